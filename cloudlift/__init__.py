@@ -1,27 +1,43 @@
 import functools
 
-import boto3
 import click
-from botocore.exceptions import ClientError
 
 from cloudlift.config import highlight_production, highlight_user_account_details
-from cloudlift.config.pre_flight import check_stack_exists
+from cloudlift.config.configuration_backup import export_configurations, import_configurations
+from cloudlift.config.pre_flight import check_aws_credentials
 from cloudlift.deployment.configs import deduce_name
 from cloudlift.deployment import EnvironmentCreator, editor
+from cloudlift.deployment.batch_deployer import (DEFAULT_MAX_BUILDS, DEFAULT_MAX_ROLLOUTS,
+                                                 DEFAULT_MAX_ROLLOUTS_PER_CLUSTER, BatchDeployer)
 from cloudlift.config.logging import log_err
+from cloudlift.deployment.cluster_capacity import CAPACITY_CHECK_WARN, CAPACITY_CHECKS
+from cloudlift.deployment.environment_status import EnvironmentStatusFetcher
+from cloudlift.deployment.rollout_monitor import DEFAULT_MAX_FAILED_STARTS, DEFAULT_ROLLOUT_DEADLINE
 from cloudlift.deployment.service_creator import ServiceCreator
 from cloudlift.deployment.service_information_fetcher import ServiceInformationFetcher
 from cloudlift.deployment.service_updater import ServiceUpdater
 from cloudlift.deployment.task_definition_creator import TaskDefinitionCreator
+from cloudlift.profiling import api_call_recorder, tracer
 from cloudlift.session import SessionCreator
 from cloudlift.version import VERSION
 from cloudlift.exceptions import UnrecoverableException
 
+
+def _require_aws_credentials(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        check_aws_credentials()
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
 def _require_environment(func):
     @click.option('--environment', '-e', prompt='environment',
                   help='environment')
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
+        check_aws_credentials()
         if kwargs['environment'] == 'production':
             highlight_production()
         highlight_user_account_details()
@@ -42,6 +58,27 @@ repo')
     return wrapper
 
 
+def _rollout_options(func):
+    @click.option('--timeout', default=DEFAULT_ROLLOUT_DEADLINE, type=click.IntRange(60),
+                  help='Seconds to wait for each ECS service to become stable')
+    @click.option('--max_failed_starts', default=DEFAULT_MAX_FAILED_STARTS,
+                  type=click.IntRange(1),
+                  help='Fail once this many new tasks in a row stopped without running')
+    @click.option('--rollback', is_flag=True,
+                  help='Put the services back on their previous task definition if the deployment fails')
+    @click.option('--max_rollouts', default=None, type=click.IntRange(1),
+                  help='Most ECS services of the service to roll out at a time')
+    @click.option('--wait_for_capacity', is_flag=True,
+                  help='Start each rollout wave once the cluster has room for its new tasks')
+    @click.option('--capacity_check', default=CAPACITY_CHECK_WARN, type=click.Choice(CAPACITY_CHECKS),
+                  help='Warn, or scale the cluster out, when it cannot place the new tasks')
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
 class CommandWrapper(click.Group):
     def __call__(self, *args, **kwargs):
         try:
@@ -53,18 +90,31 @@ class CommandWrapper(click.Group):
 
 @click.group(cls=CommandWrapper)
 @click.version_option(version=VERSION, prog_name="cloudlift")
-def cli():
+@click.option('--profile-api', is_flag=True, default=False,
+              help='Print the AWS API calls made by the command on exit')
+@click.option('--profile-api-output', type=click.Path(dir_okay=False),
+              help='Write the AWS API call profile as JSON to this file')
+@click.option('--trace', 'trace_output', type=click.Path(dir_okay=False),
+              help='Write a Chrome trace of the command phases to this file')
+@click.pass_context
+def cli(ctx, profile_api, profile_api_output, trace_output):
     """
         Cloudlift is built by Simpl developers to make it easier to launch \
         dockerized services in AWS ECS.
     """
-    try:
-        boto3.client('cloudformation')
-    except ClientError:
-        log_err("Could not connect to AWS!")
-        log_err("Ensure AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY & \
-AWS_DEFAULT_REGION env vars are set OR run 'aws configure'")
-        exit(1)
+    if profile_api or profile_api_output:
+        api_call_recorder.enable()
+        ctx.call_on_close(
+            lambda: api_call_recorder.report(profile_api_output))
+    if trace_output:
+        tracer.enable()
+        command_span = tracer.span(ctx.invoked_subcommand)
+        command_span.__enter__()
+
+        def write_trace():
+            command_span.__exit__(None, None, None)
+            tracer.report(trace_output, ctx.invoked_subcommand)
+        ctx.call_on_close(write_trace)
 
 
 @cli.command(help="Create a new service. This can contain multiple \
@@ -72,21 +122,20 @@ ECS services")
 @_require_environment
 @_require_name
 def create_service(name, environment):
-    check_stack_exists(name, environment, "create")
-    ServiceCreator(name, environment).create()
+    ServiceCreator(name, environment, stack_check="create").create()
 
 
 @cli.command(help="Update existing service.")
 @_require_environment
 @_require_name
 def update_service(name, environment):
-    check_stack_exists(name, environment, "update")
-    ServiceCreator(name, environment).update()
+    ServiceCreator(name, environment, stack_check="update").update()
 
 
 @cli.command(help="Create a new environment")
 @click.option('--environment', '-e', prompt='environment',
               help='environment')
+@_require_aws_credentials
 def create_environment(environment):
     EnvironmentCreator(environment).run()
 
@@ -104,8 +153,33 @@ def update_environment(environment, update_ecs_agents):
 in parameter store")
 @_require_name
 @_require_environment
-def edit_config(name, environment):
-    editor.edit_config(name, environment)
+@click.option('--dry_run', is_flag=True,
+              help='Show the parameter changes without making them')
+def edit_config(name, environment, dry_run):
+    editor.edit_config(name, environment, dry_run)
+
+
+@cli.command(help="Export all environment and service configurations \
+to a JSON lines file")
+@click.option('--output', '-o', required=True, type=click.Path(dir_okay=False),
+              help='File to write the configurations to')
+@click.option('--segments', default=1, type=click.IntRange(1, 32),
+              help='Number of parallel scan segments per table')
+@_require_aws_credentials
+def export_configs(output, segments):
+    export_configurations(output, segments)
+
+
+@cli.command(help="Import environment and service configurations \
+written by export_configs")
+@click.option('--input', '-i', 'input_path', required=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help='File written by export_configs')
+@click.option('--yes', '-y', is_flag=True,
+              help='Replace existing configurations without asking')
+@_require_aws_credentials
+def import_configs(input_path, yes):
+    import_configurations(input_path, assume_yes=yes)
 
 
 @cli.command()
@@ -116,8 +190,45 @@ def edit_config(name, environment):
 @click.option("--build-arg", type=(str, str), multiple=True, help="These args are passed to docker build command "
                                                                   "as --build-args. Supports multiple.\
                                                                    Please leave space between name and value" )
-def deploy_service(name, environment, version, build_arg):
-    ServiceUpdater(name, environment, None, version, dict(build_arg)).run()
+@_rollout_options
+def deploy_service(name, environment, version, build_arg, timeout, max_failed_starts, rollback,
+                   max_rollouts, wait_for_capacity, capacity_check):
+    ServiceUpdater(name, environment, None, version, dict(build_arg), deadline=timeout,
+                   max_failed_starts=max_failed_starts, rollback=rollback,
+                   max_rollouts=max_rollouts, wait_for_capacity=wait_for_capacity,
+                   capacity_check=capacity_check).run()
+
+
+@cli.command(help="Deploy the services listed in a manifest file, \
+to one or more environments")
+@click.option('--manifest', '-m', required=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help='JSON list of {"name", "environment", "version"} \
+with optional "path", "env_sample" and "build_args"')
+@click.option('--max_builds', default=DEFAULT_MAX_BUILDS, type=click.IntRange(1, 16),
+              help='Number of images built or verified at a time')
+@click.option('--max_rollouts', default=DEFAULT_MAX_ROLLOUTS, type=click.IntRange(1, 64),
+              help='Number of ECS services rolled out at a time')
+@click.option('--max_rollouts_per_cluster', default=DEFAULT_MAX_ROLLOUTS_PER_CLUSTER,
+              type=click.IntRange(1, 64),
+              help='Number of ECS services rolled out at a time in one cluster')
+@click.option('--report', type=click.Path(dir_okay=False),
+              help='Write the result of every deployment as JSON to this file')
+@_require_aws_credentials
+def deploy_many(manifest, max_builds, max_rollouts, max_rollouts_per_cluster, report):
+    BatchDeployer(manifest, max_builds, max_rollouts, max_rollouts_per_cluster, report).run()
+
+
+@cli.command(help="Deploy changed configuration in parameter store \
+with the images which are running")
+@_require_environment
+@_require_name
+@_rollout_options
+def deploy_config(name, environment, timeout, max_failed_starts, rollback, max_rollouts,
+                  wait_for_capacity, capacity_check):
+    ServiceUpdater(name, environment, None, deadline=timeout, max_failed_starts=max_failed_starts,
+                   rollback=rollback, max_rollouts=max_rollouts, wait_for_capacity=wait_for_capacity,
+                   capacity_check=capacity_check).deploy_config()
 
 
 @cli.command()
@@ -149,6 +260,7 @@ def update_task_definition(name, environment, version, build_arg):
 @click.option('--additional_tags', default=[], multiple=True,
               help='Additional tags for the image apart from commit SHA')
 @_require_name
+@_require_aws_credentials
 def upload_to_ecr(name, local_tag, additional_tags):
     ServiceUpdater(name, '', '', local_tag).upload_image(additional_tags)
 
@@ -163,6 +275,13 @@ def get_version(name, environment, short):
     ServiceInformationFetcher(name, environment).get_version(short)
 
 
+@cli.command(help="Show the deployed version and task counts of every \
+service in an environment")
+@_require_environment
+def status(environment):
+    EnvironmentStatusFetcher(environment).print_status()
+
+
 @cli.command(help="Start SSH session in instance running a current \
 service task")
 @_require_environment
@@ -1,17 +1,35 @@
+import functools
+
 from boto3 import client
 
+from cloudlift.profiling import instrument_client
+
+
+@functools.lru_cache(maxsize=None)
+def _get_default_caller_identity():
+    return instrument_client(client('sts')).get_caller_identity()
+
+
+def get_caller_identity(sts_client=None):
+    '''
+        Identity of the credentials in use. The lookup against the default
+        credentials is made once per process and shared by every caller.
+    '''
+    if sts_client:
+        return sts_client.get_caller_identity()
+    return _get_default_caller_identity()
+
 
 def get_account_id(sts_client=None):
-    sts_client = sts_client or client('sts')
-    return sts_client.get_caller_identity().get('Account')
+    return get_caller_identity(sts_client).get('Account')
 
 def get_user_id(sts_client=None):
-    sts_client = sts_client or client('sts')
     username = ""
-    account = sts_client.get_caller_identity().get('Account')
-    user_id = (sts_client.get_caller_identity()['Arn'].split("/")[0]).split(":")[-1]
+    identity = get_caller_identity(sts_client)
+    account = identity.get('Account')
+    user_id = (identity['Arn'].split("/")[0]).split(":")[-1]
     if user_id == "user":
-        username = sts_client.get_caller_identity().get('Arn').split('/')[1]
+        username = identity.get('Arn').split('/')[1]
     elif user_id == "assumed-role":
-        username = sts_client.get_caller_identity().get('Arn').split('assumed-role/')[1]
-    return username, account
\ No newline at end of file
+        username = identity.get('Arn').split('assumed-role/')[1]
+    return username, account
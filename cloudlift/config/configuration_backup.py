@@ -0,0 +1,123 @@
+'''
+Bulk export and import of the environment and service configurations
+stored in DynamoDB, e.g. to copy them into another account.
+'''
+
+import json
+from time import sleep
+
+from click import confirm
+
+from cloudlift.config.dynamodb_configuration import (CONFIG_VERSION_ATTRIBUTE, DynamodbConfiguration,
+                                                    scan_items)
+from cloudlift.config.environment_configuration import ENVIRONMENT_CONFIGURATION_TABLE
+from cloudlift.config.logging import log_bold
+from cloudlift.config.service_configuration import SERVICE_CONFIGURATION_TABLE
+from cloudlift.exceptions import UnrecoverableException
+
+CONFIGURATION_TABLES = [
+    (ENVIRONMENT_CONFIGURATION_TABLE, [('environment', None)]),
+    (SERVICE_CONFIGURATION_TABLE, [('service_name', None), ('environment', None)]),
+]
+BATCH_WRITE_ITEM_LIMIT = 25
+MAX_BATCH_ATTEMPTS = 8
+
+
+def export_configurations(output_path, segments=1):
+    '''
+        Write every configuration item to output_path, one JSON object per
+        line holding the table name and the item in DynamoDB's typed JSON.
+    '''
+    with open(output_path, 'w') as output_fp:
+        for table_name, key_attributes in CONFIGURATION_TABLES:
+            dynamodb_client = DynamodbConfiguration(table_name, key_attributes).dynamodb_client
+            items = scan_items(dynamodb_client, table_name, segments=segments)
+            for item in items:
+                output_fp.write(json.dumps({'table': table_name, 'item': item}) + '\n')
+            log_bold("Exported {} items from {}".format(len(items), table_name))
+
+
+def import_configurations(input_path, assume_yes=False):
+    '''
+        Write the items exported by export_configurations back, replacing
+        items with the same keys. Missing tables are created. Each item gets
+        a config_version above both the exported one and the one it
+        replaces, so that no one can save over it with a version read
+        before the import.
+    '''
+    items_by_table = {table_name: [] for table_name, _ in CONFIGURATION_TABLES}
+    with open(input_path) as input_fp:
+        for line_number, line in enumerate(input_fp, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get('table') not in items_by_table:
+                raise UnrecoverableException(
+                    "Unknown table {} in line {} of {}".format(
+                        record.get('table'), line_number, input_path))
+            items_by_table[record['table']].append(record['item'])
+
+    summary = ', '.join('{} items into {}'.format(len(items), table_name)
+                        for table_name, items in items_by_table.items())
+    if not assume_yes and not confirm('Import {}, replacing existing items?'.format(summary)):
+        log_bold("Import aborted.")
+        return
+
+    for table_name, key_attributes in CONFIGURATION_TABLES:
+        items = items_by_table[table_name]
+        if not items:
+            continue
+        dynamodb_configuration = DynamodbConfiguration(table_name, key_attributes)
+        dynamodb_configuration.ensure_table()
+        current_versions = _config_versions(dynamodb_configuration.dynamodb_client, table_name, key_attributes)
+        items = [_next_version(item, current_versions.get(_item_key(item, key_attributes), 0))
+                 for item in items]
+        for items_chunk in _chunks(items, BATCH_WRITE_ITEM_LIMIT):
+            _batch_write_items(dynamodb_configuration.dynamodb_client, table_name, items_chunk)
+        log_bold("Imported {} items into {}".format(len(items), table_name))
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _config_versions(dynamodb_client, table_name, key_attributes):
+    attributes = [key for key, _ in key_attributes] + [CONFIG_VERSION_ATTRIBUTE]
+    items = scan_items(
+        dynamodb_client,
+        table_name,
+        ProjectionExpression=', '.join('#attribute%d' % index for index in range(len(attributes))),
+        ExpressionAttributeNames={'#attribute%d' % index: attribute
+                                  for index, attribute in enumerate(attributes)}
+    )
+    return {_item_key(item, key_attributes): _config_version(item) for item in items}
+
+
+def _item_key(item, key_attributes):
+    return tuple(item[key]['S'] for key, _ in key_attributes)
+
+
+def _config_version(item):
+    return int(item.get(CONFIG_VERSION_ATTRIBUTE, {}).get('N', 0))
+
+
+def _next_version(item, current_version):
+    version = max(_config_version(item), current_version) + 1
+    return dict(item, **{CONFIG_VERSION_ATTRIBUTE: {'N': str(version)}})
+
+
+def _batch_write_items(dynamodb_client, table_name, items):
+    request_items = {table_name: [{'PutRequest': {'Item': item}} for item in items]}
+    for attempt in range(MAX_BATCH_ATTEMPTS):
+        response = dynamodb_client.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems')
+        if not request_items:
+            return
+        _backoff(attempt)
+    raise UnrecoverableException(
+        "DynamoDB kept throttling writes to {}, import incomplete.".format(table_name))
+
+
+def _backoff(attempt):
+    sleep(min(0.1 * 2 ** attempt, 5))
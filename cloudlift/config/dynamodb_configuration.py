@@ -1,6 +1,11 @@
 import boto3
+from boto3.dynamodb.types import TypeDeserializer
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 from cloudlift.config.logging import log_bold, log_warning, log
+from cloudlift.profiling import instrument_client
+
+CONFIG_VERSION_ATTRIBUTE = 'config_version'
 
 
 class DynamodbConfiguration:
@@ -11,11 +16,15 @@ class DynamodbConfiguration:
     def __init__(self, table_name, kv_pairs):
         session = boto3.session.Session()
         self.dynamodb = session.resource('dynamodb')
-        self.dynamodb_client = session.client('dynamodb')
+        instrument_client(self.dynamodb.meta.client)
+        self.dynamodb_client = instrument_client(session.client('dynamodb'))
         self.kv_pairs = kv_pairs
         self.table_name = table_name
 
-    def _get_table(self):
+    def ensure_table(self):
+        '''
+            The configuration table, created first if it does not exist.
+        '''
         table_names = self.dynamodb_client.list_tables()['TableNames']
         if self.table_name not in table_names:
             log_warning("Could not find {} table, creating one..".format(self.table_name))
@@ -46,3 +55,60 @@ class DynamodbConfiguration:
                 TableName=self.table_name)["Table"]["TableStatus"]
         sleep(10)
         log("{} table status is ACTIVE".format(self.table_name))
+
+
+def versioned_update(table, key, configuration, expected_version):
+    '''
+        Store configuration in the item at key, provided its config_version
+        is still expected_version, and move the item to the next version.
+        Items written before versioning have no config_version, which
+        expected_version None stands for. Raises ClientError with code
+        ConditionalCheckFailedException if the item was changed in between.
+    '''
+    if expected_version is None:
+        condition_expression = 'attribute_not_exists(config_version)'
+        expression_attribute_values = {}
+    else:
+        condition_expression = 'config_version = :expected_version'
+        expression_attribute_values = {':expected_version': expected_version}
+    expression_attribute_values.update({
+        ':configuration': configuration,
+        ':config_version': (expected_version or 0) + 1
+    })
+    return table.update_item(
+        Key=key,
+        UpdateExpression='SET configuration = :configuration, config_version = :config_version',
+        ConditionExpression=condition_expression,
+        ExpressionAttributeValues=expression_attribute_values,
+        ReturnValues="UPDATED_NEW"
+    )
+
+
+def is_conflicting_write(client_error):
+    return client_error.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+def scan_items(dynamodb_client, table_name, segments=1, **scan_arguments):
+    '''
+        Scan every page of a table, following LastEvaluatedKey. With more
+        than one segment the segments are scanned in parallel threads.
+        Items are returned in DynamoDB's typed JSON, e.g. {'S': 'staging'}.
+    '''
+    def scan_segment(segment):
+        arguments = dict(scan_arguments, TableName=table_name)
+        if segments > 1:
+            arguments.update(Segment=segment, TotalSegments=segments)
+        items = []
+        for page in dynamodb_client.get_paginator('scan').paginate(**arguments):
+            items.extend(page['Items'])
+        return items
+
+    if segments == 1:
+        return scan_segment(0)
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        return [item for items in executor.map(scan_segment, range(segments)) for item in items]
+
+
+def deserialize_item(item):
+    deserializer = TypeDeserializer()
+    return {key: deserializer.deserialize(value) for key, value in item.items()}
@@ -2,28 +2,225 @@
 This module handles global cloudlift configuration that is custom to
 the organization using cloudlift
 """
+import copy
 import ipaddress
+from functools import lru_cache
 from distutils.version import LooseVersion
 
 import boto3
 import dictdiffer
 from botocore.exceptions import ClientError
 from click import confirm, prompt
-from jsonschema import validate
-from jsonschema.exceptions import ValidationError
 
 from cloudlift.version import VERSION
 from cloudlift.exceptions import UnrecoverableException
 from cloudlift.config import DecimalEncoder, print_json_changes
-from cloudlift.config.dynamodb_configuration import DynamodbConfiguration
+from cloudlift.config.dynamodb_configuration import (CONFIG_VERSION_ATTRIBUTE, DynamodbConfiguration,
+                                                      deserialize_item, is_conflicting_write,
+                                                      scan_items, versioned_update)
 from cloudlift.config.pre_flight import check_sns_topic_exists, check_aws_instance_type
-from cloudlift.config.utils import ConfigUtils
+from cloudlift.config.utils import (ConfigUtils, compile_validator, resolve_concurrent_changes,
+                                    validate_configuration)
 from cloudlift.constants import logging_json_schema
 # import config.mfa as mfa
 from cloudlift.config.logging import log_bold, log_err, log_warning
 
 ENVIRONMENT_CONFIGURATION_TABLE = 'environment_configurations'
 
+# TODO: add cidr etc validation
+ENVIRONMENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "cluster": {
+            "type": "object",
+            "properties": {
+                "min_instances": {"type": "integer"},
+                "max_instances": {"type": "integer"},
+                "spot_min_instances": {"type": "integer"},
+                "spot_max_instances": {"type": "integer"},
+                "instance_type": {"type": "string"},
+                "key_name": {"type": "string"},
+                "allocation_strategy": {"type": "string"},
+                "spot_instance_pools": {"type": "integer"},
+                "ecs_instance_default_lifecycle_type":  {
+                    "type": "string",
+                    "pattern": "^(spot|ondemand)$"
+                },
+                "capacity_providers": {
+                    "type": "object",
+                    "properties": {
+                        "target_capacity": {"type": "integer", "minimum": 1, "maximum": 100},
+                        "minimum_scaling_step_size": {"type": "integer", "minimum": 1, "maximum": 10000},
+                        "maximum_scaling_step_size": {"type": "integer", "minimum": 1, "maximum": 10000},
+                        "instance_warmup_period": {"type": "integer", "minimum": 0, "maximum": 10000},
+                        "managed_termination_protection": {"type": "boolean"}
+                    }
+                },
+                "warm_pool": {
+                    "type": "object",
+                    "properties": {
+                        "min_size": {"type": "integer", "minimum": 0},
+                        "max_prepared_capacity": {"type": "integer", "minimum": 0},
+                        "pool_state": {"type": "string", "enum": ["Stopped", "Running"]},
+                        "reuse_on_scale_in": {"type": "boolean"},
+                        "heartbeat_timeout": {"type": "integer", "minimum": 30, "maximum": 7200}
+                    }
+                }
+            },
+            "required": [
+                "min_instances",
+                "max_instances",
+                "instance_type",
+                "key_name"
+            ]
+        },
+        "environment": {
+            "type": "object",
+            "properties": {
+                "notifications_arn": {"type": "string"},
+                "ssl_certificate_arn": {"type": "string"}
+            },
+            "required": [
+                "notifications_arn",
+                "ssl_certificate_arn"
+            ]
+        },
+        "region": {"type": "string"},
+        "vpc": {
+            "type": "object",
+            "properties": {
+                "cidr": {
+                    "type": "string"
+                },
+                "nat-gateway": {
+                    "type": "object",
+                    "properties": {
+                        "elastic-ip-allocation-id": {
+                            "type": "string"
+                        }
+                    },
+                    "required": [
+                        "elastic-ip-allocation-id"
+                    ]
+                },
+                "subnets": {
+                    "type": "object",
+                    "properties": {
+                        "private": {
+                            "type": "object",
+                            "properties": {
+                                "subnet-1": {
+                                    "type": "object",
+                                    "properties": {
+                                        "cidr": {
+                                            "type": "string"
+                                        }
+                                    },
+                                    "required": [
+                                        "cidr"
+                                    ]
+                                },
+                                "subnet-2": {
+                                    "type": "object",
+                                    "properties": {
+                                        "cidr": {
+                                            "type": "string"
+                                        }
+                                    },
+                                    "required": [
+                                        "cidr"
+                                    ]
+                                }
+                            },
+                            "required": [
+                                "subnet-1",
+                                "subnet-2"
+                            ]
+                        },
+                        "public": {
+                            "type": "object",
+                            "properties": {
+                                "subnet-1": {
+                                    "type": "object",
+                                    "properties": {
+                                        "cidr": {
+                                            "type": "string"
+                                        }
+                                    },
+                                    "required": [
+                                        "cidr"
+                                    ]
+                                },
+                                "subnet-2": {
+                                    "type": "object",
+                                    "properties": {
+                                        "cidr": {
+                                            "type": "string"
+                                        }
+                                    },
+                                    "required": [
+                                        "cidr"
+                                    ]
+                                }
+                            },
+                            "required": [
+                                "subnet-1",
+                                "subnet-2"
+                            ]
+                        }
+                    },
+                    "required": [
+                        "private",
+                        "public"
+                    ]
+                }
+            },
+            "required": [
+                "cidr",
+                "nat-gateway",
+                "subnets"
+            ]
+        },
+        "service_defaults": {
+            "type": "object",
+            "properties": {
+                "logging": logging_json_schema,
+                "fluentbit_config": {
+                    "type": "object",
+                    "properties": {
+                        "image_uri": {
+                            "type": "string"
+                        },
+                        "env": {
+                            "type": "object",
+                        }
+                    },
+                    "required": ["image_uri"]
+                },
+            }
+        }
+    },
+    "required": [
+        "cluster",
+        "environment",
+        "region",
+        "vpc"
+    ]
+}
+
+
+@lru_cache(maxsize=None)
+def _environment_configuration_validator(environment):
+    return compile_validator({
+        # "$schema": "http://json-schema.org/draft-04/schema#",
+        "title": "configuration",
+        "type": "object",
+        "properties": {
+            environment: ENVIRONMENT_SCHEMA
+        },
+        "required": [environment]
+    })
+
 
 class EnvironmentConfiguration(object):
     '''
@@ -35,13 +232,19 @@ class EnvironmentConfiguration(object):
 
         session = boto3.session.Session()
         self.dynamodb = session.resource('dynamodb')
-        self.table = DynamodbConfiguration(ENVIRONMENT_CONFIGURATION_TABLE, [
-                       ('environment', self.environment)])._get_table()
+        dynamodb_configuration = DynamodbConfiguration(ENVIRONMENT_CONFIGURATION_TABLE, [
+                       ('environment', self.environment)])
+        self.table = dynamodb_configuration.ensure_table()
+        self.dynamodb_client = dynamodb_configuration.dynamodb_client
+        self.config_version = None
+        self._base_configuration = None
         self.config_utils = ConfigUtils(changes_validation_function=self._validate_changes)
 
-    def get_config(self, cloudlift_version=VERSION):
+    def get_config(self, cloudlift_version=VERSION, for_update=False):
         '''
-            Get configuration from DynamoDB
+            Get configuration from DynamoDB. Reads are eventually consistent
+            unless for_update is set, for a configuration which is going to
+            be changed and saved.
         '''
 
         try:
@@ -49,12 +252,14 @@ class EnvironmentConfiguration(object):
                 Key={
                     'environment': self.environment
                 },
-                ConsistentRead=True,
+                ConsistentRead=for_update,
                 AttributesToGet=[
-                    'configuration'
+                    'configuration',
+                    CONFIG_VERSION_ATTRIBUTE
                 ]
             )
             existing_configuration = configuration_response['Item']['configuration']
+            self.config_version = configuration_response['Item'].get(CONFIG_VERSION_ATTRIBUTE)
             previous_cloudlift_version = existing_configuration.pop("cloudlift_version", None)
             # print(f"Previous cloudlift version in environment config is {previous_cloudlift_version}")
             if previous_cloudlift_version and LooseVersion(cloudlift_version) < LooseVersion(previous_cloudlift_version):
@@ -65,6 +270,9 @@ class EnvironmentConfiguration(object):
                                              f'latest version (Recommended):\n'
                                              f'\tpip install -U cloudlift\n\nOR\n\nUpgrade to a compatible version:\n'
                                              f'\tpip install -U cloudlift=={previous_cloudlift_version}')
+            if for_update:
+                # kept to merge with changes saved by someone else meanwhile
+                self._base_configuration = copy.deepcopy(existing_configuration)
             return existing_configuration
         except ClientError:
             raise UnrecoverableException("Unable to fetch environment configuration from DynamoDB.")
@@ -77,18 +285,18 @@ class EnvironmentConfiguration(object):
             self._create_config()
         self._edit_config()
 
-    def get_all_environments(self):
-        response = self.table.scan(
-            TableName=ENVIRONMENT_CONFIGURATION_TABLE,
-            AttributesToGet=[
-                'environment',
-            ],
-            Limit=10,
-            Select='SPECIFIC_ATTRIBUTES',
-            ScanFilter={},
-            ConsistentRead=True
+    def get_all_environments(self, segments=1):
+        '''
+            Names of all environments. Large tables can be scanned in
+            parallel segments.
+        '''
+        items = scan_items(
+            self.dynamodb_client,
+            ENVIRONMENT_CONFIGURATION_TABLE,
+            segments=segments,
+            ProjectionExpression='environment'
         )
-        return [env['environment'] for env in response['Items']]
+        return sorted(deserialize_item(item)['environment'] for item in items)
 
     def _env_config_exists(self):
         response = self.table.get_item(
@@ -142,7 +350,7 @@ class EnvironmentConfiguration(object):
         check = False
         while not check:
             cluster_instance_types = cluster_instance_types.replace(" ", "")
-            check, instance_type = check_aws_instance_type(cluster_instance_types)
+            check, instance_type = check_aws_instance_type(cluster_instance_types, region)
             if not check:
                 log_err(f"Invalid instance type: {instance_type}")
                 cluster_instance_types = prompt( "Instance types in comma delimited string, \nFor On-Demand only first instance type will be considered", default='t2.micro,m5.xlarge')
@@ -221,7 +429,7 @@ class EnvironmentConfiguration(object):
             Open editor to update configuration
         '''
         try:
-            current_configuration = self.get_config()
+            current_configuration = self.get_config(for_update=True)
             previous_cloudlift_version = current_configuration.pop('cloudlift_version', None)
             updated_configuration = self.config_utils.fault_tolerant_edit_config(current_configuration=current_configuration)
             if updated_configuration is None:
@@ -248,7 +456,9 @@ class EnvironmentConfiguration(object):
 
     def _set_config(self, config):
         '''
-            Set configuration in DynamoDB
+            Set configuration in DynamoDB, if it has not changed since it
+            was read. Otherwise the changes are merged with the stored
+            configuration, with confirmation.
         '''
         self._validate_changes(config)
         config['cloudlift_version'] = VERSION
@@ -256,207 +466,54 @@ class EnvironmentConfiguration(object):
         check_sns_topic_exists(sns_arn, self.environment)
 
         try:
-            configuration_response = self.table.update_item(
-                TableName=ENVIRONMENT_CONFIGURATION_TABLE,
-                Key={
+            configuration_response = versioned_update(
+                self.table,
+                {
                     'environment': self.environment
                 },
-                UpdateExpression='SET configuration = :configuration',
-                ExpressionAttributeValues={
-                    ':configuration': config
-                },
-                ReturnValues="UPDATED_NEW"
+                config,
+                self.config_version
             )
-            return configuration_response
-        except ClientError:
-            raise UnrecoverableException("Unable to store environment configuration in DynamoDB.")
-        pass
+        except ClientError as client_error:
+            if not is_conflicting_write(client_error):
+                raise UnrecoverableException("Unable to store environment configuration in DynamoDB.")
+            return self._set_config_over_concurrent_changes(config)
+        self.config_version = configuration_response['Attributes'][CONFIG_VERSION_ATTRIBUTE]
+        self._base_configuration = None
+        return configuration_response
+
+    def _set_config_over_concurrent_changes(self, config):
+        base_configuration = self._base_configuration
+        latest_configuration = self.get_config(VERSION, for_update=True)
+        updated_configuration = {
+            key: value for key, value in config.items() if key != 'cloudlift_version'
+        }
+        resolved_configuration = resolve_concurrent_changes(
+            base_configuration,
+            latest_configuration,
+            updated_configuration
+        )
+        if resolved_configuration is None:
+            return None
+        return self._set_config(resolved_configuration)
 
     def update_cloudlift_version(self):
         '''
             Updates cloudlift version in service configuration
         '''
         print(f"setting cloudlift version to {VERSION}")
-        config = self.get_config(VERSION)
+        config = self.get_config(VERSION, for_update=True)
         self._set_config(config)
 
-    def _validate_changes(self, configuration):
+    def _validate_changes(self, configuration, collect_all_errors=False):
         log_bold("\nValidating schema..")
-        # TODO: add cidr etc validation
-        schema = {
-            # "$schema": "http://json-schema.org/draft-04/schema#",
-            "title": "configuration",
-            "type": "object",
-            "properties": {
-                self.environment: {
-                    "type": "object",
-                    "properties": {
-                        "cluster": {
-                            "type": "object",
-                            "properties": {
-                                "min_instances": {"type": "integer"},
-                                "max_instances": {"type": "integer"},
-                                "spot_min_instances": {"type": "integer"},
-                                "spot_max_instances": {"type": "integer"},
-                                "instance_type": {"type": "string"},
-                                "key_name": {"type": "string"},
-                                "allocation_strategy": {"type": "string"},
-                                "spot_instance_pools": {"type": "integer"},
-                                "ecs_instance_default_lifecycle_type":  {
-                                    "type": "string",
-                                    "pattern": "^(spot|ondemand)$"
-                                }
-                            },
-                            "required": [
-                                "min_instances",
-                                "max_instances",
-                                "instance_type",
-                                "key_name"
-                            ]
-                        },
-                        "environment": {
-                            "type": "object",
-                            "properties": {
-                                "notifications_arn": {"type": "string"},
-                                "ssl_certificate_arn": {"type": "string"}
-                            },
-                            "required": [
-                                "notifications_arn",
-                                "ssl_certificate_arn"
-                            ]
-                        },
-                        "region": {"type": "string"},
-                        "vpc": {
-                            "type": "object",
-                            "properties": {
-                                "cidr": {
-                                    "type": "string"
-                                },
-                                "nat-gateway": {
-                                    "type": "object",
-                                    "properties": {
-                                        "elastic-ip-allocation-id": {
-                                            "type": "string"
-                                        }
-                                    },
-                                    "required": [
-                                        "elastic-ip-allocation-id"
-                                    ]
-                                },
-                                "subnets": {
-                                    "type": "object",
-                                    "properties": {
-                                        "private": {
-                                            "type": "object",
-                                            "properties": {
-                                                "subnet-1": {
-                                                    "type": "object",
-                                                    "properties": {
-                                                        "cidr": {
-                                                            "type": "string"
-                                                        }
-                                                    },
-                                                    "required": [
-                                                        "cidr"
-                                                    ]
-                                                },
-                                                "subnet-2": {
-                                                    "type": "object",
-                                                    "properties": {
-                                                        "cidr": {
-                                                            "type": "string"
-                                                        }
-                                                    },
-                                                    "required": [
-                                                        "cidr"
-                                                    ]
-                                                }
-                                            },
-                                            "required": [
-                                                "subnet-1",
-                                                "subnet-2"
-                                            ]
-                                        },
-                                        "public": {
-                                            "type": "object",
-                                            "properties": {
-                                                "subnet-1": {
-                                                    "type": "object",
-                                                    "properties": {
-                                                        "cidr": {
-                                                            "type": "string"
-                                                        }
-                                                    },
-                                                    "required": [
-                                                        "cidr"
-                                                    ]
-                                                },
-                                                "subnet-2": {
-                                                    "type": "object",
-                                                    "properties": {
-                                                        "cidr": {
-                                                            "type": "string"
-                                                        }
-                                                    },
-                                                    "required": [
-                                                        "cidr"
-                                                    ]
-                                                }
-                                            },
-                                            "required": [
-                                                "subnet-1",
-                                                "subnet-2"
-                                            ]
-                                        }
-                                    },
-                                    "required": [
-                                        "private",
-                                        "public"
-                                    ]
-                                }
-                            },
-                            "required": [
-                                "cidr",
-                                "nat-gateway",
-                                "subnets"
-                            ]
-                        },
-                        "service_defaults": {
-                            "type": "object",
-                            "properties": {
-                                "logging": logging_json_schema,
-                                "fluentbit_config": {
-                                    "type": "object",
-                                    "properties": {
-                                        "image_uri": {
-                                            "type": "string"
-                                        },
-                                        "env": {
-                                            "type": "object",
-                                        }
-                                    },
-                                    "required": ["image_uri"]
-                                },
-                            }
-                        }
-                    },
-                    "required": [
-                        "cluster",
-                        "environment",
-                        "region",
-                        "vpc"
-                    ]
-                }
-            },
-            "required": [self.environment]
-        }
-        try:
-            validate(configuration, schema)
-        except ValidationError as validation_error:
-            log_err("Schema validation failed!")
-            error_path = str(".".join(list(validation_error.relative_path)))
-            if error_path:
-                raise UnrecoverableException(validation_error.message + " in " + error_path)
-            else:
-                raise UnrecoverableException(validation_error.message)
+        validate_configuration(
+            _environment_configuration_validator(self.environment),
+            configuration,
+            collect_all_errors=collect_all_errors
+        )
+        capacity_providers = configuration.get(self.environment, {}).get('cluster', {}).get('capacity_providers', {})
+        if capacity_providers.get('minimum_scaling_step_size', 1) > capacity_providers.get('maximum_scaling_step_size', 10000):
+            raise UnrecoverableException("cluster.capacity_providers.minimum_scaling_step_size is more than "
+                                         "maximum_scaling_step_size.")
         log_bold("Schema valid!")
@@ -5,7 +5,7 @@ from boto3 import client
 from boto3.session import Session
 from cloudlift.exceptions import UnrecoverableException
 
-from cloudlift.config import get_account_id
+from cloudlift.config import get_account_id, get_caller_identity
 from cloudlift.config.logging import log_bold, log_err
 
 
@@ -57,4 +57,4 @@ def get_mfa_session(mfa_code=None, region='ap-south-1'):
 
 
 def get_username():
-    return client('sts').get_caller_identity()['Arn'].split("user/")[1]
+    return get_caller_identity()['Arn'].split("user/")[1]
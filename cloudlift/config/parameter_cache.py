@@ -0,0 +1,97 @@
+'''
+Encrypted on-disk cache of SSM parameter values, so that parameters which
+did not change since the last read are not downloaded and decrypted again.
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+
+from cloudlift.exceptions import UnrecoverableException
+
+SSM_CACHE_ENV = 'CLOUDLIFT_SSM_CACHE'
+SSM_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cloudlift', 'ssm_cache')
+SSM_CACHE_KEY_FILE = 'cache.key'
+
+
+def is_parameter_cache_enabled():
+    return os.environ.get(SSM_CACHE_ENV, '').lower() in ('1', 'true', 'yes')
+
+
+class EncryptedParameterCache(object):
+    '''
+        Parameters by name, each with the value, the ARN and the version
+        stamp it was read at, stored encrypted with a Fernet key.
+
+        The key is kept next to the cache files, so anyone who can read
+        the cache can read the key. What protects the values is the
+        directory and files being readable only by the user; encryption
+        only keeps the values out of the cache files as plain text.
+    '''
+
+    def __init__(self, name, cache_dir=None):
+        self.cache_dir = cache_dir or SSM_CACHE_DIR
+        self.cache_file = os.path.join(
+            self.cache_dir, hashlib.sha256(name.encode('utf-8')).hexdigest() + '.cache')
+        self._fernet = _load_fernet(os.path.join(self.cache_dir, SSM_CACHE_KEY_FILE))
+
+    def load(self):
+        from cryptography.fernet import InvalidToken
+        try:
+            with open(self.cache_file, 'rb') as cache_fp:
+                return json.loads(self._fernet.decrypt(cache_fp.read()).decode('utf-8'))
+        except (OSError, ValueError, InvalidToken):
+            return {}
+
+    def save(self, parameters):
+        encrypted = self._fernet.encrypt(json.dumps(parameters).encode('utf-8'))
+        fd, temporary_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as cache_fp:
+            cache_fp.write(encrypted)
+        os.replace(temporary_path, self.cache_file)
+
+
+def version_stamp(parameter):
+    '''
+        What describe_parameters and get_parameters both report about the
+        revision of a parameter.
+    '''
+    return [parameter['Version'], parameter['LastModifiedDate'].isoformat()]
+
+
+def _load_fernet(key_path):
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError:
+        raise UnrecoverableException(
+            "The SSM parameter cache needs the cryptography package. Install it "
+            "with `pip install cloudlift[ssm-cache]` or unset {}.".format(SSM_CACHE_ENV))
+    os.makedirs(os.path.dirname(key_path), mode=0o700, exist_ok=True)
+    try:
+        with open(key_path, 'rb') as key_fp:
+            return Fernet(key_fp.read())
+    except FileNotFoundError:
+        replace_existing = False
+    except ValueError:
+        # Neither the key nor anything cached with it can be used.
+        replace_existing = True
+    key = Fernet.generate_key()
+    fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(key_path))
+    try:
+        with os.fdopen(fd, 'wb') as key_fp:
+            key_fp.write(key)
+        if replace_existing:
+            os.replace(temporary_path, key_path)
+        else:
+            # Linking publishes the complete key, and only if no other
+            # process published one first.
+            try:
+                os.link(temporary_path, key_path)
+            except FileExistsError:
+                with open(key_path, 'rb') as key_fp:
+                    return Fernet(key_fp.read())
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return Fernet(key)
@@ -1,9 +1,67 @@
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from botocore.exceptions import ClientError
 from cloudlift.exceptions import UnrecoverableException
 
 from cloudlift.config import get_client_for
-from cloudlift.config.logging import log_err
+from cloudlift.config.logging import log_bold, log_err, log_intent, log_intent_err
+from cloudlift.config.parameter_cache import (EncryptedParameterCache, is_parameter_cache_enabled,
+                                              version_stamp)
+from cloudlift.profiling import THROTTLING_ERROR_CODES
+
+SSM_WRITE_WORKERS = 8
+# PutParameter allows 3 transactions per second at standard throughput and
+# up to 1000 with higher throughput enabled
+SSM_INITIAL_PUT_RATE = 3
+SSM_MAX_PUT_RATE = 40
+SSM_MIN_PUT_RATE = 0.5
+SSM_MAX_PUT_ATTEMPTS = 8
+SSM_DELETE_PARAMETERS_LIMIT = 10
+SSM_GET_PARAMETERS_LIMIT = 10
+
+
+class AdaptiveTokenBucket(object):
+    '''
+        Allows calls at rate per second, in bursts of at most rate calls.
+        The rate is halved whenever a call is throttled and grows again
+        slowly with every call which succeeds.
+    '''
+
+    def __init__(self, rate, min_rate, max_rate, increase=0.5,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = rate
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
 
 
 class ParameterStore(object):
@@ -26,6 +84,8 @@ class ParameterStore(object):
         ))
 
     def get_existing_config(self):
+        if is_parameter_cache_enabled():
+            return self._get_existing_config_through_cache()
         environment_configs = {}
         environment_configs_path = {}
         next_token = None
@@ -55,31 +115,147 @@ class ParameterStore(object):
                 break
         return environment_configs, environment_configs_path
 
-    def set_config(self, differences):
+    def _get_existing_config_through_cache(self):
+        '''
+            Lists the parameters without their values, and downloads only
+            the ones whose version differs from the cached one.
+        '''
+        cache = EncryptedParameterCache(self.client.meta.region_name + self.path_prefix)
+        cached_parameters = cache.load()
+        listed_stamps = {}
+        paginator = self.client.get_paginator('describe_parameters')
+        for page in paginator.paginate(
+            ParameterFilters=[{
+                'Key': 'Path',
+                'Option': 'OneLevel',
+                'Values': [self.path_prefix.rstrip('/')]
+            }],
+            MaxResults=50
+        ):
+            for parameter in page['Parameters']:
+                listed_stamps[parameter['Name']] = version_stamp(parameter)
+
+        stale_names = [
+            name for name, stamp in listed_stamps.items()
+            if cached_parameters.get(name, {}).get('stamp') != stamp
+        ]
+        for start in range(0, len(stale_names), SSM_GET_PARAMETERS_LIMIT):
+            response = self.client.get_parameters(
+                Names=stale_names[start:start + SSM_GET_PARAMETERS_LIMIT],
+                WithDecryption=True
+            )
+            for parameter in response['Parameters']:
+                cached_parameters[parameter['Name']] = {
+                    'stamp': version_stamp(parameter),
+                    'value': parameter['Value'],
+                    'arn': parameter['ARN'],
+                }
+            # deleted between describe_parameters and get_parameters
+            for name in response.get('InvalidParameters', []):
+                cached_parameters.pop(name, None)
+
+        # parameters deleted since they were cached are dropped
+        parameters = {
+            name: cached_parameters[name] for name in listed_stamps if name in cached_parameters
+        }
+        if stale_names or len(parameters) != len(cached_parameters):
+            cache.save(parameters)
+
+        environment_configs = {}
+        environment_configs_path = {}
+        for name, parameter in parameters.items():
+            parameter_name = name.split(self.path_prefix)[1]
+            environment_configs[parameter_name] = parameter['value']
+            environment_configs_path[parameter_name] = parameter['arn']
+        return environment_configs, environment_configs_path
+
+    def set_config(self, differences, dry_run=False):
+        '''
+            Apply the dictdiffer differences to the parameters. Puts run
+            concurrently, paced by an AdaptiveTokenBucket, and deletes are
+            made in batches of 10. Returns the outcome per key, which is
+            'added', 'changed' or 'removed', or the error for keys which
+            failed. With dry_run nothing is written, and the outcomes
+            expected are logged and returned.
+        '''
         self._validate_changes(differences)
+        puts = []
+        removals = []
         for parameter_change in differences:
             if parameter_change[0] == 'change':
-                response = self.client.put_parameter(
-                    Name='%s%s' % (self.path_prefix, parameter_change[1]),
-                    Value=parameter_change[2][1],
-                    Type='SecureString',
-                    KeyId='alias/aws/ssm',
-                    Overwrite=True
-                )
+                puts.append((parameter_change[1], parameter_change[2][1], True))
             elif parameter_change[0] == 'add':
                 for added_parameter in parameter_change[2]:
-                    response = self.client.put_parameter(
-                        Name='%s%s' % (self.path_prefix, added_parameter[0]),
-                        Value=added_parameter[1],
-                        Type='SecureString',
-                        KeyId='alias/aws/ssm',
-                        Overwrite=False
-                    )
+                    puts.append((added_parameter[0], added_parameter[1], False))
             elif parameter_change[0] == 'remove':
-                deleted_parameters = ["%s%s" % (self.path_prefix, item[0]) for item in parameter_change[2]]
-                response = self.client.delete_parameters(
-                    Names=deleted_parameters
+                removals.extend(item[0] for item in parameter_change[2])
+
+        if dry_run:
+            report = {key: 'changed' if overwrite else 'added' for key, _, overwrite in puts}
+            report.update((key, 'removed') for key in removals)
+            for key, outcome in report.items():
+                log_intent("%s would be %s" % (key, outcome))
+            return report
+
+        report = {}
+        bucket = AdaptiveTokenBucket(SSM_INITIAL_PUT_RATE, SSM_MIN_PUT_RATE, SSM_MAX_PUT_RATE)
+        with ThreadPoolExecutor(max_workers=SSM_WRITE_WORKERS) as executor:
+            put_errors = executor.map(lambda put: self._put_parameter(bucket, *put), puts)
+            for (key, _, overwrite), error in zip(puts, list(put_errors)):
+                report[key] = error or ('changed' if overwrite else 'added')
+        for start in range(0, len(removals), SSM_DELETE_PARAMETERS_LIMIT):
+            report.update(self._delete_parameters(bucket, removals[start:start + SSM_DELETE_PARAMETERS_LIMIT]))
+
+        failed = {key: outcome for key, outcome in report.items()
+                  if outcome not in ('added', 'changed', 'removed')}
+        for key, outcome in report.items():
+            if key in failed:
+                log_intent_err("%s: %s" % (key, outcome))
+            else:
+                log_intent("%s %s" % (key, outcome))
+        if failed:
+            raise UnrecoverableException("%d of %d parameter changes failed." % (len(failed), len(report)))
+        log_bold("Updated %d parameters." % len(report))
+        return report
+
+    def _put_parameter(self, bucket, key, value, overwrite):
+        for _ in range(SSM_MAX_PUT_ATTEMPTS):
+            bucket.acquire()
+            try:
+                self.client.put_parameter(
+                    Name='%s%s' % (self.path_prefix, key),
+                    Value=value,
+                    Type='SecureString',
+                    KeyId='alias/aws/ssm',
+                    Overwrite=overwrite
                 )
+            except ClientError as client_error:
+                if not _is_throttled(client_error):
+                    return client_error.response['Error']['Message']
+                bucket.throttled()
+                continue
+            bucket.succeeded()
+            return None
+        return "Throttled by SSM %d times, giving up." % SSM_MAX_PUT_ATTEMPTS
+
+    def _delete_parameters(self, bucket, keys):
+        names = ["%s%s" % (self.path_prefix, key) for key in keys]
+        for _ in range(SSM_MAX_PUT_ATTEMPTS):
+            bucket.acquire()
+            try:
+                response = self.client.delete_parameters(Names=names)
+            except ClientError as client_error:
+                if not _is_throttled(client_error):
+                    return {key: client_error.response['Error']['Message'] for key in keys}
+                bucket.throttled()
+                continue
+            bucket.succeeded()
+            invalid_names = set(response.get('InvalidParameters', []))
+            return {
+                key: "Parameter not found." if name in invalid_names else 'removed'
+                for key, name in zip(keys, names)
+            }
+        return {key: "Throttled by SSM %d times, giving up." % SSM_MAX_PUT_ATTEMPTS for key in keys}
 
     def _validate_changes(self, differences):
         errors = []
@@ -103,3 +279,7 @@ class ParameterStore(object):
     def _is_a_valid_parameter_key(self, key):
         return bool(re.match(r"^[\w|\.|\-|\/]+$", key))
 
+
+def _is_throttled(client_error):
+    # TooManyUpdates is raised for concurrent changes to the same parameter
+    return client_error.response['Error']['Code'] in THROTTLING_ERROR_CODES | {'TooManyUpdates'}
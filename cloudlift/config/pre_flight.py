@@ -1,44 +1,195 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from cloudlift.exceptions import UnrecoverableException
+from cloudlift.config.account import get_account_id, get_caller_identity
 from cloudlift.config.logging import log_err
 from cloudlift.config.stack import get_service_stack_name
-import re
+from cloudlift.profiling import instrument_client, tracer
+
+PREFLIGHT_CACHE_TTL_ENV = 'CLOUDLIFT_PREFLIGHT_CACHE_TTL'
+PREFLIGHT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cloudlift', 'preflight_cache.json')
+PREFLIGHT_MAX_WORKERS = 8
+
+
+class PreflightCache(object):
+    '''
+        Remembers the pre-flight checks which passed, so that repeated
+        configuration saves do not look the same resources up again.
+        Entries are kept for the life of the process and, when
+        CLOUDLIFT_PREFLIGHT_CACHE_TTL is set to a number of seconds, in
+        PREFLIGHT_CACHE_FILE for that long. Failed checks are never cached.
+        Entries are kept per AWS account, as the same names may refer to
+        other resources, or none, in another account.
+    '''
+
+    def __init__(self, cache_file=PREFLIGHT_CACHE_FILE):
+        self.cache_file = cache_file
+        self._passed = set()
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        try:
+            return max(int(os.environ.get(PREFLIGHT_CACHE_TTL_ENV, 0)), 0)
+        except ValueError:
+            return 0
+
+    def passed(self, *key):
+        key = self._key(key)
+        with self._lock:
+            if key in self._passed:
+                return True
+            if self.ttl and key in self._load_persisted():
+                self._passed.add(key)
+                return True
+        return False
+
+    def remember(self, *key):
+        key = self._key(key)
+        with self._lock:
+            self._passed.add(key)
+            if self.ttl:
+                entries = self._load_persisted()
+                entries[key] = time.time()
+                self._persist(entries)
+
+    def clear(self):
+        with self._lock:
+            self._passed.clear()
+
+    def _key(self, key):
+        return '|'.join((get_account_id(),) + key)
+
+    def _load_persisted(self):
+        try:
+            with open(self.cache_file) as cache_fp:
+                entries = json.load(cache_fp)
+        except (OSError, ValueError):
+            return {}
+        expires_before = time.time() - self.ttl
+        return {key: checked_at for key, checked_at in entries.items()
+                if isinstance(checked_at, (int, float)) and checked_at > expires_before}
+
+    def _persist(self, entries):
+        cache_dir = os.path.dirname(self.cache_file)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # written aside and renamed, so concurrent runs never read half a file
+            fd, temporary_path = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'w') as cache_fp:
+                json.dump(entries, cache_fp)
+            os.replace(temporary_path, self.cache_file)
+        except OSError:
+            pass
+
+
+preflight_cache = PreflightCache()
+
+
+def run_preflight_checks(checks, max_workers=PREFLIGHT_MAX_WORKERS):
+    '''
+        Run independent checks concurrently, given as a dict of name to a
+        callable without arguments, and return their results by name.
+        Every check runs to the end, so all the failures are reported
+        together in one UnrecoverableException.
+    '''
+    results = {}
+    failures = []
+    with tracer.span('pre-flight'):
+        with ThreadPoolExecutor(max_workers=max(min(max_workers, len(checks)), 1)) as executor:
+            futures = {
+                name: executor.submit(tracer.traced(name, check))
+                for name, check in checks.items()
+            }
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except UnrecoverableException as error:
+                failures.append((name, error.value))
+            except (ClientError, BotoCoreError) as error:
+                failures.append((name, str(error)))
+    if len(failures) == 1:
+        raise UnrecoverableException(failures[0][1])
+    if failures:
+        raise UnrecoverableException("{} pre-flight checks failed:\n{}".format(
+            len(failures),
+            '\n'.join("  - {}: {}".format(name, message) for name, message in failures)
+        ))
+    return results
+
+
+def check_aws_credentials():
+    '''
+        Verify that usable AWS credentials are configured. The caller identity
+        lookup is cached, so this costs one STS call per process at most.
+    '''
+    try:
+        get_caller_identity()
+        return True
+    except (ClientError, BotoCoreError):
+        log_err("Could not connect to AWS!")
+        raise UnrecoverableException("Ensure AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY & \
+AWS_DEFAULT_REGION env vars are set OR run 'aws configure'")
 
 def check_sns_topic_exists(topic_name, environment):
-    session = boto3.session.Session()
-    sns_client = session.client('sns')
+    '''
+        The topic is looked up in the region of its ARN, which need not be
+        the region of the default session.
+    '''
+    if preflight_cache.passed('sns-topic', topic_name):
+        return True
+    sns_client = instrument_client(boto3.session.Session(
+        region_name=_region_from_arn(topic_name)
+    ).client('sns'))
     try:
         sns_client.get_topic_attributes(TopicArn=topic_name)
-        return True
     except ClientError as e:
         if e.response['Error']['Code'] == 'NotFound':
             raise UnrecoverableException(
                 "Unable to find SNS topic {topic_name} in {environment} environment".format(**locals()))
         else:
             raise UnrecoverableException(e.response['Error']['Message'])
-        
+    preflight_cache.remember('sns-topic', topic_name)
+    return True
+
 def check_stack_exists(name, environment, cmd):
-    session = boto3.session.Session()
-    cloudformation_client = session.client('cloudformation')
+    stack_name = get_service_stack_name(environment, name)
+    if preflight_cache.passed('stack', environment, stack_name, cmd):
+        return True
+    # imported here as the region module needs the environment configuration,
+    # which imports this module
+    from cloudlift.config.region import get_client_for
+    cloudformation_client = get_client_for('cloudformation', environment)
     try:
-        stack_name = get_service_stack_name(environment, name)
         cloudformation_client.describe_stacks(StackName=stack_name)
         if cmd == 'create':
             raise UnrecoverableException(
                 "CloudFormation stack {name} in {environment} environment already exists.".format(**locals()))
-        elif cmd == 'update':
-            return True
     except ClientError as e:
-        if e.response['Error']['Code'] == 'ValidationError' and cmd == 'create':
-            return True
-        elif e.response['Error']['Code'] == 'ValidationError' and cmd == 'update':
+        if e.response['Error']['Code'] == 'ValidationError' and cmd == 'update':
             raise UnrecoverableException(
                 "CloudFormation stack {name} in {environment} environment does not exist.".format(**locals()))
-        else:
+        elif e.response['Error']['Code'] != 'ValidationError':
             raise UnrecoverableException(e.response['Error']['Message'])
+    if cmd == 'update':
+        # only existing stacks are remembered, a stack may be created any time
+        preflight_cache.remember('stack', environment, stack_name, cmd)
+    return True
 
-def check_aws_instance_type(instance_type):
+def check_aws_instance_type(instance_type, region=None):
+    '''
+        Returns (True, "") when every comma separated instance type is well
+        formed and, if a region is given, offered in that region. Otherwise
+        returns (False, <first bad instance type>).
+    '''
     pattern = r"^((a1|c1|c3|c4|c5|c5a|c5ad|c5d|c5n|c6a|c6g|c6gd|c6gn|c6i|c6id|c7g|cc2|d2|d3|d3en|dl1|f1|g2|g3|g3s|g4ad|g4dn|g5|g5g|h1|i2|i3|i3en|i4i|im4gn|inf1|is4gen|m1|m2|m3|m4|m5|m5a|m5ad|m5d|m5dn|m5n|m5zn|m6a|m6g|m6gd|m6i|m6id|mac1|mac2|p2|p3|p3dn|p4d|r3|r4|r5|r5a|r5ad|r5b|r5d|r5dn|r5n|r6a|r6g|r6gd|r6i|r6id|t1|t2|t3|t3a|t4g|trn1|u-12tb1|u-3tb1|u-6tb1|u-9tb1|vt1|x1|x1e|x2gd|x2idn|x2iedn|x2iezn|z1d)\.(10xlarge|112xlarge|12xlarge|16xlarge|18xlarge|24xlarge|2xlarge|32xlarge|3xlarge|48xlarge|4xlarge|56xlarge|6xlarge|8xlarge|9xlarge|large|medium|metal|micro|nano|small|xlarge))"
     instance_type = instance_type.split(",")
     for i in instance_type:
@@ -46,4 +197,34 @@ def check_aws_instance_type(instance_type):
             continue
         else:
             return False, i
-    return True, ""
\ No newline at end of file
+    if region:
+        unchecked = [i for i in instance_type if not preflight_cache.passed('instance-type', region, i)]
+        if unchecked:
+            offered = _instance_types_offered(unchecked, region)
+            for i in unchecked:
+                if i not in offered:
+                    return False, i
+                preflight_cache.remember('instance-type', region, i)
+    return True, ""
+
+
+def _instance_types_offered(instance_types, region):
+    ec2_client = instrument_client(boto3.session.Session(region_name=region).client('ec2'))
+    try:
+        paginator = ec2_client.get_paginator('describe_instance_type_offerings')
+        return {
+            offering['InstanceType']
+            for page in paginator.paginate(
+                LocationType='region',
+                Filters=[{'Name': 'instance-type', 'Values': instance_types}]
+            )
+            for offering in page['InstanceTypeOfferings']
+        }
+    except ClientError as e:
+        raise UnrecoverableException(e.response['Error']['Message'])
+
+
+def _region_from_arn(arn):
+    # arn:aws:sns:<region>:<account>:<name>
+    parts = arn.split(':')
+    return parts[3] if len(parts) > 3 and parts[3] else None
@@ -4,6 +4,7 @@ from cloudlift.exceptions import UnrecoverableException
 
 from cloudlift.config import EnvironmentConfiguration
 from cloudlift.config.logging import log_err
+from cloudlift.profiling import instrument_client
 
 def get_region_for_environment(environment):
     if environment:
@@ -16,9 +17,9 @@ def get_region_for_environment(environment):
 
 def get_client_for(resource, environment):
     try:
-        return boto3.session.Session(
+        return instrument_client(boto3.session.Session(
             region_name=get_region_for_environment(environment)
-        ).client(resource)
+        ).client(resource))
     except ClientError as error:
         if error.response['Error']['Code'] == 'ExpiredTokenException':
             raise UnrecoverableException("AWS session associated with this profile has expired or is otherwise invalid")
@@ -33,9 +34,11 @@ def get_client_for(resource, environment):
 
 def get_resource_for(resource, environment):
     try:
-        return boto3.session.Session(
+        boto_resource = boto3.session.Session(
             region_name=get_region_for_environment(environment)
         ).resource(resource)
+        instrument_client(boto_resource.meta.client)
+        return boto_resource
     except ClientError as error:
         if error.response['Error']['Code'] == 'ExpiredTokenException':
             raise UnrecoverableException(
@@ -3,26 +3,330 @@ This module abstracts implementation of storing, editing and
 retrieving service configuration.
 '''
 
+import copy
+from functools import lru_cache
+
 import dictdiffer
 from botocore.exceptions import ClientError
 from click import confirm, edit, prompt
 from cloudlift.exceptions import UnrecoverableException
-from jsonschema import validate
-from jsonschema.exceptions import ValidationError
 from stringcase import pascalcase
 
 from cloudlift.config import  print_json_changes, get_resource_for
 # import config.mfa as mfa
 from cloudlift.config.logging import log_bold, log_err, log_warning
 from cloudlift.version import VERSION
-from cloudlift.config.dynamodb_configuration import DynamodbConfiguration
+from cloudlift.config.dynamodb_configuration import (CONFIG_VERSION_ATTRIBUTE, DynamodbConfiguration,
+                                                      is_conflicting_write, versioned_update)
 from cloudlift.config.pre_flight import check_sns_topic_exists
 from cloudlift.config.environment_configuration import EnvironmentConfiguration
 from cloudlift.constants import FLUENTBIT_FIRELENS_SIDECAR_CONTAINER_NAME, logging_json_schema
-from cloudlift.config.utils import ConfigUtils
+from cloudlift.config.utils import (ConfigUtils, compile_validator, resolve_concurrent_changes,
+                                    validate_configuration)
 
 SERVICE_CONFIGURATION_TABLE = 'service_configurations'
 
+SERVICE_SCHEMA = {
+    "title": "service",
+    "type": "object",
+    "properties": {
+        "http_interface": {
+            "type": "object",
+            "properties": {
+                "internal": {
+                    "type": "boolean"
+                },
+                "restrict_access_to": {
+                    "type": "array",
+                    "items": {
+                        "type": "string"
+                    }
+                },
+                "container_port": {
+                    "type": "number"
+                },
+                "health_check_path": {
+                    "type": "string",
+                    "pattern": "^\/.*$"
+                }
+            },
+            "required": [
+                "internal",
+                "restrict_access_to",
+                "container_port"
+            ]
+        },
+        "custom_metrics": {
+            "type": "object",
+            "properties": {
+                "metrics_port" : {"type": "string"},
+                "metrics_path": {"type": "string"}
+            }
+        },
+        "volume": {
+            "type": "object",
+            "properties": {
+            "efs_id": {"type": "string"},
+            "efs_directory_path": {"type": "string"},
+            "container_path": {"type": "string"}
+            }
+        },
+        "memory_reservation": {
+            "type": "number",
+            "minimum": 10,
+            "maximum": 30000
+        },
+        "fargate": {
+            "type": "object",
+            "properties": {
+                "cpu": {
+                    "type": "number",
+                    "minimum": 256,
+                    "maximum": 4096
+                },
+                "memory": {
+                    "type": "number",
+                    "minimum": 512,
+                    "maximum": 30720
+                }
+            }
+        },
+        "command": {
+            "oneOf": [
+                {"type": "string"},
+                {"type": "null"}
+            ]
+        },
+        "spot_deployment": {
+            "type": "boolean"
+        },
+        "logging": logging_json_schema,
+        "deployment": {
+            "type": "object",
+            "properties": {
+                "minimum_healthy_percent": {
+                    "type": "integer",
+                    "minimum": 0,
+                    "maximum": 100
+                },
+                "maximum_percent": {
+                    "type": "integer",
+                    "minimum": 100
+                },
+                "circuit_breaker": {
+                    "type": "object",
+                    "properties": {
+                        "enable": {"type": "boolean"},
+                        "rollback": {"type": "boolean"}
+                    },
+                    "required": ["enable"]
+                },
+                "health_check_grace_period_seconds": {
+                    "type": "integer",
+                    "minimum": 0,
+                    "maximum": 2147483647
+                }
+            }
+        },
+        "autoscaling": {
+            "type": "object",
+            "properties": {
+                "min_capacity": {"type": "integer", "minimum": 0},
+                "max_capacity": {"type": "integer", "minimum": 1},
+                "target_tracking": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "metric": {
+                                "type": "string",
+                                "enum": ["cpu", "memory", "alb_request_count", "custom"]
+                            },
+                            "target": {"type": "number", "minimum": 0, "exclusiveMinimum": True},
+                            "scale_in_cooldown": {"type": "integer", "minimum": 0},
+                            "scale_out_cooldown": {"type": "integer", "minimum": 0},
+                            "custom_metric": {
+                                "type": "object",
+                                "properties": {
+                                    "namespace": {"type": "string"},
+                                    "metric_name": {"type": "string"},
+                                    "statistic": {
+                                        "type": "string",
+                                        "enum": ["Average", "Minimum", "Maximum", "SampleCount", "Sum"]
+                                    },
+                                    "dimensions": {
+                                        "type": "object",
+                                        "additionalProperties": {"type": "string"}
+                                    },
+                                    "unit": {"type": "string"}
+                                },
+                                "required": ["namespace", "metric_name", "statistic"]
+                            }
+                        },
+                        "required": ["metric", "target"]
+                    }
+                },
+                "sqs_step_scaling": {
+                    "type": "object",
+                    "properties": {
+                        "queue_name": {"type": "string"},
+                        "scale_out_steps": {
+                            "type": "array",
+                            "minItems": 1,
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "messages": {"type": "integer", "minimum": 0},
+                                    "adjustment": {"type": "integer", "minimum": 1}
+                                },
+                                "required": ["messages", "adjustment"]
+                            }
+                        },
+                        "scale_in": {
+                            "type": "object",
+                            "properties": {
+                                "below_messages": {"type": "integer", "minimum": 1},
+                                "adjustment": {"type": "integer", "maximum": -1}
+                            }
+                        },
+                        "cooldown": {"type": "integer", "minimum": 0}
+                    },
+                    "required": ["queue_name", "scale_out_steps"]
+                }
+            },
+            "required": ["min_capacity", "max_capacity"]
+        },
+        "placement": {
+            "type": "object",
+            "properties": {
+                "strategies": {
+                    "type": "array",
+                    "maxItems": 5,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "type": {
+                                "type": "string",
+                                "enum": ["spread", "binpack", "random"]
+                            },
+                            "field": {"type": "string"}
+                        },
+                        "required": ["type"]
+                    }
+                },
+                "constraints": {
+                    "type": "array",
+                    "maxItems": 10,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "type": {
+                                "type": "string",
+                                "enum": ["distinctInstance", "memberOf"]
+                            },
+                            "expression": {"type": "string"}
+                        },
+                        "required": ["type"]
+                    }
+                }
+            }
+        },
+        "rollout": {
+            "type": "object",
+            "properties": {
+                "priority": {"type": "integer"},
+                "after": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "uniqueItems": True
+                }
+            }
+        },
+        "depends_on": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {    
+                    "container_name": {"type": "string"},
+                    "condition": {"type": "string", "enum": ["START", "COMPLETE", "SUCCESS", "HEALTHY"]}
+                    }
+            }
+        },
+        "sidecars": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {
+                        "type": "string",
+                        # convention: sidecar name ends with -sidecar
+                        "pattern": ".*-sidecar$"
+                        },
+                    "image_uri": {"type": "string"},
+                    "command": {
+                        "oneOf": [
+                            {"type": "string"},
+                            {"type": "null"}
+                        ]
+                    },
+                    "logging": logging_json_schema,
+                    "memory_reservation": {
+                        "type": "number",
+                        "minimum": 10,
+                        "maximum": 30000
+                    },
+                    "env": {
+                        "type": "object"
+                    },
+                    "essential": {"type": "boolean"},
+                    "health_check": {
+                        "type": "object",
+                        "properties": {
+                            "command": {
+                                "type": "array",
+                                "items": {"type": "string"}
+                                },
+                            "interval": {"type": "number"},
+                            "timeout": {"type": "number"},
+                            "retries": {"type": "number"},
+                            "start_period": {"type": "number"}
+                        },
+                        "required": ["command"]
+                    }
+                },
+                "required": ["name", "image_uri", "memory_reservation", "essential"]
+            }
+        }
+    },
+    "required": ["memory_reservation", "command"]
+}
+SERVICE_CONFIGURATION_SCHEMA = {
+    # "$schema": "http://json-schema.org/draft-04/schema#",
+    "title": "configuration",
+    "type": "object",
+    "properties": {
+        "notifications_arn": {
+            "type": "string"
+        },
+        "services": {
+            "type": "object",
+            "patternProperties": {
+                "^[a-zA-Z]+$": SERVICE_SCHEMA
+            }
+        },
+        "cloudlift_version": {
+            "type": "string"
+        }
+    },
+    "required": ["cloudlift_version", "services", "notifications_arn"]
+}
+
+
+@lru_cache(maxsize=None)
+def _service_configuration_validator():
+    return compile_validator(SERVICE_CONFIGURATION_SCHEMA)
+
+
 class ServiceConfiguration(object):
     '''
         Handles configuration in DynamoDB for services
@@ -40,20 +344,26 @@ class ServiceConfiguration(object):
         # ssm_client = mfa_session.client('ssm')
         self.dynamodb_resource = get_resource_for('dynamodb',environment)
         self.table = DynamodbConfiguration(SERVICE_CONFIGURATION_TABLE, [
-            ('service_name', self.service_name), ('environment', self.environment)])._get_table()
+            ('service_name', self.service_name), ('environment', self.environment)]).ensure_table()
 
         self.masked_config_keys = {}
+        self.config_version = None
+        self.stored_cloudlift_version = None
+        self._base_configuration = None
         self.config_utils = ConfigUtils(changes_validation_function=self._validate_changes)
         self.environment_configuration = EnvironmentConfiguration(self.environment).get_config().get(self.environment, {})
 
-    def edit_config(self):
+    def edit_config(self, current_configuration=None):
         '''
-            Open editor to update configuration
+            Open editor to update configuration. current_configuration, when
+            given, is the result of get_config(VERSION, for_update=True)
+            made beforehand, and is not read again.
         '''
 
         try:
             from cloudlift.version import VERSION
-            current_configuration = self.get_config(VERSION)
+            if current_configuration is None:
+                current_configuration = self.get_config(VERSION, for_update=True)
 
             current_configuration, _ = self._mask_config_keys(current_configuration, ["depends_on", "sidecars"])
             updated_configuration = self.config_utils.fault_tolerant_edit_config(current_configuration=current_configuration, inject_version=True)
@@ -79,9 +389,11 @@ class ServiceConfiguration(object):
         except ClientError:
             raise UnrecoverableException("Unable to fetch service configuration from DynamoDB.")
 
-    def get_config(self, cloudlift_version):
+    def get_config(self, cloudlift_version, for_update=False):
         '''
-            Get configuration from DynamoDB
+            Get configuration from DynamoDB. Reads are eventually consistent
+            unless for_update is set, for a configuration which is going to
+            be changed and saved with set_config.
         '''
 
         try:
@@ -90,16 +402,19 @@ class ServiceConfiguration(object):
                     'service_name': self.service_name,
                     'environment': self.environment
                 },
-                ConsistentRead=True,
+                ConsistentRead=for_update,
                 AttributesToGet=[
-                    'configuration'
+                    'configuration',
+                    CONFIG_VERSION_ATTRIBUTE
                 ]
             )
             if 'Item' in configuration_response:
                 existing_configuration = configuration_response['Item']['configuration']
+                self.config_version = configuration_response['Item'].get(CONFIG_VERSION_ATTRIBUTE)
 
                 from distutils.version import LooseVersion
                 previous_cloudlift_version = existing_configuration.pop("cloudlift_version", None)
+                self.stored_cloudlift_version = previous_cloudlift_version
                 if LooseVersion(cloudlift_version) < LooseVersion(previous_cloudlift_version):
                     raise UnrecoverableException(f'Cloudlift Version {previous_cloudlift_version} was used to '
                                                  f'create this service. You are using version {cloudlift_version}, '
@@ -110,15 +425,22 @@ class ServiceConfiguration(object):
                                                  f'\tpip install -U cloudlift=={previous_cloudlift_version}')
             else:
                 existing_configuration = self._default_service_configuration()
+                self.config_version = None
+                self.stored_cloudlift_version = None
                 self.new_service = True
 
+            if for_update:
+                # kept to merge with changes saved by someone else meanwhile
+                self._base_configuration = copy.deepcopy(existing_configuration)
             return existing_configuration
         except ClientError:
             raise UnrecoverableException("Unable to fetch service configuration from DynamoDB.")
 
     def set_config(self, config):
         '''
-            Set configuration in DynamoDB
+            Set configuration in DynamoDB, if it has not changed since it
+            was read. Otherwise the changes are merged with the stored
+            configuration, with confirmation.
         '''
         config['cloudlift_version'] = VERSION
 
@@ -131,198 +453,133 @@ class ServiceConfiguration(object):
         self._validate_changes(config)
         check_sns_topic_exists(config['notifications_arn'], self.environment)
         try:
-            configuration_response = self.table.update_item(
-                TableName=SERVICE_CONFIGURATION_TABLE,
-                Key={
+            configuration_response = versioned_update(
+                self.table,
+                {
                     'service_name': self.service_name,
                     'environment': self.environment
                 },
-                UpdateExpression='SET configuration = :configuration',
-                ExpressionAttributeValues={
-                    ':configuration': config
-                },
-                ReturnValues="UPDATED_NEW"
+                config,
+                self.config_version
             )
-            return configuration_response
-        except ClientError:
-            raise UnrecoverableException("Unable to store service configuration in DynamoDB.")
+        except ClientError as client_error:
+            if not is_conflicting_write(client_error):
+                raise UnrecoverableException("Unable to store service configuration in DynamoDB.")
+            return self._set_config_over_concurrent_changes(config)
+        self.config_version = configuration_response['Attributes'][CONFIG_VERSION_ATTRIBUTE]
+        self.stored_cloudlift_version = VERSION
+        self._base_configuration = None
+        return configuration_response
+
+    def _set_config_over_concurrent_changes(self, config):
+        base_configuration = self._base_configuration
+        latest_configuration = self.get_config(VERSION, for_update=True)
+        updated_configuration = {
+            key: value for key, value in config.items() if key != 'cloudlift_version'
+        }
+        resolved_configuration = resolve_concurrent_changes(
+            base_configuration,
+            latest_configuration,
+            updated_configuration
+        )
+        if resolved_configuration is None:
+            return None
+        return self.set_config(resolved_configuration)
 
     def update_cloudlift_version(self):
         '''
-            Updates cloudlift version in service configuration
+            Updates cloudlift version in service configuration. Only the
+            version is written, on condition that the stored version is
+            still the one last read by get_config.
         '''
-        config = self.get_config(VERSION)
-        self.set_config(config)
-
-    def _validate_changes(self, configuration):
-        service_schema = {
-            "title": "service",
-            "type": "object",
-            "properties": {
-                "http_interface": {
-                    "type": "object",
-                    "properties": {
-                        "internal": {
-                            "type": "boolean"
-                        },
-                        "restrict_access_to": {
-                            "type": "array",
-                            "items": {
-                                "type": "string"
-                            }
-                        },
-                        "container_port": {
-                            "type": "number"
-                        },
-                        "health_check_path": {
-                            "type": "string",
-                            "pattern": "^\/.*$"
-                        }
-                    },
-                    "required": [
-                        "internal",
-                        "restrict_access_to",
-                        "container_port"
-                    ]
-                },
-                "custom_metrics": {
-                    "type": "object",
-                    "properties": {
-                        "metrics_port" : {"type": "string"},
-                        "metrics_path": {"type": "string"}
-                    }
-                },
-                "volume": {
-                    "type": "object",
-                    "properties": {
-                    "efs_id": {"type": "string"},
-                    "efs_directory_path": {"type": "string"},
-                    "container_path": {"type": "string"}
-                    }
-                },
-                "memory_reservation": {
-                    "type": "number",
-                    "minimum": 10,
-                    "maximum": 30000
-                },
-                "fargate": {
-                    "type": "object",
-                    "properties": {
-                        "cpu": {
-                            "type": "number",
-                            "minimum": 256,
-                            "maximum": 4096
-                        },
-                        "memory": {
-                            "type": "number",
-                            "minimum": 512,
-                            "maximum": 30720
-                        }
-                    }
-                },
-                "command": {
-                    "oneOf": [
-                        {"type": "string"},
-                        {"type": "null"}
-                    ]
-                },
-                "spot_deployment": {
-                    "type": "boolean"
-                },
-                "logging": logging_json_schema,
-                "depends_on": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {    
-                            "container_name": {"type": "string"},
-                            "condition": {"type": "string", "enum": ["START", "COMPLETE", "SUCCESS", "HEALTHY"]}
-                            }
-                    }
-                },
-                "sidecars": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "name": {
-                                "type": "string",
-                                # convention: sidecar name ends with -sidecar
-                                "pattern": ".*-sidecar$"
-                                },
-                            "image_uri": {"type": "string"},
-                            "command": {
-                                "oneOf": [
-                                    {"type": "string"},
-                                    {"type": "null"}
-                                ]
-                            },
-                            "logging": logging_json_schema,
-                            "memory_reservation": {
-                                "type": "number",
-                                "minimum": 10,
-                                "maximum": 30000
-                            },
-                            "env": {
-                                "type": "object"
-                            },
-                            "essential": {"type": "boolean"},
-                            "health_check": {
-                                "type": "object",
-                                "properties": {
-                                    "command": {
-                                        "type": "array",
-                                        "items": {"type": "string"}
-                                        },
-                                    "interval": {"type": "number"},
-                                    "timeout": {"type": "number"},
-                                    "retries": {"type": "number"},
-                                    "start_period": {"type": "number"}
-                                },
-                                "required": ["command"]
-                            }
-                        },
-                        "required": ["name", "image_uri", "memory_reservation", "essential"]
-                    }
-                }
-            },
-            "required": ["memory_reservation", "command"]
-        }
-        schema = {
-            # "$schema": "http://json-schema.org/draft-04/schema#",
-            "title": "configuration",
-            "type": "object",
-            "properties": {
-                "notifications_arn": {
-                    "type": "string"
-                },
-                "services": {
-                    "type": "object",
-                    "patternProperties": {
-                        "^[a-zA-Z]+$": service_schema
-                    }
-                },
-                "cloudlift_version": {
-                    "type": "string"
-                }
-            },
-            "required": ["cloudlift_version", "services", "notifications_arn"]
-        }
+        if self.stored_cloudlift_version == VERSION:
+            return
+        if self.stored_cloudlift_version is None:
+            condition_expression = 'attribute_not_exists(configuration.cloudlift_version)'
+            expression_attribute_values = {}
+        else:
+            condition_expression = 'configuration.cloudlift_version = :previous_version'
+            expression_attribute_values = {':previous_version': self.stored_cloudlift_version}
+        expression_attribute_values[':cloudlift_version'] = VERSION
         try:
-            for _, service_configuration in configuration.get('services').items():
-                for sidecar in service_configuration.get('sidecars', []):
-                    if sidecar.get('name') == FLUENTBIT_FIRELENS_SIDECAR_CONTAINER_NAME and sidecar.get('log_driver') == 'awsfirelens':
-                        raise UnrecoverableException("Set logging to 'awslogs' or 'null' for fluentbit firelens sidecar when using 'awsfirelens' for main container logging.")
-            validate(configuration, schema)
-        except ValidationError as validation_error:
-            log_err("Schema validation failed!")
-            if validation_error.relative_path:
-                raise UnrecoverableException(validation_error.message + " in " +
-                        str(".".join(list(validation_error.relative_path))))
-            else:
-                raise UnrecoverableException(validation_error.message)
+            self.table.update_item(
+                Key={
+                    'service_name': self.service_name,
+                    'environment': self.environment
+                },
+                UpdateExpression='SET configuration.cloudlift_version = :cloudlift_version',
+                ConditionExpression=condition_expression,
+                ExpressionAttributeValues=expression_attribute_values
+            )
+        except ClientError as client_error:
+            if not is_conflicting_write(client_error):
+                raise UnrecoverableException("Unable to store service configuration in DynamoDB.")
+            # another cloudlift stamped its version meanwhile; get_config
+            # refuses to go on if that version is newer than this one
+            self.get_config(VERSION, for_update=True)
+            return self.update_cloudlift_version()
+        self.stored_cloudlift_version = VERSION
+
+    def _validate_changes(self, configuration, collect_all_errors=False):
+        for _, service_configuration in (configuration.get('services') or {}).items():
+            for sidecar in service_configuration.get('sidecars', []):
+                if sidecar.get('name') == FLUENTBIT_FIRELENS_SIDECAR_CONTAINER_NAME and sidecar.get('log_driver') == 'awsfirelens':
+                    raise UnrecoverableException("Set logging to 'awslogs' or 'null' for fluentbit firelens sidecar when using 'awsfirelens' for main container logging.")
+        validate_configuration(
+            _service_configuration_validator(),
+            configuration,
+            collect_all_errors=collect_all_errors
+        )
+        # checks across keys, on a configuration the schema has accepted
+        for _, service_configuration in configuration['services'].items():
+            if 'health_check_grace_period_seconds' in service_configuration.get('deployment', {}) \
+                    and 'http_interface' not in service_configuration:
+                raise UnrecoverableException("deployment.health_check_grace_period_seconds needs an http_interface, "
+                                             "it delays the load balancer health checks of new tasks.")
+            self._validate_autoscaling(service_configuration)
+            self._validate_placement(service_configuration)
         log_bold("Schema valid!")
 
+    def _validate_autoscaling(self, service_configuration):
+        autoscaling = service_configuration.get('autoscaling')
+        if not autoscaling:
+            return
+        if autoscaling.get('min_capacity', 0) > autoscaling.get('max_capacity', 0):
+            raise UnrecoverableException("autoscaling.min_capacity is more than autoscaling.max_capacity.")
+        predefined_metrics = [policy['metric'] for policy in autoscaling.get('target_tracking', [])
+                              if policy['metric'] != 'custom']
+        if len(set(predefined_metrics)) != len(predefined_metrics):
+            raise UnrecoverableException("autoscaling.target_tracking repeats a metric other than custom.")
+        for policy in autoscaling.get('target_tracking', []):
+            if policy['metric'] == 'alb_request_count' and 'http_interface' not in service_configuration:
+                raise UnrecoverableException("autoscaling on alb_request_count needs an http_interface.")
+            if policy['metric'] == 'custom' and 'custom_metric' not in policy:
+                raise UnrecoverableException("autoscaling on a custom metric needs custom_metric.")
+        steps = [step.get('messages') for step in
+                 autoscaling.get('sqs_step_scaling', {}).get('scale_out_steps', [])]
+        if len(set(steps)) != len(steps):
+            raise UnrecoverableException("autoscaling.sqs_step_scaling.scale_out_steps repeat a number of messages.")
+
+    def _validate_placement(self, service_configuration):
+        placement = service_configuration.get('placement')
+        if not placement:
+            return
+        if 'fargate' in service_configuration:
+            raise UnrecoverableException("placement is not supported on fargate, Fargate places the tasks itself.")
+        for strategy in placement.get('strategies', []):
+            if strategy.get('type') == 'binpack' and strategy.get('field') not in ('memory', 'cpu'):
+                raise UnrecoverableException("placement.strategies: binpack needs a field of memory or cpu.")
+            if strategy.get('type') == 'spread' and not strategy.get('field'):
+                raise UnrecoverableException("placement.strategies: spread needs a field, "
+                                             "such as instanceId or attribute:ecs.availability-zone.")
+            if strategy.get('type') == 'random' and 'field' in strategy:
+                raise UnrecoverableException("placement.strategies: random takes no field.")
+        for constraint in placement.get('constraints', []):
+            if constraint.get('type') == 'memberOf' and not constraint.get('expression'):
+                raise UnrecoverableException("placement.constraints: memberOf needs an expression.")
+            if constraint.get('type') == 'distinctInstance' and 'expression' in constraint:
+                raise UnrecoverableException("placement.constraints: distinctInstance takes no expression.")
+
     def _default_service_configuration(self):
         return {
             u'notifications_arn': None,
@@ -5,8 +5,12 @@ utilities for handling malformed JSON configurations
 import json
 import os
 import tempfile
-import copy
+from decimal import Decimal
+
+import dictdiffer
+from dictdiffer.merge import Merger, UnresolvedConflictsException
 from click import confirm, edit, style
+from jsonschema import Draft4Validator
 
 from cloudlift.config import DecimalEncoder
 from cloudlift.version import VERSION
@@ -15,6 +19,81 @@ from cloudlift.config.logging import log_bold, log_err, log_warning
 from cloudlift.config import DecimalEncoder, print_json_changes
 
 
+class _ConfigurationValidator(Draft4Validator):
+    def is_type(self, instance, type):
+        # configurations read from DynamoDB hold their numbers as Decimal
+        if type == 'integer' and isinstance(instance, Decimal):
+            return instance == instance.to_integral_value()
+        return super(_ConfigurationValidator, self).is_type(instance, type)
+
+
+def compile_validator(schema):
+    '''
+        Check a schema once and build its validator. jsonschema.validate
+        checks the schema again on every call.
+    '''
+    _ConfigurationValidator.check_schema(schema)
+    return _ConfigurationValidator(schema)
+
+
+def validate_configuration(validator, configuration, collect_all_errors=False):
+    '''
+        Raise UnrecoverableException if the configuration does not match the
+        validator's schema. The message describes the first error found, or
+        every error when collect_all_errors is set.
+    '''
+    errors = validator.iter_errors(configuration)
+    if collect_all_errors:
+        errors = sorted(errors, key=lambda error: [str(key) for key in error.relative_path])
+    else:
+        first_error = next(errors, None)
+        errors = [first_error] if first_error else []
+    if not errors:
+        return
+    log_err("Schema validation failed!")
+    if len(errors) == 1:
+        raise UnrecoverableException(_describe_validation_error(errors[0]))
+    raise UnrecoverableException(
+        "%d schema errors:\n" % len(errors) +
+        "\n".join("  - " + _describe_validation_error(error) for error in errors)
+    )
+
+
+def resolve_concurrent_changes(base_configuration, latest_configuration, updated_configuration):
+    '''
+        Someone saved latest_configuration after base_configuration was read
+        and changed into updated_configuration. Show what they changed, merge
+        both sets of changes if they do not touch the same keys and ask which
+        configuration to save. Returns None if the save is aborted.
+    '''
+    log_warning("\nThe configuration was changed by someone else while you were editing it.")
+    if base_configuration is not None:
+        print_json_changes(list(dictdiffer.diff(base_configuration, latest_configuration)))
+        merger = Merger(base_configuration, latest_configuration, updated_configuration, {})
+        try:
+            merger.run()
+            merged_configuration = dictdiffer.patch(merger.unified_patches, base_configuration)
+            log_bold("Your changes can be applied on top of theirs.")
+            print_json_changes(list(dictdiffer.diff(latest_configuration, merged_configuration)))
+            if confirm('Do you want to save the merged config?'):
+                return merged_configuration
+            log_warning("Changes aborted.")
+            return None
+        except UnresolvedConflictsException:
+            log_err("Your changes conflict with theirs and cannot be merged.")
+    print_json_changes(list(dictdiffer.diff(latest_configuration, updated_configuration)))
+    if confirm('Do you want to overwrite their changes with yours?'):
+        return updated_configuration
+    log_warning("Changes aborted.")
+    return None
+
+
+def _describe_validation_error(validation_error):
+    error_path = ".".join(str(key) for key in validation_error.relative_path)
+    if error_path:
+        return validation_error.message + " in " + error_path
+    return validation_error.message
+
 
 class ConfigUtils:
     def __init__(self, current_configuration=None, changes_validation_function=None):
@@ -49,7 +128,7 @@ class ConfigUtils:
             try:
                 self._validate_schema(updated_configuration)
             except UnrecoverableException as error:
-                log_err(str(error))
+                log_err(error.value)
                 choice = confirm("The faulty configuration has been saved temporarily. Would you like to reopen it for editing?")
                 if choice:
                     return self._edit_temp_config(updated_configuration)
@@ -58,11 +137,14 @@ class ConfigUtils:
         return updated_configuration
 
     def _validate_schema(self, configuration):
-        config_to_validate = copy.deepcopy(configuration)
+        # validation does not modify the configuration, so the version only
+        # needs a shallow copy to stay out of the edited configuration
+        config_to_validate = configuration
         if self.inject_version:
-            config_to_validate['cloudlift_version'] = VERSION
-        self.changes_validation_function(config_to_validate)
-        
+            config_to_validate = dict(configuration, cloudlift_version=VERSION)
+        # every error is reported, so they can all be fixed in one edit
+        self.changes_validation_function(config_to_validate, collect_all_errors=True)
+
 
     def _get_temp_config_file_name(self):
         prefix = f"temp_config_{VERSION}_"
@@ -106,7 +188,7 @@ class ConfigUtils:
         try:
             self._validate_schema(updated_configuration)
         except UnrecoverableException as error:
-            log_err(str(error))
+            log_err(error.value)
             choice = confirm("The faulty configuration has been saved temporarily. Would you like to reopen it for editing?")
             if choice:
                 return self._edit_temp_config(updated_configuration)
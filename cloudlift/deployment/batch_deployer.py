@@ -0,0 +1,328 @@
+'''
+Deploy many services, possibly to several environments, in one run from
+a manifest file.
+'''
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import zip_longest
+
+import boto3
+from terminaltables import SingleTable
+
+from cloudlift.config import (get_cluster_name, get_region_for_environment,
+                              get_service_stack_name, highlight_production,
+                              highlight_user_account_details)
+from cloudlift.config.logging import log_bold, log_err, log_intent
+from cloudlift.config.pre_flight import PREFLIGHT_MAX_WORKERS, run_preflight_checks
+from cloudlift.config.utils import compile_validator, validate_configuration
+from cloudlift.deployment import deployer
+from cloudlift.deployment.ecr_client import EcrClient
+from cloudlift.deployment.service_updater import DEPLOYMENT_COLORS, get_ecs_service_names
+from cloudlift.exceptions import UnrecoverableException
+from cloudlift.profiling import instrument_client, tracer
+
+MANIFEST_SCHEMA = {
+    "title": "deploy_many manifest",
+    "type": "array",
+    "minItems": 1,
+    "items": {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string", "minLength": 1},
+            "environment": {"type": "string", "minLength": 1},
+            "version": {"type": "string", "minLength": 1},
+            "path": {"type": "string"},
+            "env_sample": {"type": "string"},
+            "build_args": {
+                "type": "object",
+                "additionalProperties": {"type": "string"}
+            }
+        },
+        "required": ["name", "environment", "version"],
+        "additionalProperties": False
+    }
+}
+
+DEFAULT_MAX_BUILDS = 2
+DEFAULT_MAX_ROLLOUTS = 8
+DEFAULT_MAX_ROLLOUTS_PER_CLUSTER = 4
+
+
+@lru_cache(maxsize=None)
+def _manifest_validator():
+    return compile_validator(MANIFEST_SCHEMA)
+
+
+def load_manifest(manifest_path):
+    '''
+        A JSON list of deployments, each with the service name, environment
+        and version. path is the checkout to build the image from when it
+        is not in ECR yet; without it the image must exist. env_sample
+        defaults to env.sample in path.
+    '''
+    try:
+        with open(manifest_path) as manifest_fp:
+            manifest = json.load(manifest_fp)
+    except ValueError as error:
+        raise UnrecoverableException("{} is not valid JSON: {}".format(manifest_path, error))
+    validate_configuration(_manifest_validator(), manifest, collect_all_errors=True)
+    duplicates = _duplicates((entry['name'], entry['environment']) for entry in manifest)
+    if duplicates:
+        raise UnrecoverableException("Services listed more than once: {}".format(
+            ', '.join('{} in {}'.format(name, environment) for name, environment in duplicates)))
+    return manifest
+
+
+class BatchDeployment(object):
+    '''
+        One entry of the manifest and how its deployment went.
+    '''
+
+    def __init__(self, entry):
+        self.name = entry['name']
+        self.environment = entry['environment']
+        self.version = entry['version']
+        self.path = entry.get('path')
+        self.env_sample_file = entry.get('env_sample') or os.path.join(self.path or '.', 'env.sample')
+        self.build_args = entry.get('build_args')
+        self.ecs_service_names = []
+        self.env_config = None
+        self.image_url = None
+        self.error = None
+        self.rollouts = OrderedDict()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def status(self):
+        if self.error:
+            return 'failed'
+        if any(result != 'deployed' for result in self.rollouts.values()):
+            return 'failed'
+        return 'deployed'
+
+    def fail(self, error):
+        self.error = error
+        self.finished_at = time.time()
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'environment': self.environment,
+            'version': self.version,
+            'status': self.status,
+            'error': self.error,
+            'ecs_services': dict(self.rollouts),
+            'duration': round(self.finished_at - self.started_at, 3)
+            if self.started_at and self.finished_at else None,
+        }
+
+
+class BatchDeployer(object):
+    '''
+        Deploys the services of a manifest in three stages. Pre-flight
+        resolves each environment once, then reads the service stacks and
+        SSM configs concurrently. Images are then built or verified, at
+        most max_builds at a time, and once per repository and version.
+        Last, the ECS services are rolled out, at most max_rollouts at a
+        time and max_rollouts_per_cluster in any one cluster. A failed
+        service does not stop the others; the result of every service is
+        reported at the end.
+    '''
+
+    def __init__(self, manifest_path, max_builds=DEFAULT_MAX_BUILDS,
+                 max_rollouts=DEFAULT_MAX_ROLLOUTS,
+                 max_rollouts_per_cluster=DEFAULT_MAX_ROLLOUTS_PER_CLUSTER,
+                 report_path=None):
+        self.deployments = [BatchDeployment(entry) for entry in load_manifest(manifest_path)]
+        self.max_builds = max_builds
+        self.max_rollouts = max_rollouts
+        self.max_rollouts_per_cluster = max_rollouts_per_cluster
+        self.report_path = report_path
+        self.environments = {}
+
+    def run(self):
+        environment_names = sorted({deployment.environment for deployment in self.deployments})
+        if 'production' in environment_names:
+            highlight_production()
+        highlight_user_account_details()
+
+        with tracer.span('environment resolution'):
+            self.environments = run_preflight_checks({
+                environment: lambda environment=environment: _resolve_environment(environment)
+                for environment in environment_names
+            })
+        for deployment in self.deployments:
+            deployment.started_at = time.time()
+
+        with tracer.span('service pre-flight'):
+            self._prepare(self._pending())
+        with tracer.span('image verification'):
+            self._ensure_images(self._pending())
+        log_bold("Initiating deployment of {} services\n".format(len(self._pending())))
+        with tracer.span('ECS rollouts'):
+            self._rollout()
+        for deployment in self.deployments:
+            deployment.finished_at = deployment.finished_at or time.time()
+
+        self._report()
+        failed = [deployment for deployment in self.deployments if deployment.status != 'deployed']
+        if failed:
+            raise UnrecoverableException("{} of {} deployments failed.".format(
+                len(failed), len(self.deployments)))
+
+    def _pending(self):
+        return [deployment for deployment in self.deployments if not deployment.error]
+
+    def _prepare(self, deployments):
+        if not deployments:
+            return
+
+        def prepare(deployment):
+            environment = self.environments[deployment.environment]
+            if not os.path.exists(deployment.env_sample_file):
+                deployment.fail('{} not found.'.format(deployment.env_sample_file))
+                return
+            try:
+                results = run_preflight_checks({
+                    'service stack': lambda: get_ecs_service_names(
+                        environment['cloudformation_client'],
+                        get_service_stack_name(deployment.environment, deployment.name)
+                    ),
+                    'SSM config fetch': lambda: deployer.build_config(
+                        deployment.environment, deployment.name, deployment.env_sample_file
+                    ),
+                })
+            except Exception as error:
+                deployment.fail(_error_message(error))
+                return
+            deployment.ecs_service_names = results['service stack']
+            deployment.env_config = results['SSM config fetch']
+
+        with ThreadPoolExecutor(max_workers=min(len(deployments), PREFLIGHT_MAX_WORKERS)) as executor:
+            list(executor.map(prepare, deployments))
+
+    def _ensure_images(self, deployments):
+        images = OrderedDict()
+        for deployment in deployments:
+            region = self.environments[deployment.environment]['region']
+            images.setdefault((deployment.name, region, deployment.version), []).append(deployment)
+
+        def ensure_image(image_deployments):
+            deployment = next((candidate for candidate in image_deployments if candidate.path),
+                              image_deployments[0])
+            region = self.environments[deployment.environment]['region']
+            try:
+                ecr_client = EcrClient(deployment.name, region, deployment.build_args,
+                                       working_dir=deployment.path or '.')
+                ecr_client.version = deployment.version
+                if deployment.path:
+                    ecr_client.build_and_upload_image()
+                else:
+                    ecr_client.verify_image()
+                image_url = ecr_client.ecr_image_uri + ':' + deployment.version
+            except Exception as error:
+                for image_deployment in image_deployments:
+                    image_deployment.fail(_error_message(error))
+                return
+            for image_deployment in image_deployments:
+                image_deployment.image_url = image_url
+
+        with ThreadPoolExecutor(max_workers=self.max_builds) as executor:
+            list(executor.map(ensure_image, images.values()))
+
+    def _rollout(self):
+        cluster_slots = {
+            environment['cluster_name']: threading.BoundedSemaphore(self.max_rollouts_per_cluster)
+            for environment in self.environments.values()
+        }
+        rollouts_by_cluster = OrderedDict()
+        for deployment in self.deployments:
+            if deployment.error:
+                continue
+            cluster_name = self.environments[deployment.environment]['cluster_name']
+            for ecs_service_name in deployment.ecs_service_names:
+                deployment.rollouts[ecs_service_name] = 'pending'
+                rollouts_by_cluster.setdefault(cluster_name, []).append((deployment, ecs_service_name))
+        # interleaved by cluster, so that waiting on a busy cluster holds
+        # up as few rollouts in other clusters as possible
+        rollouts = [
+            rollout for cluster_rollouts in zip_longest(*rollouts_by_cluster.values())
+            for rollout in cluster_rollouts if rollout is not None
+        ]
+
+        def rollout(index_and_rollout):
+            index, (deployment, ecs_service_name) = index_and_rollout
+            environment = self.environments[deployment.environment]
+            with cluster_slots[environment['cluster_name']]:
+                log_bold("Starting to deploy " + ecs_service_name)
+                try:
+                    deployed = deployer.deploy_new_version(
+                        environment['region'],
+                        environment['cluster_name'],
+                        ecs_service_name,
+                        deployment.version,
+                        deployment.name,
+                        deployment.env_sample_file,
+                        deployment.environment,
+                        DEPLOYMENT_COLORS[index % len(DEPLOYMENT_COLORS)],
+                        deployment.image_url,
+                        deployment.env_config
+                    )
+                    deployment.rollouts[ecs_service_name] = 'deployed' if deployed else 'failed'
+                except Exception as error:
+                    deployment.rollouts[ecs_service_name] = _error_message(error)
+            if 'pending' not in deployment.rollouts.values():
+                deployment.finished_at = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.max_rollouts) as executor:
+            list(executor.map(tracer.traced('service deployment', rollout), enumerate(rollouts)))
+
+    def _report(self):
+        table_data = [['Service', 'Environment', 'Version', 'Result', 'Details']]
+        for deployment in self.deployments:
+            details = deployment.error or ', '.join(
+                '{}: {}'.format(ecs_service_name, result)
+                for ecs_service_name, result in deployment.rollouts.items()
+            )
+            table_data.append([deployment.name, deployment.environment,
+                               deployment.version, deployment.status, details])
+        print(SingleTable(table_data, 'deploy_many').table)
+        if self.report_path:
+            with open(self.report_path, 'w') as report_fp:
+                json.dump([deployment.as_dict() for deployment in self.deployments],
+                          report_fp, indent=4)
+            log_intent("Report written to " + self.report_path)
+        for deployment in self.deployments:
+            if deployment.status != 'deployed':
+                log_err("{} in {} failed".format(deployment.name, deployment.environment))
+
+
+def _resolve_environment(environment):
+    region = get_region_for_environment(environment)
+    return {
+        'region': region,
+        'cluster_name': get_cluster_name(environment),
+        'cloudformation_client': instrument_client(
+            boto3.session.Session(region_name=region).client('cloudformation')),
+    }
+
+
+def _error_message(error):
+    return error.value if isinstance(error, UnrecoverableException) else str(error)
+
+
+def _duplicates(keys):
+    seen = set()
+    duplicates = []
+    for key in keys:
+        if key in seen and key not in duplicates:
+            duplicates.append(key)
+        seen.add(key)
+    return duplicates
@@ -0,0 +1,305 @@
+'''
+Free CPU and memory of the container instances of a cluster, what the
+tasks of a service reserve from them, and whether the tasks a rollout
+starts can be placed.
+'''
+
+import math
+import re
+from collections import OrderedDict
+
+from cloudlift.config.logging import log_intent, log_warning
+
+CAPACITY_CHECK_WARN = 'warn'
+CAPACITY_CHECK_SCALE = 'scale'
+CAPACITY_CHECK_OFF = 'off'
+CAPACITY_CHECKS = (CAPACITY_CHECK_WARN, CAPACITY_CHECK_SCALE, CAPACITY_CHECK_OFF)
+DESCRIBE_CONTAINER_INSTANCES_LIMIT = 100
+DESCRIBE_SERVICES_LIMIT = 10
+DEPLOYMENT_TYPE_ATTRIBUTE = 'deployment_type'
+ANY_DEPLOYMENT_TYPE = 'any'
+MAX_EXTRA_INSTANCES = 50
+DEPLOYMENT_TYPE_EXPRESSION = re.compile(
+    r'attribute:' + DEPLOYMENT_TYPE_ATTRIBUTE + r'\s*==\s*(\w+)')
+# the cluster template names its capacity providers <stack>-ondemand and <stack>-spot
+CAPACITY_PROVIDER_NAME = re.compile(r'-(ondemand|spot)$')
+AUTO_SCALING_GROUP_OUTPUTS = OrderedDict([
+    ('ondemand', 'AutoScalingGroupOnDemand'),
+    ('spot', 'AutoScalingGroupSpot'),
+])
+
+
+def get_container_instances(ecs_client, cluster_name):
+    '''
+        The ACTIVE container instances of the cluster, described in batches
+        of 100.
+    '''
+    container_instance_arns = [
+        container_instance_arn
+        for page in ecs_client.get_paginator('list_container_instances').paginate(
+            cluster=cluster_name, status='ACTIVE')
+        for container_instance_arn in page['containerInstanceArns']
+    ]
+    container_instances = []
+    for start in range(0, len(container_instance_arns), DESCRIBE_CONTAINER_INSTANCES_LIMIT):
+        container_instances.extend(ecs_client.describe_container_instances(
+            cluster=cluster_name,
+            containerInstances=container_instance_arns[start:start + DESCRIBE_CONTAINER_INSTANCES_LIMIT]
+        )['containerInstances'])
+    return container_instances
+
+
+def get_auto_scaling_groups(cloudformation_client, cluster_name):
+    '''
+        The auto scaling group of each deployment_type, from the outputs of
+        the cluster stack. Services of ANY_DEPLOYMENT_TYPE are given the
+        group of the cluster's default instance lifecycle.
+    '''
+    stack = cloudformation_client.describe_stacks(StackName=cluster_name)['Stacks'][0]
+    outputs = {output['OutputKey']: output['OutputValue'] for output in stack.get('Outputs', [])}
+    auto_scaling_groups = OrderedDict(
+        (pool, outputs[output_key])
+        for pool, output_key in AUTO_SCALING_GROUP_OUTPUTS.items()
+        if output_key in outputs
+    )
+    default_lifecycle = outputs.get('ECSClusterDefaultInstanceLifecycle', 'ondemand')
+    if default_lifecycle in auto_scaling_groups:
+        auto_scaling_groups[ANY_DEPLOYMENT_TYPE] = auto_scaling_groups[default_lifecycle]
+    return auto_scaling_groups
+
+
+def remaining_resources(container_instance):
+    '''
+        CPU units and MiB of memory not reserved by the tasks on the
+        container instance.
+    '''
+    return _resources(container_instance.get('remainingResources', []))
+
+
+def registered_resources(container_instance):
+    return _resources(container_instance.get('registeredResources', []))
+
+
+def task_resources(task_definition):
+    '''
+        CPU units and MiB of memory one task of the task definition reserves
+        on a container instance: the soft memory limit of each container,
+        or its hard limit when it has none.
+    '''
+    containers = task_definition['containerDefinitions']
+    return {
+        'CPU': sum(container.get('cpu', 0) for container in containers),
+        'MEMORY': sum(container.get('memoryReservation') or container.get('memory') or 0
+                      for container in containers),
+    }
+
+
+def deployment_type(container_instance):
+    '''
+        spot or ondemand, from the attribute the instances of the
+        environment's auto scaling groups register with.
+    '''
+    for attribute in container_instance.get('attributes', []):
+        if attribute['name'] == DEPLOYMENT_TYPE_ATTRIBUTE:
+            return attribute.get('value')
+    return None
+
+
+def service_deployment_type(service):
+    '''
+        The deployment_type the placement constraints of the service
+        restrict it to, or the capacity provider of the cluster's auto
+        scaling group it runs on, or ANY_DEPLOYMENT_TYPE.
+    '''
+    for constraint in service.get('placementConstraints', []):
+        match = DEPLOYMENT_TYPE_EXPRESSION.search(constraint.get('expression', ''))
+        if constraint.get('type') == 'memberOf' and match:
+            return match.group(1)
+    capacity_providers = [item['capacityProvider'] for item in service.get('capacityProviderStrategy', [])]
+    if len(capacity_providers) == 1:
+        match = CAPACITY_PROVIDER_NAME.search(capacity_providers[0])
+        if match:
+            return match.group(1)
+    return ANY_DEPLOYMENT_TYPE
+
+
+def surge_task_count(service):
+    '''
+        How many new tasks ECS starts before stopping old ones: up to
+        maximumPercent of the desired count run during the rollout.
+    '''
+    desired_count = service.get('desiredCount', 0)
+    maximum_percent = service.get('deploymentConfiguration', {}).get('maximumPercent', 200)
+    return max(int(math.floor(desired_count * maximum_percent / 100.0)) - desired_count, 0)
+
+
+def simulate_placement(free_resources, tasks):
+    '''
+        Places tasks, the resources of each, on instances with
+        free_resources, spreading them as the services' instanceId spread
+        strategy does: each on the instance with the most free memory it
+        fits on. Returns the tasks which did not fit anywhere.
+    '''
+    free_resources = [dict(resources) for resources in free_resources]
+    unplaced = []
+    for task in sorted(tasks, key=lambda task: task['MEMORY'], reverse=True):
+        candidates = [resources for resources in free_resources
+                      if all(resources[resource] >= task[resource] for resource in task)]
+        if not candidates:
+            unplaced.append(task)
+            continue
+        target = max(candidates, key=lambda resources: resources['MEMORY'])
+        for resource in task:
+            target[resource] -= task[resource]
+    return unplaced
+
+
+class CapacityPlan(object):
+    '''
+        The surge tasks of a rollout by deployment_type, with those which
+        do not fit on the container instances of that type, and how many
+        more instances like the largest one there would place them. That
+        number is None when there are no instances of the type to go by.
+    '''
+
+    def __init__(self):
+        self.tasks = OrderedDict()
+        self.unplaced = OrderedDict()
+        self.extra_instances = OrderedDict()
+        self.container_instances = OrderedDict()
+
+    @property
+    def fits(self):
+        return not any(self.unplaced.values())
+
+    def describe(self):
+        return '\n'.join(
+            "{} of {} new tasks on {} instances cannot be placed, {}".format(
+                len(self.unplaced[pool]), len(self.tasks[pool]), pool,
+                self._describe_extra_instances(pool))
+            for pool in self.tasks if self.unplaced[pool]
+        )
+
+    def _describe_extra_instances(self, pool):
+        if self.extra_instances[pool] is None:
+            return "there are none to tell how many more instances are needed"
+        if self.extra_instances[pool]:
+            return "{} more instances needed".format(self.extra_instances[pool])
+        return "and more instances would not place them"
+
+
+class CapacityPlanner(object):
+    '''
+        Checks that the cluster can place the new tasks a rollout of ECS
+        services starts while the old ones still run, with the placement
+        constraints on deployment_type the services are created with. When
+        it cannot, scale_out raises the desired capacity of the auto
+        scaling group of each deployment_type short of instances, given by
+        auto_scaling_groups as get_auto_scaling_groups returns them.
+    '''
+
+    def __init__(self, ecs_client, cluster_name, autoscaling_client=None, auto_scaling_groups=None):
+        self.ecs_client = ecs_client
+        self.cluster_name = cluster_name
+        self.autoscaling_client = autoscaling_client
+        self.auto_scaling_groups = auto_scaling_groups or {}
+
+    def plan(self, ecs_service_names):
+        tasks_by_pool = OrderedDict()
+        for service in self._describe_services(ecs_service_names):
+            if service.get('launchType') == 'FARGATE':
+                continue
+            surge = surge_task_count(service)
+            if not surge:
+                continue
+            task_definition = self.ecs_client.describe_task_definition(
+                taskDefinition=service['taskDefinition'])['taskDefinition']
+            tasks_by_pool.setdefault(service_deployment_type(service), []).extend(
+                [task_resources(task_definition)] * surge)
+
+        plan = CapacityPlan()
+        if not tasks_by_pool:
+            return plan
+        container_instances = get_container_instances(self.ecs_client, self.cluster_name)
+        for pool, tasks in tasks_by_pool.items():
+            pool_instances = [
+                container_instance for container_instance in container_instances
+                if pool == ANY_DEPLOYMENT_TYPE or deployment_type(container_instance) == pool
+            ]
+            plan.tasks[pool] = tasks
+            plan.container_instances[pool] = pool_instances
+            plan.unplaced[pool] = simulate_placement(
+                [remaining_resources(container_instance) for container_instance in pool_instances],
+                tasks)
+            plan.extra_instances[pool] = _extra_instances_needed(pool_instances, plan.unplaced[pool])
+        return plan
+
+    def scale_out(self, plan):
+        '''
+            Raises the desired capacity of the auto scaling group of each
+            deployment_type which is short of instances, up to its maximum
+            size. A group without instances to size new ones by is only
+            started with one, when it has none at all. Returns the new
+            desired capacity by group.
+        '''
+        scaled = OrderedDict()
+        for pool, extra_instances in plan.extra_instances.items():
+            if extra_instances == 0:
+                continue
+            group_name = self.auto_scaling_groups.get(pool)
+            if group_name is None:
+                log_warning("The cluster stack has no auto scaling group of {} instances".format(pool))
+                continue
+            group = self.autoscaling_client.describe_auto_scaling_groups(
+                AutoScalingGroupNames=[group_name])['AutoScalingGroups'][0]
+            if extra_instances is None:
+                if group['DesiredCapacity']:
+                    log_warning("{} has no {} instances in the cluster yet, cannot tell how many "
+                                "more are needed".format(group_name, pool))
+                    continue
+                extra_instances = 1
+            desired_capacity = min(group['DesiredCapacity'] + extra_instances, group['MaxSize'])
+            if desired_capacity <= group['DesiredCapacity']:
+                log_warning("{} is at its maximum size of {}".format(group_name, group['MaxSize']))
+                continue
+            log_intent("Scaling {} out from {} to {} instances".format(
+                group_name, group['DesiredCapacity'], desired_capacity))
+            self.autoscaling_client.set_desired_capacity(
+                AutoScalingGroupName=group_name,
+                DesiredCapacity=desired_capacity,
+                HonorCooldown=False
+            )
+            scaled[group_name] = desired_capacity
+        return scaled
+
+    def _describe_services(self, ecs_service_names):
+        services = []
+        for start in range(0, len(ecs_service_names), DESCRIBE_SERVICES_LIMIT):
+            services.extend(self.ecs_client.describe_services(
+                cluster=self.cluster_name,
+                services=ecs_service_names[start:start + DESCRIBE_SERVICES_LIMIT]
+            )['services'])
+        return services
+
+
+def _extra_instances_needed(container_instances, unplaced):
+    # new instances are taken to be like the largest one of the type
+    if not unplaced:
+        return 0
+    if not container_instances:
+        return None
+    largest = max((registered_resources(container_instance)
+                   for container_instance in container_instances),
+                  key=lambda resources: (resources['MEMORY'], resources['CPU']))
+    if simulate_placement([largest], unplaced[:1]):
+        # the largest of the tasks is larger than an empty instance
+        return 0
+    for extra_instances in range(1, MAX_EXTRA_INSTANCES + 1):
+        if not simulate_placement([largest] * extra_instances, unplaced):
+            return extra_instances
+    return MAX_EXTRA_INSTANCES
+
+
+def _resources(resources):
+    values = {resource['name']: resource.get('integerValue', 0) for resource in resources}
+    return {'CPU': values.get('CPU', 0), 'MEMORY': values.get('MEMORY', 0)}
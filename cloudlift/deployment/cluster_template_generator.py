@@ -7,7 +7,8 @@ from stringcase import camelcase, pascalcase
 from troposphere import (Base64, FindInMap, Output, Parameter, Ref, Sub,
                          cloudformation, Export, GetAtt, Tags)
 from troposphere.autoscaling import (AutoScalingGroup, LaunchTemplateSpecification, NotificationConfigurations,
-                                     ScalingPolicy, MixedInstancesPolicy, LaunchTemplateOverrides, InstancesDistribution )
+                                     ScalingPolicy, MixedInstancesPolicy, LaunchTemplateOverrides, InstancesDistribution,
+                                     InstanceReusePolicy, LifecycleHookSpecification, WarmPool)
 from troposphere.autoscaling import LaunchTemplate as ASGLaunchTemplate
 from troposphere.cloudwatch import Alarm, MetricDimension
 from troposphere.ec2 import (VPC, InternetGateway, NatGateway, Route,
@@ -15,9 +16,11 @@ from troposphere.ec2 import (VPC, InternetGateway, NatGateway, Route,
                              SubnetRouteTableAssociation, VPCGatewayAttachment,SecurityGroupIngress,
                              LaunchTemplateData, LaunchTemplate, IamInstanceProfile, LaunchTemplateBlockDeviceMapping,
                              EBSBlockDevice, MetadataOptions)
-from troposphere.ecs import Cluster
+from troposphere.ecs import (AutoScalingGroupProvider, CapacityProvider,
+                             CapacityProviderStrategy, Cluster,
+                             ClusterCapacityProviderAssociations, ManagedScaling)
 from troposphere.elasticache import SubnetGroup as ElastiCacheSubnetGroup
-from troposphere.iam import InstanceProfile, Role
+from troposphere.iam import InstanceProfile, Policy, Role
 from troposphere.logs import LogGroup
 from troposphere.policies import (AutoScalingRollingUpdate, CreationPolicy,
                                   ResourceSignal)
@@ -31,6 +34,10 @@ from cloudlift.version import VERSION
 from cloudlift.config.logging import log_warning
 
 
+WARM_POOL_LIFECYCLE_HOOK = 'InstanceInitialization'
+COMPLETE_LIFECYCLE_ACTION_SCRIPT = '/usr/local/bin/complete-lifecycle-action'
+
+
 class ClusterTemplateGenerator(TemplateGenerator):
     """
         This class generates CloudFormation template for a environment cluster
@@ -322,7 +329,8 @@ class ClusterTemplateGenerator(TemplateGenerator):
                 'arn:aws:iam::aws:policy/service-role/AmazonEC2RoleforSSM'
             ],
             RoleName=role_name,
-            AssumeRolePolicyDocument=assume_role_policy
+            AssumeRolePolicyDocument=assume_role_policy,
+            **self._warm_pool_role_policies()
         )
         self.template.add_resource(ecs_role)
         instance_profile = InstanceProfile(
@@ -335,13 +343,169 @@ class ClusterTemplateGenerator(TemplateGenerator):
         self.template.add_resource(instance_profile)
         return instance_profile
 
+    def _warm_pool_role_policies(self):
+        # instances complete their launch lifecycle action once initialized
+        if not self.uses_warm_pool:
+            return {}
+        return {'Policies': [Policy(
+            PolicyName='WarmPoolLifecycleActions',
+            PolicyDocument={
+                u'Statement': [
+                    {
+                        u'Action': [u'autoscaling:CompleteLifecycleAction'],
+                        u'Effect': u'Allow',
+                        u'Resource': Sub('arn:aws:autoscaling:${AWS::Region}:${AWS::AccountId}:autoScalingGroup:*:'
+                                         'autoScalingGroupName/${AWS::StackName}-AutoScalingGroupOnDemand-*')
+                    },
+                    {
+                        u'Action': [u'autoscaling:DescribeAutoScalingInstances'],
+                        u'Effect': u'Allow',
+                        u'Resource': u'*'
+                    }
+                ]
+            }
+        )]}
+
     def _add_cluster(self):
         cluster = Cluster('Cluster', ClusterName=Ref('AWS::StackName'))
         self.template.add_resource(cluster)
         self._add_ec2_auto_scaling()
+        if self.uses_capacity_providers:
+            self._add_capacity_providers(cluster)
         self._add_cluster_alarms(cluster)
         return cluster
 
+    @property
+    def uses_capacity_providers(self):
+        return 'capacity_providers' in self.configuration['cluster']
+
+    def _add_capacity_providers(self, cluster):
+        '''
+            An ECS capacity provider for each auto scaling group, which
+            scales the group to the tasks waiting for instances in place of
+            the memory reservation alarms, and keeps instances running tasks
+            from being scaled in. Services without a capacity provider
+            strategy of their own go to the default lifecycle's provider.
+        '''
+        settings = self.configuration['cluster']['capacity_providers']
+        capacity_providers = {}
+        for deployment_type, auto_scaling_group in self.auto_scaling_groups.items():
+            capacity_providers[deployment_type] = self.template.add_resource(CapacityProvider(
+                'CapacityProvider' + deployment_type,
+                Name=Sub('${AWS::StackName}-' + deployment_type.lower()),
+                AutoScalingGroupProvider=AutoScalingGroupProvider(
+                    AutoScalingGroupArn=Ref(auto_scaling_group),
+                    ManagedScaling=ManagedScaling(
+                        Status='ENABLED',
+                        TargetCapacity=settings.get('target_capacity', 100),
+                        MinimumScalingStepSize=settings.get('minimum_scaling_step_size', 1),
+                        MaximumScalingStepSize=settings.get('maximum_scaling_step_size', 10000),
+                        InstanceWarmupPeriod=settings.get('instance_warmup_period', 300)
+                    ),
+                    ManagedTerminationProtection='ENABLED' if self._managed_termination_protection else 'DISABLED'
+                ),
+                Tags=Tags(Team=self.team_name, environment=self.env)
+            ))
+        if not capacity_providers:
+            return
+        default_deployment_type = {'spot': 'Spot', 'ondemand': 'OnDemand'}.get(
+            self.configuration['cluster'].get('ecs_instance_default_lifecycle_type'))
+        if default_deployment_type not in capacity_providers:
+            default_deployment_type = next(iter(capacity_providers))
+        self.template.add_resource(ClusterCapacityProviderAssociations(
+            'ClusterCapacityProviderAssociations',
+            Cluster=Ref(cluster),
+            CapacityProviders=[Ref(capacity_provider) for capacity_provider in capacity_providers.values()],
+            DefaultCapacityProviderStrategy=[CapacityProviderStrategy(
+                CapacityProvider=Ref(capacity_providers[default_deployment_type]),
+                Weight=1
+            )]
+        ))
+
+    @property
+    def uses_warm_pool(self):
+        return 'warm_pool' in self.configuration['cluster']
+
+    def _add_warm_pool(self, auto_scaling_group):
+        '''
+            A pool of instances which ran their user data, stopped or
+            running, for the On-Demand group to scale out from in place of
+            launching and initializing new ones.
+        '''
+        settings = self.configuration['cluster']['warm_pool']
+        warm_pool_arguments = {}
+        if 'max_prepared_capacity' in settings:
+            warm_pool_arguments['MaxGroupPreparedCapacity'] = settings['max_prepared_capacity']
+        self.template.add_resource(WarmPool(
+            'WarmPoolOnDemand',
+            AutoScalingGroupName=Ref(auto_scaling_group),
+            MinSize=settings.get('min_size', 0),
+            PoolState=settings.get('pool_state', 'Stopped'),
+            InstanceReusePolicy=InstanceReusePolicy(
+                ReuseOnScaleIn=settings.get('reuse_on_scale_in', False)
+            ),
+            **warm_pool_arguments
+        ))
+
+    def _warm_pool_lifecycle_hooks(self):
+        # holds new instances until their user data completes the action,
+        # so instances are not stopped into the warm pool half initialized
+        return [LifecycleHookSpecification(
+            LifecycleHookName=WARM_POOL_LIFECYCLE_HOOK,
+            LifecycleTransition='autoscaling:EC2_INSTANCE_LAUNCHING',
+            HeartbeatTimeout=self.configuration['cluster']['warm_pool'].get('heartbeat_timeout', 600),
+            DefaultResult='CONTINUE'
+        )]
+
+    def _warm_pool_init_files(self):
+        '''
+            A script completing the launch lifecycle action of the instance,
+            after the user data on the first boot, and again when it leaves
+            the warm pool: on the boot out of a stopped pool, or once the
+            target lifecycle state of a running one is InService.
+        '''
+        return {
+            COMPLETE_LIFECYCLE_ACTION_SCRIPT: cloudformation.InitFile(
+                content=Sub('\n'.join([
+                    '#!/bin/bash',
+                    'metadata() {',
+                    '    TOKEN=$(curl -s -X PUT http://169.254.169.254/latest/api/token -H "X-aws-ec2-metadata-token-ttl-seconds: 60")',
+                    '    curl -s -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/$1',
+                    '}',
+                    'RESULT=CONTINUE',
+                    'if [ "$1" = "--in-service" ]; then',
+                    '    until [ "$(metadata autoscaling/target-lifecycle-state)" = "InService" ]; do sleep 5; done',
+                    'elif [ -n "$1" ]; then',
+                    '    RESULT=$1',
+                    'fi',
+                    'INSTANCE_ID=$(metadata instance-id)',
+                    'GROUP_NAME=$(aws autoscaling describe-auto-scaling-instances --region ${AWS::Region} '
+                    '--instance-ids $INSTANCE_ID --query "AutoScalingInstances[0].AutoScalingGroupName" --output text)',
+                    'aws autoscaling complete-lifecycle-action --region ${AWS::Region} '
+                    '--lifecycle-hook-name ' + WARM_POOL_LIFECYCLE_HOOK + ' --auto-scaling-group-name $GROUP_NAME '
+                    '--instance-id $INSTANCE_ID --lifecycle-action-result $RESULT',
+                    ''
+                ])),
+                mode='000755',
+                owner='root',
+                group='root'
+            ),
+            '/var/lib/cloud/scripts/per-boot/complete-lifecycle-action': cloudformation.InitFile(
+                content='\n'.join([
+                    '#!/bin/bash',
+                    'nohup ' + COMPLETE_LIFECYCLE_ACTION_SCRIPT + ' --in-service >/dev/null 2>&1 &',
+                    ''
+                ]),
+                mode='000755',
+                owner='root',
+                group='root'
+            ),
+        }
+
+    @property
+    def _managed_termination_protection(self):
+        return self.configuration['cluster']['capacity_providers'].get('managed_termination_protection', True)
+
     def _add_cluster_alarms(self, cluster):
         cluster_high_cpu_alarm = Alarm(
             'ClusterHighCPUAlarm',
@@ -448,22 +612,48 @@ class ClusterTemplateGenerator(TemplateGenerator):
         )
         self.template.add_resource(database_security_group)
         deployment_types = ['OnDemand', 'Spot']
+        self.auto_scaling_groups = {}
         for deployment_type in deployment_types:
+            # warm pools are not supported for spot instances
+            warm_pool = self.uses_warm_pool and deployment_type == 'OnDemand'
             lc_metadata_override = ''
             if deployment_type == 'Spot':
                 lc_metadata_override = '\n'.join([
                     'echo ECS_ENABLE_SPOT_INSTANCE_DRAINING=true >> /etc/ecs/ecs.config',
                 ])
-            user_data = Base64(Sub('\n'.join([
+            if warm_pool:
+                # instances register with the cluster only once out of the warm pool
+                lc_metadata_override = '\n'.join([
+                    'echo ECS_WARM_POOLS_CHECK=true >> /etc/ecs/ecs.config',
+                ])
+            cfn_init = "/opt/aws/bin/cfn-init -v --region ${AWS::Region} --stack ${AWS::StackName} --resource LaunchTemplate"+deployment_type
+            cfn_signal_arguments = " --region ${AWS::Region} --stack ${AWS::StackName} --resource AutoScalingGroup"+deployment_type
+            warm_pool_files = {}
+            if warm_pool:
+                bootstrap_lines = [
+                    cfn_init,
+                    "INIT_STATUS=$?",
+                    "/opt/aws/bin/cfn-signal -e $INIT_STATUS" + cfn_signal_arguments,
+                ]
+                lifecycle_lines = [
+                    "[ $INIT_STATUS -eq 0 ] && " + COMPLETE_LIFECYCLE_ACTION_SCRIPT + " CONTINUE || " + COMPLETE_LIFECYCLE_ACTION_SCRIPT + " ABANDON",
+                    "/var/lib/cloud/scripts/per-boot/complete-lifecycle-action",
+                ]
+                warm_pool_files = self._warm_pool_init_files()
+            else:
+                bootstrap_lines = [cfn_init, "/opt/aws/bin/cfn-signal -e $?" + cfn_signal_arguments]
+                lifecycle_lines = []
+            user_data_lines = [
                 "#!/bin/bash",
                 "yum update -y",
                 "yum install -y aws-cfn-bootstrap",
-                "/opt/aws/bin/cfn-init -v --region ${AWS::Region} --stack ${AWS::StackName} --resource LaunchTemplate"+deployment_type,
-                "/opt/aws/bin/cfn-signal -e $? --region ${AWS::Region} --stack ${AWS::StackName} --resource AutoScalingGroup"+deployment_type,
+                *bootstrap_lines,
                 "yum install -y https://s3.amazonaws.com/ec2-downloads-windows/SSMAgent/latest/linux_amd64/amazon-ssm-agent.rpm",
                 "systemctl enable amazon-ssm-agent",
                 "systemctl start amazon-ssm-agent",
-                ""])))
+                *lifecycle_lines,
+                ""]
+            user_data = Base64(Sub('\n'.join(user_data_lines)))
             lc_metadata = cloudformation.Init({
                 "config": cloudformation.InitConfig(
                     files=cloudformation.InitFiles({
@@ -509,7 +699,8 @@ class ClusterTemplateGenerator(TemplateGenerator):
                                 'bogus-priv',
                             ])
                         ),
-                    )
+                    ),
+                    **warm_pool_files
                 }),
                     services={
                         "sysvinit": cloudformation.InitServices({
@@ -594,7 +785,8 @@ class ClusterTemplateGenerator(TemplateGenerator):
                             VolumeType="gp3"
                         )
                     )
-                ]
+                ],
+                **({'InstanceType': self.configuration['cluster']['instance_type'].split(",")[0]} if warm_pool else {})
             )
             launch_template = LaunchTemplate(
                 "LaunchTemplate"+deployment_type,
@@ -619,6 +811,37 @@ class ClusterTemplateGenerator(TemplateGenerator):
                 spot_instance_pools = {
                     'SpotInstancePools' : self.configuration['cluster']['spot_instance_pools']
                 }
+            capacity_provider_asg = {}
+            if self.uses_capacity_providers and self._managed_termination_protection:
+                # managed termination protection needs new instances protected from scale in
+                capacity_provider_asg['NewInstancesProtectedFromScaleIn'] = True
+            if warm_pool:
+                # groups with a warm pool cannot have a mixed instances policy
+                launch_template_asg = {
+                    'LaunchTemplate': LaunchTemplateSpecification(
+                        LaunchTemplateId=Ref(launch_template),
+                        Version=GetAtt(launch_template, 'LatestVersionNumber')
+                    ),
+                    'LifecycleHookSpecificationList': self._warm_pool_lifecycle_hooks()
+                }
+            else:
+                launch_template_asg = {
+                    'MixedInstancesPolicy': MixedInstancesPolicy(
+                        LaunchTemplate=ASGLaunchTemplate(
+                            LaunchTemplateSpecification=LaunchTemplateSpecification(
+                                LaunchTemplateId=Ref(launch_template),
+                                Version=GetAtt(launch_template, 'LatestVersionNumber')
+                            ),
+                            Overrides=overrides_instances
+                        ),
+                        InstancesDistribution=InstancesDistribution(
+                            OnDemandBaseCapacity=0,
+                            OnDemandPercentageAboveBaseCapacity=0 if deployment_type == 'Spot' else 100,
+                            SpotAllocationStrategy="capacity-optimized" if deployment_type == 'OnDemand' else self.configuration['cluster']['allocation_strategy'],
+                            **spot_instance_pools 
+                        )
+                    )
+                }
             self.auto_scaling_group = AutoScalingGroup(
                 "AutoScalingGroup"+deployment_type,
                 UpdatePolicy=up,
@@ -647,24 +870,11 @@ class ClusterTemplateGenerator(TemplateGenerator):
                         TopicARN=Ref(self.notification_sns_arn)
                     )
                 ],
-                MixedInstancesPolicy=MixedInstancesPolicy(
-                    LaunchTemplate=ASGLaunchTemplate(
-                        LaunchTemplateSpecification=LaunchTemplateSpecification(
-                            LaunchTemplateId=Ref(launch_template),
-                            Version=GetAtt(launch_template, 'LatestVersionNumber')
-                        ),
-                        Overrides=overrides_instances
-                    ),
-                    InstancesDistribution=InstancesDistribution(
-                        OnDemandBaseCapacity=0,
-                        OnDemandPercentageAboveBaseCapacity=0 if deployment_type == 'Spot' else 100,
-                        SpotAllocationStrategy="capacity-optimized" if deployment_type == 'OnDemand' else self.configuration['cluster']['allocation_strategy'],
-                        **spot_instance_pools 
-                    )
-                ),
+                **launch_template_asg,
                 CreationPolicy=CreationPolicy(
                     ResourceSignal=ResourceSignal(Timeout='PT15M')
-                )
+                ),
+                **capacity_provider_asg
             )
             self.cluster_scaling_policy = ScalingPolicy(
                 'AutoScalingPolicy'+deployment_type,
@@ -718,8 +928,13 @@ class ClusterTemplateGenerator(TemplateGenerator):
                 self.template.add_resource(launch_template)
                 self.template.add_resource(self.auto_scaling_group)
                 self.template.add_resource(ec2_hosts_high_cpu_alarm)
-                self.template.add_resource(self.cluster_scaling_policy)
-                self.template.add_resource(self.cluster_high_memory_reservation_autoscale_alarm)
+                self.auto_scaling_groups[deployment_type] = self.auto_scaling_group
+                if warm_pool:
+                    self._add_warm_pool(self.auto_scaling_group)
+                if not self.uses_capacity_providers:
+                    # with capacity providers, ECS managed scaling sizes the group
+                    self.template.add_resource(self.cluster_scaling_policy)
+                    self.template.add_resource(self.cluster_high_memory_reservation_autoscale_alarm)
 
     def _add_cluster_parameters(self):
         self.template.add_parameter(Parameter(
@@ -821,6 +1036,19 @@ class ClusterTemplateGenerator(TemplateGenerator):
                 Description="On-Demand AutoScaling group for ECS container instances",
                 Value=Ref('AutoScalingGroupOnDemand'))
             )
+        if self.uses_capacity_providers:
+            if self.configuration['cluster']['spot_min_instances'] > 0:
+                self.template.add_output(Output(
+                    "CapacityProviderSpot",
+                    Description="Capacity provider of the Spot AutoScaling group",
+                    Value=Ref('CapacityProviderSpot'))
+                )
+            if self.configuration['cluster']['min_instances'] > 0:
+                self.template.add_output(Output(
+                    "CapacityProviderOnDemand",
+                    Description="Capacity provider of the On-Demand AutoScaling group",
+                    Value=Ref('CapacityProviderOnDemand'))
+                )
         self.template.add_output(Output(
             "SecurityGroupAlb",
             Description="Security group ID for ALB",
@@ -4,15 +4,50 @@ from colorclass import Color
 from terminaltables import SingleTable
 
 from cloudlift.config import ParameterStore
-from cloudlift.config.logging import log_bold, log_err, log_intent, log_with_color
+from cloudlift.config.logging import log_bold, log_err, log_intent, log_warning, log_with_color
 from cloudlift.deployment.ecs import DeployAction, EcsClient
+from cloudlift.deployment.rollout_monitor import (DEFAULT_MAX_FAILED_STARTS,
+                                                  DEFAULT_ROLLOUT_DEADLINE, RolloutFailed,
+                                                  RolloutMonitor)
 from cloudlift.exceptions import UnrecoverableException
+from cloudlift.profiling import api_call_recorder, tracer
 
 
 def deploy_new_version(region, cluster_name, ecs_service_name,
                        deploy_version_tag, service_name, sample_env_file_path,
-                       env_name, color='white', complete_image_uri=None):
-    env_config = build_config(env_name, service_name, sample_env_file_path)
+                       env_name, color='white', complete_image_uri=None,
+                       env_config=None, deadline=DEFAULT_ROLLOUT_DEADLINE,
+                       max_failed_starts=DEFAULT_MAX_FAILED_STARTS, rollback=False):
+    '''
+        env_config is the result of build_config, when it has been fetched
+        already, e.g. once for all the ECS services of a deployment. Without
+        deploy_version_tag and complete_image_uri the images are kept. The
+        rollout fails after deadline seconds, or once max_failed_starts
+        new tasks in a row stopped without running. With rollback, the
+        previous task definition stays registered until the rollout
+        succeeded, and the service is put back on it when it failed.
+    '''
+    try:
+        return _deploy_new_version(region, cluster_name, ecs_service_name,
+                                   deploy_version_tag, service_name,
+                                   sample_env_file_path, env_name, color,
+                                   complete_image_uri, env_config,
+                                   deadline, max_failed_starts, rollback)
+    finally:
+        # deployments run in their own process, which exits without
+        # running atexit handlers
+        api_call_recorder.spool()
+
+
+def _deploy_new_version(region, cluster_name, ecs_service_name,
+                        deploy_version_tag, service_name, sample_env_file_path,
+                        env_name, color, complete_image_uri, env_config=None,
+                        deadline=DEFAULT_ROLLOUT_DEADLINE,
+                        max_failed_starts=DEFAULT_MAX_FAILED_STARTS,
+                        rollback=False):
+    if env_config is None:
+        with tracer.span('SSM config fetch'):
+            env_config = build_config(env_name, service_name, sample_env_file_path)
     client = EcsClient(None, None, region)
     deployment = DeployAction(client, cluster_name, ecs_service_name)
     if deployment.service.desired_count == 0:
@@ -29,24 +64,65 @@ def deploy_new_version(region, cluster_name, ecs_service_name,
             deploy_version_tag,
             **{container_name: complete_image_uri}
         )
-    else:
+    elif deploy_version_tag is not None:
         task_definition.set_images(deploy_version_tag)
     for container in task_definition.containers:
         task_definition.apply_container_environment(container, env_config)
     print_task_diff(ecs_service_name, task_definition.diff, color)
-    new_task_definition = deployment.update_task_definition(task_definition)
-    response = deploy_and_wait(deployment, new_task_definition, color)
+    with tracer.span('task definition register'):
+        new_task_definition = deployment.update_task_definition(
+            task_definition, deregister_previous=not rollback)
+    with tracer.span('ECS rollout', service=ecs_service_name):
+        response = deploy_and_wait(deployment, new_task_definition, color,
+                                   deadline, max_failed_starts)
     if response:
+        if rollback:
+            deployment.deregister_task_definition(task_definition)
         log_bold(ecs_service_name + " Deployed successfully.")
     else:
         log_err(ecs_service_name + " Deployment failed.")
+        if rollback:
+            with tracer.span('ECS rollback', service=ecs_service_name):
+                roll_back(deployment, task_definition, new_task_definition, color,
+                          deadline, max_failed_starts)
     return response
 
 
-def deploy_and_wait(deployment, new_task_definition, color):
+def roll_back(deployment, previous_task_definition, failed_task_definition, color,
+              deadline=DEFAULT_ROLLOUT_DEADLINE,
+              max_failed_starts=DEFAULT_MAX_FAILED_STARTS):
+    '''
+        Puts the service back on the task definition it ran before the
+        failed rollout and waits for it to settle. The failed revision is
+        deregistered once it did; when the rollback fails too, both stay
+        registered for a manual fix.
+    '''
+    log_warning("{} Rolling back to {}".format(
+        deployment.service_name, previous_task_definition.family_revision))
+    if deploy_and_wait(deployment, previous_task_definition, color,
+                       deadline, max_failed_starts):
+        deployment.deregister_task_definition(failed_task_definition)
+        log_bold(deployment.service_name + " Rolled back to " +
+                 previous_task_definition.family_revision)
+        return True
+    log_err(deployment.service_name + " Rollback failed.")
+    return False
+
+
+def deploy_and_wait(deployment, new_task_definition, color,
+                    deadline=DEFAULT_ROLLOUT_DEADLINE,
+                    max_failed_starts=DEFAULT_MAX_FAILED_STARTS):
     existing_events = fetch_events(deployment.get_service())
     deployment.deploy(new_task_definition)
-    return wait_for_finish(deployment, existing_events, color)
+    monitor = RolloutMonitor(
+        deployment.client,
+        deployment.cluster_name,
+        deployment.service_name,
+        new_task_definition.arn,
+        deadline=deadline,
+        max_failed_starts=max_failed_starts
+    )
+    return wait_for_finish(deployment, existing_events, color, monitor)
 
 
 def build_config(env_name, service_name, sample_env_file_path):
@@ -93,7 +169,7 @@ def make_container_defn_env_conf(service_config, environment_configs_path):
     return container_defn_env_config_path
 
 
-def wait_for_finish(action, existing_events, color):
+def wait_for_finish(action, existing_events, color, monitor=None):
     waiting = True
     while waiting:
         sleep(1)
@@ -104,6 +180,15 @@ def wait_for_finish(action, existing_events, color):
             color
         )
         waiting = not action.is_deployed(service) and not service.errors
+        if monitor is not None:
+            try:
+                if waiting:
+                    monitor.check(service)
+                elif not service.errors:
+                    monitor.check_finished(service)
+            except RolloutFailed as rollout_failure:
+                log_err(str(rollout_failure))
+                return False
     if service.errors:
         log_err(str(service.errors))
         return False
@@ -127,8 +212,8 @@ def fetch_and_print_new_events(service, existing_events, color):
 
 
 def print_task_diff(ecs_service_name, diffs, color):
-    image_diff = next(x for x in diffs if x.field == 'image')
-    if image_diff.old_value != image_diff.value:
+    image_diff = next((x for x in diffs if x.field == 'image'), None)
+    if image_diff is not None and image_diff.old_value != image_diff.value:
         log_with_color(ecs_service_name + " New image getting deployed", color)
         log_with_color(ecs_service_name + " " + str(image_diff), color)
     else:
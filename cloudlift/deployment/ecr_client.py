@@ -8,6 +8,7 @@ from stringcase import spinalcase
 
 from cloudlift.config import get_account_id
 from cloudlift.config.logging import log_intent, log_warning, log_bold, log_err
+from cloudlift.profiling import instrument_client, tracer
 
 
 def get_container_tool() -> str:
@@ -28,23 +29,36 @@ class EcrClient:
         self.build_args = build_args
         self.working_dir = working_dir
         self.region = region
-        self.ecr_client = boto3.session.Session(region_name=self.region).client('ecr')
-        self.container_tool = get_container_tool()
+        self.ecr_client = instrument_client(
+            boto3.session.Session(region_name=self.region).client('ecr'))
+        self._container_tool = None
+        self.repository_ensured = False
 
     def build_and_upload_image(self):
-        self._ensure_repository()
+        self.ensure_repository()
         self._ensure_image_in_ecr()
 
+    def verify_image(self):
+        '''
+            Raise unless the image of self.version is in ECR, without
+            building it.
+        '''
+        if not self._find_image_in_ecr(self.version):
+            raise UnrecoverableException(
+                "Image {}:{} not found in ECR.".format(self.repo_name, self.version))
+
     def upload_image(self, version, additional_tags):
         image_name = spinalcase(self.name) + ':' + version
         ecr_image_name = self.ecr_image_uri + ':' + version
-        self._ensure_repository()
+        self.ensure_repository()
         self._push_image(image_name, ecr_image_name)
 
         for new_tag in additional_tags:
             self._add_image_tag(version, new_tag)
 
-    def _ensure_repository(self):
+    def ensure_repository(self):
+        if self.repository_ensured:
+            return
         try:
             self.ecr_client.create_repository(
                 repositoryName=self.repo_name,
@@ -58,6 +72,7 @@ class EcrClient:
                 log_intent('Repo exists with name: ' + self.repo_name)
             else:
                 raise ex
+        self.repository_ensured = True
 
     def _ensure_image_in_ecr(self):
         if self.version == 'dirty':
@@ -113,7 +128,8 @@ class EcrClient:
     def _build_image(self, image_name):
         log_bold("Building container image " + image_name)
         command = self._build_command(image_name)
-        subprocess.check_call(command, shell=True)
+        with tracer.span('image build'):
+            subprocess.check_call(command, shell=True)
         log_bold("Built " + image_name)
 
     def _build_command(self, image_name):
@@ -154,9 +170,10 @@ branch or commit SHA")
             subprocess.check_call([self.container_tool, "tag", local_name, ecr_name])
         except:
             raise UnrecoverableException("Local image was not found.")
-        self._login_to_ecr()
-        subprocess.check_call([self.container_tool, "push", ecr_name])
-        subprocess.check_call([self.container_tool, "rmi", ecr_name])
+        with tracer.span('image push'):
+            self._login_to_ecr()
+            subprocess.check_call([self.container_tool, "push", ecr_name])
+            subprocess.check_call([self.container_tool, "rmi", ecr_name])
         log_intent('Pushed the image (' + local_name + ') to ECR sucessfully.')
 
     def _add_image_tag(self, existing_tag, new_tag):
@@ -176,10 +193,11 @@ branch or commit SHA")
 
     def _find_image_in_ecr(self, tag):
         try:
-            return self.ecr_client.batch_get_image(
-                repositoryName=self.repo_name,
-                imageIds=[{'imageTag': tag}]
-            )['images'][0]
+            with tracer.span('ECR image lookup', tag=tag):
+                return self.ecr_client.batch_get_image(
+                    repositoryName=self.repo_name,
+                    imageIds=[{'imageTag': tag}]
+                )['images'][0]
         except:
             return None
 
@@ -196,5 +214,12 @@ branch or commit SHA")
     def account_id(self):
         return get_account_id()
     @property
+    def container_tool(self):
+        # looked up when first needed, images found in ECR need none
+        if self._container_tool is None:
+            self._container_tool = get_container_tool()
+        return self._container_tool
+
+    @property
     def container_tool_name(self):
         return self.container_tool.split('/')[-1] if self.container_tool is not None else None
@@ -19,6 +19,8 @@ import boto3
 from botocore.exceptions import ClientError, NoCredentialsError
 from dateutil.tz.tz import tzlocal
 
+from cloudlift.profiling import instrument_client
+
 
 class EcsClient(object):
     def __init__(self, access_key_id=None, secret_access_key=None,
@@ -27,7 +29,7 @@ class EcsClient(object):
                           aws_secret_access_key=secret_access_key,
                           region_name=region,
                           profile_name=profile)
-        self.boto = session.client(u'ecs')
+        self.boto = instrument_client(session.client(u'ecs'))
 
     def describe_services(self, cluster_name, service_name):
         return self.boto.describe_services(
@@ -51,6 +53,18 @@ class EcsClient(object):
             serviceName=service_name
         )
 
+    def list_stopped_tasks(self, cluster_name, service_name):
+        paginator = self.boto.get_paginator(u'list_tasks')
+        return [
+            task_arn
+            for page in paginator.paginate(
+                cluster=cluster_name,
+                serviceName=service_name,
+                desiredStatus=u'STOPPED'
+            )
+            for task_arn in page[u'taskArns']
+        ]
+
     def list_task_definitions(self, family_prefix, status='ACTIVE', sort='DESC'):
         response = self.boto.list_task_definitions(familyPrefix=family_prefix, status=status, sort=sort)
         return response['taskDefinitionArns']
@@ -83,11 +97,18 @@ class EcsClient(object):
         )
 
     def update_service(self, cluster, service, desired_count, task_definition):
+        '''
+            desired_count None keeps the desired count of the service, which
+            application autoscaling may be changing.
+        '''
+        desired_count_argument = {}
+        if desired_count is not None:
+            desired_count_argument['desiredCount'] = desired_count
         return self.boto.update_service(
             cluster=cluster,
             service=service,
-            desiredCount=desired_count,
-            taskDefinition=task_definition
+            taskDefinition=task_definition,
+            **desired_count_argument
         )
 
     def run_task(self, cluster, task_definition, count, started_by, overrides):
@@ -103,9 +124,12 @@ class EcsClient(object):
 class EcsService(dict):
     def __init__(self, cluster, service_definition=None, **kwargs):
         self._cluster = cluster
+        self.desired_count_changed = False
         super(EcsService, self).__init__(service_definition, **kwargs)
 
     def set_desired_count(self, desired_count):
+        if desired_count != self.get(u'desiredCount'):
+            self.desired_count_changed = True
         self[u'desiredCount'] = desired_count
 
     def set_task_definition(self, task_definition):
@@ -423,7 +447,12 @@ class EcsAction(object):
         )
         return task_definition
 
-    def update_task_definition(self, task_definition):
+    def update_task_definition(self, task_definition, deregister_previous=True):
+        '''
+            Registers a new revision of the task definition. The revision it
+            was read from is deregistered unless deregister_previous is
+            False, e.g. to keep it to roll back to.
+        '''
         fargate_td = {}
         if task_definition.requires_compatibilities and 'FARGATE' in task_definition.requires_compatibilities:
             fargate_td = {
@@ -442,14 +471,18 @@ class EcsAction(object):
             **fargate_td
         )
         new_task_definition = EcsTaskDefinition(response[u'taskDefinition'])
-        self._client.deregister_task_definition(task_definition.arn)
+        if deregister_previous:
+            self.deregister_task_definition(task_definition)
         return new_task_definition
 
+    def deregister_task_definition(self, task_definition):
+        self._client.deregister_task_definition(task_definition.arn)
+
     def update_service(self, service):
         response = self._client.update_service(
             cluster=service.cluster,
             service=service.name,
-            desired_count=service.desired_count,
+            desired_count=service.desired_count if service.desired_count_changed else None,
             task_definition=service.task_definition
         )
         return EcsService(self._cluster_name, response[u'service'])
@@ -7,7 +7,7 @@ from cloudlift.deployment.deployer import read_config
 from cloudlift.config.logging import log_warning
 
 
-def edit_config(name, environment):
+def edit_config(name, environment, dry_run=False):
     parameter_store = ParameterStore(name, environment)
     env_config_strings = parameter_store.get_existing_config_as_string()
     edited_config_content = click.edit(str(env_config_strings))
@@ -24,7 +24,9 @@ def edit_config(name, environment):
         log_warning("No changes made, exiting.")
     else:
         print_parameter_changes(differences)
-        if click.confirm('Do you want update the config?'):
+        if dry_run:
+            parameter_store.set_config(differences, dry_run=True)
+        elif click.confirm('Do you want update the config?'):
             parameter_store.set_config(differences)
         else:
             log_warning("Changes aborted.")
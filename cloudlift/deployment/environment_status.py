@@ -0,0 +1,142 @@
+'''
+Snapshot of the version and health of every service in an environment.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from terminaltables import SingleTable
+
+from cloudlift.config import get_client_for, get_cluster_name
+from cloudlift.config.logging import log_bold, log_warning
+from cloudlift.profiling import tracer
+
+DESCRIBE_SERVICES_LIMIT = 10
+STATUS_MAX_WORKERS = 16
+
+
+class EnvironmentStatusFetcher(object):
+    '''
+        Lists the ECS services of the environment's cluster, describes them
+        in batches of 10 and the task definitions they run once per ARN,
+        both concurrently.
+    '''
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.cluster_name = get_cluster_name(environment)
+        self.ecs_client = get_client_for('ecs', environment)
+
+    def get_status(self):
+        '''
+            One dict per ECS service, sorted by name, with the image tag,
+            the task counts and the deployment in progress or last made.
+        '''
+        with tracer.span('list services'):
+            service_arns = [
+                service_arn
+                for page in self.ecs_client.get_paginator('list_services').paginate(
+                    cluster=self.cluster_name, PaginationConfig={'PageSize': 100})
+                for service_arn in page['serviceArns']
+            ]
+        if not service_arns:
+            return []
+        batches = [service_arns[start:start + DESCRIBE_SERVICES_LIMIT]
+                   for start in range(0, len(service_arns), DESCRIBE_SERVICES_LIMIT)]
+        with ThreadPoolExecutor(max_workers=STATUS_MAX_WORKERS) as executor:
+            with tracer.span('describe services'):
+                services = [
+                    service
+                    for described in executor.map(
+                        tracer.traced('describe services', self._describe_services), batches)
+                    for service in described
+                ]
+            task_definition_arns = sorted({service['taskDefinition'] for service in services})
+            with tracer.span('describe task definitions'):
+                task_definitions = dict(zip(task_definition_arns, executor.map(
+                    tracer.traced('describe task definition', self._describe_task_definition),
+                    task_definition_arns)))
+        now = datetime.now(timezone.utc)
+        return sorted(
+            (_service_status(service, task_definitions[service['taskDefinition']], now)
+             for service in services),
+            key=lambda status: status['service']
+        )
+
+    def print_status(self):
+        statuses = self.get_status()
+        if not statuses:
+            log_warning("No services found in " + self.cluster_name)
+            return
+        table_data = [['Service', 'Image tag', 'Desired', 'Running', 'Pending',
+                       'Deployment', 'Deployed']]
+        for status in statuses:
+            table_data.append([
+                status['service'],
+                status['image_tag'],
+                status['desired'],
+                status['running'],
+                status['pending'],
+                status['deployment'],
+                _format_age(status['deployment_age']),
+            ])
+        log_bold("{} services in {}".format(len(statuses), self.cluster_name))
+        print(SingleTable(table_data, self.environment).table)
+
+    def _describe_services(self, service_arns):
+        return self.ecs_client.describe_services(
+            cluster=self.cluster_name,
+            services=service_arns
+        )['services']
+
+    def _describe_task_definition(self, task_definition_arn):
+        return self.ecs_client.describe_task_definition(
+            taskDefinition=task_definition_arn
+        )['taskDefinition']
+
+
+def _service_status(service, task_definition, now):
+    deployments = service.get('deployments', [])
+    primary = next((deployment for deployment in deployments
+                    if deployment.get('status') == 'PRIMARY'), None)
+    if primary is None:
+        deployment_state = '-'
+    elif len(deployments) > 1:
+        deployment_state = 'IN_PROGRESS'
+    else:
+        deployment_state = primary.get('rolloutState', 'COMPLETED')
+    deployed_at = primary.get('createdAt') if primary else None
+    return {
+        'service': service['serviceName'],
+        'image_tag': _image_tag(task_definition),
+        'desired': service.get('desiredCount', 0),
+        'running': service.get('runningCount', 0),
+        'pending': service.get('pendingCount', 0),
+        'deployment': deployment_state,
+        'deployment_age': (now - deployed_at).total_seconds() if deployed_at else None,
+    }
+
+
+def _image_tag(task_definition):
+    # the image of the first container other than the sidecars
+    containers = [container for container in task_definition['containerDefinitions']
+                  if not container['name'].endswith('-sidecar')]
+    if not containers:
+        return '-'
+    image = containers[0]['image']
+    repository, _, tag = image.rpartition(':')
+    if not repository or '/' in tag:
+        return 'latest'
+    return tag
+
+
+def _format_age(seconds):
+    if seconds is None:
+        return '-'
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return '{}m ago'.format(minutes)
+    hours = minutes // 60
+    if hours < 48:
+        return '{}h {}m ago'.format(hours, minutes % 60)
+    return '{}d {}h ago'.format(hours // 24, hours % 24)
@@ -0,0 +1,127 @@
+'''
+Watches an ECS rollout for tasks of the new task definition which fail to
+start, and for the rollout running past its deadline.
+'''
+
+import time
+
+DEFAULT_ROLLOUT_DEADLINE = 30 * 60
+DEFAULT_MAX_FAILED_STARTS = 3
+STOPPED_TASKS_POLL_INTERVAL = 10
+DESCRIBE_TASKS_LIMIT = 100
+# stop codes of tasks which exited or never started, other than the ones
+# ECS stops itself while scaling or replacing tasks
+FAILED_START_STOP_CODES = {'TaskFailedToStart', 'EssentialContainerExited'}
+
+
+class RolloutFailed(Exception):
+    '''
+        The rollout cannot succeed. The message says why, one line per
+        failed task.
+    '''
+
+
+class RolloutMonitor(object):
+    '''
+        Call check() with the service on every poll of the rollout. It
+        raises RolloutFailed once max_failed_starts tasks of the task
+        definition stopped in a row without another one reaching RUNNING
+        in between, or when the rollout takes longer than deadline
+        seconds.
+    '''
+
+    def __init__(self, client, cluster_name, service_name, task_definition_arn,
+                 deadline=DEFAULT_ROLLOUT_DEADLINE, max_failed_starts=DEFAULT_MAX_FAILED_STARTS,
+                 clock=time.monotonic):
+        self.client = client
+        self.cluster_name = cluster_name
+        self.service_name = service_name
+        self.task_definition_arn = task_definition_arn
+        self.deadline = deadline
+        self.max_failed_starts = max_failed_starts
+        self._clock = clock
+        self._started_at = clock()
+        self._checked_stopped_tasks_at = self._started_at
+        self._seen_task_arns = set()
+        self._most_running = 0
+        self.failed_starts = []
+
+    def check(self, service):
+        deployment = self._deployment(service)
+        if deployment is not None and deployment.get(u'rolloutState') == u'FAILED':
+            # the deployment circuit breaker of the service tripped
+            raise RolloutFailed("%s: %s" % (
+                self.service_name, deployment.get(u'rolloutStateReason', u'ECS deployment failed.')))
+        running = deployment.get(u'runningCount', 0) if deployment is not None else 0
+        if running > self._most_running:
+            # a task started, earlier failures were not consecutive
+            self._most_running = running
+            self.failed_starts = []
+
+        now = self._clock()
+        if now - self._checked_stopped_tasks_at >= STOPPED_TASKS_POLL_INTERVAL:
+            self._checked_stopped_tasks_at = now
+            self.failed_starts.extend(self._new_failed_starts())
+            if len(self.failed_starts) >= self.max_failed_starts:
+                raise RolloutFailed(
+                    "%s: %d tasks of %s failed to start:\n%s" % (
+                        self.service_name, len(self.failed_starts),
+                        self.task_definition_arn.split('/')[-1],
+                        '\n'.join(self.failed_starts)))
+
+        if self.deadline and now - self._started_at > self.deadline:
+            message = "%s: not stable after %d seconds." % (self.service_name, self.deadline)
+            if self.failed_starts:
+                message += " Tasks which failed to start:\n" + '\n'.join(self.failed_starts)
+            raise RolloutFailed(message)
+
+    def check_finished(self, service):
+        '''
+            Call with the service once it is stable. Raises RolloutFailed
+            if ECS rolled it back to another task definition.
+        '''
+        if service.get(u'taskDefinition') != self.task_definition_arn:
+            raise RolloutFailed("%s: ECS rolled the deployment back to %s." % (
+                self.service_name, service.get(u'taskDefinition', u'').split('/')[-1]))
+
+    def _deployment(self, service):
+        for deployment in service.get(u'deployments', []):
+            if deployment.get(u'taskDefinition') == self.task_definition_arn:
+                return deployment
+        return None
+
+    def _new_failed_starts(self):
+        task_arns = [
+            task_arn for task_arn in self.client.list_stopped_tasks(
+                self.cluster_name, self.service_name)
+            if task_arn not in self._seen_task_arns
+        ]
+        tasks = []
+        for start in range(0, len(task_arns), DESCRIBE_TASKS_LIMIT):
+            tasks.extend(self.client.describe_tasks(
+                self.cluster_name, task_arns[start:start + DESCRIBE_TASKS_LIMIT])[u'tasks'])
+        failed_starts = []
+        for task in sorted(tasks, key=lambda task: task.get(u'stoppedAt') or task.get(u'createdAt')):
+            self._seen_task_arns.add(task[u'taskArn'])
+            if task[u'taskDefinitionArn'] != self.task_definition_arn or not _failed_to_start(task):
+                continue
+            failed_starts.append(_describe_stopped_task(task))
+        return failed_starts
+
+
+def _failed_to_start(task):
+    if task.get(u'stopCode') in FAILED_START_STOP_CODES:
+        return True
+    return u'health check' in task.get(u'stoppedReason', u'').lower()
+
+
+def _describe_stopped_task(task):
+    description = "  - task %s: %s" % (
+        task[u'taskArn'].split('/')[-1], task.get(u'stoppedReason', u'stopped'))
+    for container in task.get(u'containers', []):
+        if container.get(u'exitCode') not in (None, 0) or container.get(u'reason'):
+            description += "\n      container %s exited with code %s%s" % (
+                container[u'name'],
+                container.get(u'exitCode', u'-'),
+                ": " + container[u'reason'] if container.get(u'reason') else "")
+    return description
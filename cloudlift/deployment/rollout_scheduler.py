@@ -0,0 +1,83 @@
+'''
+Orders the ECS services of a service stack into rollout waves, and holds a
+wave back until the cluster has room for its new tasks.
+'''
+
+import time
+
+from cloudlift.config.logging import log_intent, log_warning
+from cloudlift.exceptions import UnrecoverableException
+
+DEFAULT_ROLLOUT_PRIORITY = 0
+CAPACITY_POLL_INTERVAL = 15
+DEFAULT_CAPACITY_WAIT = 10 * 60
+
+
+def plan_waves(components, max_concurrent=None):
+    '''
+        components maps each component of the service to its rollout
+        settings, the rollout block of its service configuration: priority,
+        lower first, and after, the components which must be deployed
+        before it. Each wave holds the components left with the lowest
+        priority whose dependencies are deployed, at most max_concurrent
+        of them, in the order given.
+    '''
+    unknown = sorted({
+        dependency for settings in components.values()
+        for dependency in settings.get('after', []) if dependency not in components
+    })
+    if unknown:
+        raise UnrecoverableException("Unknown components in rollout.after: {}".format(
+            ', '.join(unknown)))
+
+    def priority(component):
+        return components[component].get('priority', DEFAULT_ROLLOUT_PRIORITY)
+
+    waves = []
+    deployed = set()
+    remaining = list(components)
+    while remaining:
+        lowest = min(priority(component) for component in remaining)
+        ready = [component for component in remaining
+                 if priority(component) == lowest
+                 and deployed.issuperset(components[component].get('after', []))]
+        if not ready:
+            raise UnrecoverableException(
+                "Cannot order the rollout of {}: they come after each other or after "
+                "components of a higher priority.".format(', '.join(remaining)))
+        wave_size = max_concurrent or len(ready)
+        for start in range(0, len(ready), wave_size):
+            waves.append(ready[start:start + wave_size])
+        deployed.update(ready)
+        remaining = [component for component in remaining if component not in deployed]
+    return waves
+
+
+class CapacityGate(object):
+    '''
+        Waits until the new tasks the ECS services about to be rolled out
+        start next to their old ones can be placed on the container
+        instances of the cluster, by the plan of a CapacityPlanner. After
+        max_wait seconds the wave is let through with a warning, as the
+        cluster may still scale out for the pending tasks.
+    '''
+
+    def __init__(self, planner, max_wait=DEFAULT_CAPACITY_WAIT,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.planner = planner
+        self.max_wait = max_wait
+        self._clock = clock
+        self._sleep = sleep
+
+    def wait_for(self, ecs_service_names, plan=None):
+        started_at = self._clock()
+        plan = plan or self.planner.plan(ecs_service_names)
+        while not plan.fits:
+            if self._clock() - started_at >= self.max_wait:
+                log_warning("{}\nDeploying anyway.".format(plan.describe()))
+                return False
+            log_intent("Waiting for room in {}: {}".format(self.planner.cluster_name,
+                                                          plan.describe()))
+            self._sleep(CAPACITY_POLL_INTERVAL)
+            plan = self.planner.plan(ecs_service_names)
+        return True
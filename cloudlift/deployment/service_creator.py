@@ -3,6 +3,7 @@ Create or update ECS service and related dependencies
 using CloudFormation templates
 '''
 
+from functools import partial
 from time import sleep
 
 from botocore.exceptions import ClientError
@@ -11,10 +12,14 @@ from cloudlift.exceptions import UnrecoverableException
 from cloudlift.config import get_client_for
 from cloudlift.config import ServiceConfiguration
 from cloudlift.config import get_cluster_name, get_service_stack_name
+from cloudlift.config.pre_flight import (check_sns_topic_exists, check_stack_exists,
+                                         run_preflight_checks)
 from cloudlift.deployment.changesets import create_change_set
 from cloudlift.config.logging import log, log_bold, log_err
 from cloudlift.deployment.progress import get_stack_events, print_new_events
 from cloudlift.deployment.service_template_generator import ServiceTemplateGenerator
+from cloudlift.profiling import tracer
+from cloudlift.version import VERSION
 
 
 class ServiceCreator(object):
@@ -23,19 +28,29 @@ class ServiceCreator(object):
         CloudFormation template for ECS service and related dependencies
     '''
 
-    def __init__(self, name, environment):
+    def __init__(self, name, environment, stack_check=None):
+        '''
+            The lookups needed before creating or updating the stack run
+            concurrently. stack_check is 'create' or 'update' to also check
+            whether the service stack exists, as check_stack_exists does.
+        '''
         self.name = name
         self.environment = environment
         self.stack_name = get_service_stack_name(environment, name)
         self.client = get_client_for('cloudformation', self.environment)
         self.s3client = get_client_for('s3', self.environment)
         self.bucket_name = 'cloudlift-service-template'
-        self.environment_stack = self._get_environment_stack()
-        self.existing_events = get_stack_events(self.client, self.stack_name)
-        self.service_configuration = ServiceConfiguration(
-            self.name,
-            self.environment
-        )
+        checks = {
+            'environment stack': self._get_environment_stack,
+            'stack events': partial(get_stack_events, self.client, self.stack_name),
+            'service configuration': self._get_service_configuration,
+        }
+        if stack_check:
+            checks['service stack'] = partial(check_stack_exists, name, environment, stack_check)
+        results = run_preflight_checks(checks)
+        self.environment_stack = results['environment stack']
+        self.existing_events = results['stack events']
+        self.service_configuration, self.current_configuration = results['service configuration']
 
     def delete_template(self, key=None):
         '''
@@ -57,7 +72,7 @@ class ServiceCreator(object):
             and related dependencies
         '''
         log_bold("Initiating service creation")
-        self.service_configuration.edit_config()
+        self.service_configuration.edit_config(self.current_configuration)
 
         template_generator = ServiceTemplateGenerator(
             self.service_configuration,
@@ -106,31 +121,34 @@ class ServiceCreator(object):
         '''
 
         log_bold("Starting to update service")
-        self.service_configuration.edit_config()
+        self.service_configuration.edit_config(self.current_configuration)
         try:
             template_generator = ServiceTemplateGenerator(
                 self.service_configuration,
                 self.environment_stack
             )
-            service_template_body, template_source, key = template_generator.generate_service()
-            change_set = create_change_set(
-                self.client,
-                service_template_body,
-                template_source,
-                self.stack_name,
-                "",
-                self.environment
-            )
+            with tracer.span('template generation'):
+                service_template_body, template_source, key = template_generator.generate_service()
+            with tracer.span('changeset create'):
+                change_set = create_change_set(
+                    self.client,
+                    service_template_body,
+                    template_source,
+                    self.stack_name,
+                    "",
+                    self.environment
+                )
             if change_set is None:
                 self.delete_template(key)
                 return
             self.service_configuration.update_cloudlift_version()
             log_bold("Executing changeset. Checking progress...")
-            self.client.execute_change_set(
-                ChangeSetName=change_set['ChangeSetId']
-            )
-            self.delete_template(key)
-            self._print_progress()
+            with tracer.span('stack update'):
+                self.client.execute_change_set(
+                    ChangeSetName=change_set['ChangeSetId']
+                )
+                self.delete_template(key)
+                self._print_progress()
         except ClientError as exc:
             self.delete_template(key)
             if "No updates are to be performed." in str(exc):
@@ -151,6 +169,18 @@ class ServiceCreator(object):
 cluster using `create_environment` command.")
         return environment_stack
 
+    def _get_service_configuration(self):
+        service_configuration = ServiceConfiguration(self.name, self.environment)
+        current_configuration = service_configuration.get_config(VERSION, for_update=True)
+        if current_configuration.get('notifications_arn'):
+            try:
+                # warms the pre-flight cache for set_config; a missing topic
+                # can still be fixed in the editor
+                check_sns_topic_exists(current_configuration['notifications_arn'], self.environment)
+            except UnrecoverableException:
+                pass
+        return service_configuration, current_configuration
+
     def _print_progress(self):
         while True:
             response = self.client.describe_stacks(StackName=self.stack_name)
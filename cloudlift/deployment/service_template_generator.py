@@ -12,13 +12,19 @@ from awacs.sts import AssumeRole
 from awacs.firehose import PutRecordBatch
 from cfn_flip import to_yaml
 from stringcase import pascalcase
-from troposphere import GetAtt, Output, Parameter, Ref, Sub, ImportValue, Tags
+from troposphere import GetAtt, Join, Output, Parameter, Ref, Sub, ImportValue, Tags
+from troposphere.applicationautoscaling import (CustomizedMetricSpecification,
+                                                MetricDimension as ScalingMetricDimension,
+                                                PredefinedMetricSpecification, ScalableTarget,
+                                                ScalingPolicy, StepAdjustment,
+                                                StepScalingPolicyConfiguration,
+                                                TargetTrackingScalingPolicyConfiguration)
 from troposphere.cloudwatch import Alarm, MetricDimension
 from troposphere.ec2 import SecurityGroup
 from troposphere.ecs import (AwsvpcConfiguration, ContainerDefinition,
-                             DeploymentConfiguration, Secret, MountPoint,
+                             DeploymentCircuitBreaker, DeploymentConfiguration, Secret, MountPoint,
                              LoadBalancer, LogConfiguration, Volume, EFSVolumeConfiguration,
-                             NetworkConfiguration, PlacementStrategy,
+                             NetworkConfiguration, PlacementStrategy, CapacityProviderStrategyItem,
                              PortMapping, Service, TaskDefinition, ServiceRegistry, PlacementConstraint, 
                              MountPoint, ContainerDependency, Environment,
                              FirelensConfiguration, HealthCheck)
@@ -56,6 +62,11 @@ class ServiceTemplateGenerator(TemplateGenerator):
         )]
     LAUNCH_TYPE_FARGATE = 'FARGATE'
     LAUNCH_TYPE_EC2 = 'EC2'
+    PREDEFINED_SCALING_METRICS = {
+        'cpu': 'ECSServiceAverageCPUUtilization',
+        'memory': 'ECSServiceAverageMemoryUtilization',
+        'alb_request_count': 'ALBRequestCountPerTarget',
+    }
 
     def __init__(self, service_configuration, environment_stack):
         super(ServiceTemplateGenerator, self).__init__(
@@ -64,6 +75,7 @@ class ServiceTemplateGenerator(TemplateGenerator):
         self._derive_configuration(service_configuration)
         self.env_sample_file_path = './env.sample'
         self.environment_stack = environment_stack
+        self._environment_stack_outputs = None
         self.current_version = ServiceInformationFetcher(
             self.application_name, self.env).get_current_version()
         self.bucket_name = 'cloudlift-service-template'
@@ -83,10 +95,11 @@ class ServiceTemplateGenerator(TemplateGenerator):
         self._add_cluster_services()
 
         key = uuid.uuid4().hex + '.yml'
-        if len(to_yaml(self.template.to_json())) > 51000:
+        template_body = to_yaml(self.template.to_json())
+        if len(template_body) > 51000:
             try:
                 self.client.put_object(
-                    Body=to_yaml(self.template.to_json()),
+                    Body=template_body,
                     Bucket=self.bucket_name,
                     Key=key,
                 )
@@ -99,7 +112,7 @@ class ServiceTemplateGenerator(TemplateGenerator):
                 else:
                     raise boto_client_error
         else:
-            return to_yaml(self.template.to_json()), 'TemplateBody', ''
+            return template_body, 'TemplateBody', ''
 
     def _add_cluster_services(self):
         for ecs_service_name, config in self.configuration['services'].items():
@@ -230,26 +243,17 @@ service is down',
             "Essential": 'true',
             "Cpu": 0
         }
-        placement_constraint = {}
-        if 'fargate' not in config:
-            for key in self.environment_stack["Outputs"]:
-                if key["OutputKey"] == 'ECSClusterDefaultInstanceLifecycle':
-                    instance_lifecycle = key["OutputValue"]
-                    spot_deployment = instance_lifecycle == 'spot'
-                    placement_constraint = {
-                        "PlacementConstraints": [PlacementConstraint(
-                            Type='memberOf',
-                            Expression='attribute:deployment_type == spot' if spot_deployment else 'attribute:deployment_type == ondemand'
-                        )],
-                    }
-            if 'spot_deployment' in config:
-                spot_deployment = config["spot_deployment"]
-                placement_constraint = {
-                    "PlacementConstraints" : [PlacementConstraint(
-                        Type='memberOf',
-                        Expression='attribute:deployment_type == spot' if spot_deployment else 'attribute:deployment_type == ondemand'
-                    )],
-                }
+        placement_arguments = {}
+        launch_type_arguments = {'LaunchType': launch_type}
+        if launch_type == self.LAUNCH_TYPE_EC2:
+            capacity_provider_strategy = self._capacity_provider_strategy(config)
+            if capacity_provider_strategy is not None:
+                # services on capacity providers take no launch type
+                launch_type_arguments = {}
+                if capacity_provider_strategy:
+                    launch_type_arguments['CapacityProviderStrategy'] = capacity_provider_strategy
+            placement_arguments = self._placement_arguments(
+                config, deployment_type_constraint=capacity_provider_strategy is None)
 
         if 'http_interface' in config:
             container_definition_arguments['PortMappings'] = [
@@ -370,12 +374,15 @@ service is down',
 
         self.template.add_resource(td)
         desired_count = self._get_desired_task_count_for_service(service_name)
-        deployment_configuration = DeploymentConfiguration(
-            MinimumHealthyPercent=100,
-            MaximumPercent=200
-        )
+        if 'autoscaling' in config:
+            # keep the count autoscaling chose, within the configured range
+            desired_count = min(max(desired_count, int(config['autoscaling']['min_capacity'])),
+                                int(config['autoscaling']['max_capacity']))
+        alb_target_group = None
+        deployment_arguments = self._deployment_arguments(config)
         if 'http_interface' in config:
-            alb, lb, service_listener, alb_sg = self._add_alb(cd, service_name, config, launch_type)
+            alb, lb, service_listener, alb_sg, target_group = self._add_alb(cd, service_name, config, launch_type)
+            alb_target_group = (alb, target_group)
 
             if launch_type == self.LAUNCH_TYPE_FARGATE:
                 # if launch type is ec2, then services inherit the ec2 instance security group
@@ -436,12 +443,12 @@ service is down',
                                 ]
                             )
                         ),
-                        'PlacementStrategies': self.PLACEMENT_STRATEGIES
+                        **placement_arguments
                     }
                 else:
                     launch_type_svc = {
                         'Role': Ref(self.ecs_service_role),
-                        'PlacementStrategies': self.PLACEMENT_STRATEGIES
+                        **placement_arguments
                     }
 
             svc = Service(
@@ -451,10 +458,10 @@ service is down',
                 TaskDefinition=Ref(td),
                 DesiredCount=desired_count,
                 DependsOn=service_listener.title,
-                LaunchType=launch_type,
+                **deployment_arguments,
+                **launch_type_arguments,
                 **launch_type_svc,
-                Tags=Tags(Team=self.team_name, environment=self.env),
-                **placement_constraint
+                Tags=Tags(Team=self.team_name, environment=self.env)
             )
             self.template.add_output(
                 Output(
@@ -539,22 +546,21 @@ service is down',
                                 ]
                             )
                         ),
-                        'PlacementStrategies': self.PLACEMENT_STRATEGIES
+                        **placement_arguments
                     }
                 else:
                     launch_type_svc = {
-                        'PlacementStrategies': self.PLACEMENT_STRATEGIES
+                        **placement_arguments
                     }
             svc = Service(
                 service_name,
                 Cluster=self.cluster_name,
                 TaskDefinition=Ref(td),
                 DesiredCount=desired_count,
-                DeploymentConfiguration=deployment_configuration,
-                LaunchType=launch_type,
+                **deployment_arguments,
+                **launch_type_arguments,
                 **launch_type_svc,
-                Tags=Tags(Team=self.team_name, environment=self.env),
-                **placement_constraint
+                Tags=Tags(Team=self.team_name, environment=self.env)
             )
             self.template.add_output(
                 Output(
@@ -565,6 +571,137 @@ service is down',
             )
             self.template.add_resource(svc)
         self._add_service_alarms(svc)
+        if 'autoscaling' in config:
+            self._add_service_autoscaling(service_name, svc, config['autoscaling'], alb_target_group)
+
+    def _add_service_autoscaling(self, service_name, svc, autoscaling, alb_target_group):
+        '''
+            A scalable target for the desired count of the ECS service, with
+            a target tracking policy for each of autoscaling.target_tracking
+            and step scaling on the backlog of autoscaling.sqs_step_scaling.
+        '''
+        scalable_target = ScalableTarget(
+            service_name + 'ScalableTarget',
+            MinCapacity=int(autoscaling['min_capacity']),
+            MaxCapacity=int(autoscaling['max_capacity']),
+            ResourceId=Join('/', ['service', self.cluster_name, GetAtt(svc, 'Name')]),
+            ScalableDimension='ecs:service:DesiredCount',
+            ServiceNamespace='ecs'
+        )
+        self.template.add_resource(scalable_target)
+        custom_policy_count = 0
+        for policy in autoscaling.get('target_tracking', []):
+            policy_name = service_name + pascalcase(policy['metric'])
+            if policy['metric'] == 'custom':
+                # there may be several custom metrics, the first keeps the plain name
+                custom_policy_count += 1
+                if custom_policy_count > 1:
+                    policy_name += str(custom_policy_count)
+            self.template.add_resource(self._target_tracking_policy(
+                policy_name + 'TargetTracking', scalable_target, policy, alb_target_group))
+        if 'sqs_step_scaling' in autoscaling:
+            self._add_sqs_step_scaling(service_name, scalable_target, autoscaling['sqs_step_scaling'])
+
+    def _target_tracking_policy(self, policy_name, scalable_target, policy, alb_target_group):
+        metric = policy['metric']
+        metric_specification = {}
+        if metric == 'custom':
+            custom_metric = policy['custom_metric']
+            metric_specification['CustomizedMetricSpecification'] = CustomizedMetricSpecification(
+                Namespace=custom_metric['namespace'],
+                MetricName=custom_metric['metric_name'],
+                Statistic=custom_metric['statistic'],
+                Dimensions=[
+                    ScalingMetricDimension(Name=name, Value=value)
+                    for name, value in sorted(custom_metric.get('dimensions', {}).items())
+                ],
+                **({'Unit': custom_metric['unit']} if 'unit' in custom_metric else {})
+            )
+        else:
+            predefined_metric = {'PredefinedMetricType': self.PREDEFINED_SCALING_METRICS[metric]}
+            if metric == 'alb_request_count':
+                alb, target_group = alb_target_group
+                predefined_metric['ResourceLabel'] = Join('/', [
+                    GetAtt(alb, 'LoadBalancerFullName'),
+                    GetAtt(target_group, 'TargetGroupFullName')
+                ])
+            metric_specification['PredefinedMetricSpecification'] = PredefinedMetricSpecification(
+                **predefined_metric)
+        return ScalingPolicy(
+            policy_name,
+            PolicyName=policy_name,
+            PolicyType='TargetTrackingScaling',
+            ScalingTargetId=Ref(scalable_target),
+            TargetTrackingScalingPolicyConfiguration=TargetTrackingScalingPolicyConfiguration(
+                TargetValue=float(policy['target']),
+                ScaleInCooldown=int(policy.get('scale_in_cooldown', 300)),
+                ScaleOutCooldown=int(policy.get('scale_out_cooldown', 60)),
+                **metric_specification
+            )
+        )
+
+    def _add_sqs_step_scaling(self, service_name, scalable_target, sqs_step_scaling):
+        # the steps are relative to the alarm threshold, the smallest backlog
+        # scaled out on
+        steps = sorted(sqs_step_scaling['scale_out_steps'], key=lambda step: step['messages'])
+        threshold = steps[0]['messages']
+        cooldown = int(sqs_step_scaling.get('cooldown', 60))
+        scale_out_policy = ScalingPolicy(
+            service_name + 'SqsScaleOutPolicy',
+            PolicyName=service_name + 'SqsScaleOutPolicy',
+            PolicyType='StepScaling',
+            ScalingTargetId=Ref(scalable_target),
+            StepScalingPolicyConfiguration=StepScalingPolicyConfiguration(
+                AdjustmentType='ChangeInCapacity',
+                Cooldown=cooldown,
+                MetricAggregationType='Maximum',
+                StepAdjustments=[
+                    StepAdjustment(
+                        MetricIntervalLowerBound=float(step['messages'] - threshold),
+                        ScalingAdjustment=int(step['adjustment']),
+                        **({'MetricIntervalUpperBound': float(next_step['messages'] - threshold)}
+                           if next_step else {})
+                    )
+                    for step, next_step in zip(steps, steps[1:] + [None])
+                ]
+            )
+        )
+        scale_in = sqs_step_scaling.get('scale_in', {})
+        scale_in_policy = ScalingPolicy(
+            service_name + 'SqsScaleInPolicy',
+            PolicyName=service_name + 'SqsScaleInPolicy',
+            PolicyType='StepScaling',
+            ScalingTargetId=Ref(scalable_target),
+            StepScalingPolicyConfiguration=StepScalingPolicyConfiguration(
+                AdjustmentType='ChangeInCapacity',
+                Cooldown=cooldown,
+                MetricAggregationType='Maximum',
+                StepAdjustments=[StepAdjustment(
+                    MetricIntervalUpperBound=0.0,
+                    ScalingAdjustment=int(scale_in.get('adjustment', -1))
+                )]
+            )
+        )
+        self.template.add_resource(scale_out_policy)
+        self.template.add_resource(scale_in_policy)
+        for alarm_name, policy, comparison, alarm_threshold, evaluation_periods in [
+            ('SqsScaleOutAlarm', scale_out_policy, 'GreaterThanOrEqualToThreshold', threshold, 1),
+            ('SqsScaleInAlarm', scale_in_policy, 'LessThanThreshold',
+             scale_in.get('below_messages', 1), 5),
+        ]:
+            self.template.add_resource(Alarm(
+                service_name + alarm_name,
+                EvaluationPeriods=evaluation_periods,
+                Dimensions=[MetricDimension(Name='QueueName', Value=sqs_step_scaling['queue_name'])],
+                AlarmActions=[Ref(policy)],
+                Namespace='AWS/SQS',
+                Period=60,
+                MetricName='ApproximateNumberOfMessagesVisible',
+                Statistic='Maximum',
+                Threshold=str(alarm_threshold),
+                ComparisonOperator=comparison,
+                TreatMissingData='notBreaching'
+            ))
 
     def _gen_log_config(self, service_name, config):
         if config == 'awslogs':
@@ -711,7 +848,7 @@ service is down',
             config['http_interface']['internal']
         )
         self._add_alb_alarms(service_name, alb)
-        return alb, lb, service_listener, svc_alb_sg
+        return alb, lb, service_listener, svc_alb_sg, service_target_group
 
     def _add_service_listener(self, service_name, target_group_action,
                               alb, internal):
@@ -891,60 +1028,35 @@ building this service",
             "VPC",
             Description='',
             Type="AWS::EC2::VPC::Id",
-            Default=list(
-                filter(
-                    lambda x: x['OutputKey'] == "VPC",
-                    self.environment_stack['Outputs']
-                )
-            )[0]['OutputValue']
+            Default=self.environment_stack_outputs['VPC']
         )
         self.template.add_parameter(self.vpc)
         self.public_subnet1 = Parameter(
             "PublicSubnet1",
             Description='',
             Type="AWS::EC2::Subnet::Id",
-            Default=list(
-                filter(
-                    lambda x: x['OutputKey'] == "PublicSubnet1",
-                    self.environment_stack['Outputs']
-                )
-            )[0]['OutputValue']
+            Default=self.environment_stack_outputs['PublicSubnet1']
         )
         self.template.add_parameter(self.public_subnet1)
         self.public_subnet2 = Parameter(
             "PublicSubnet2",
             Description='',
             Type="AWS::EC2::Subnet::Id",
-            Default=list(
-                filter(
-                    lambda x: x['OutputKey'] == "PublicSubnet2",
-                    self.environment_stack['Outputs']
-                )
-            )[0]['OutputValue']
+            Default=self.environment_stack_outputs['PublicSubnet2']
         )
         self.template.add_parameter(self.public_subnet2)
         self.private_subnet1 = Parameter(
             "PrivateSubnet1",
             Description='',
             Type="AWS::EC2::Subnet::Id",
-            Default=list(
-                filter(
-                    lambda x: x['OutputKey'] == "PrivateSubnet1",
-                    self.environment_stack['Outputs']
-                )
-            )[0]['OutputValue']
+            Default=self.environment_stack_outputs['PrivateSubnet1']
         )
         self.template.add_parameter(self.private_subnet1)
         self.private_subnet2 = Parameter(
             "PrivateSubnet2",
             Description='',
             Type="AWS::EC2::Subnet::Id",
-            Default=list(
-                filter(
-                    lambda x: x['OutputKey'] == "PrivateSubnet2",
-                    self.environment_stack['Outputs']
-                )
-            )[0]['OutputValue']
+            Default=self.environment_stack_outputs['PrivateSubnet2']
         )
         self.template.add_parameter(self.private_subnet2)
         self.template.add_parameter(Parameter(
@@ -953,12 +1065,7 @@ building this service",
             Type="String",
             Default="production"
         ))
-        self.alb_security_group = list(
-            filter(
-                lambda x: x['OutputKey'] == "SecurityGroupAlb",
-                self.environment_stack['Outputs']
-            )
-        )[0]['OutputValue']
+        self.alb_security_group = self.environment_stack_outputs['SecurityGroupAlb']
 
     def _fetch_current_desired_count(self):
         stack_name = get_service_stack_name(self.env, self.application_name)
@@ -993,6 +1100,93 @@ building this service",
         except Exception:
             log_bold("Could not find existing services.")
 
+    def _deployment_arguments(self, config):
+        '''
+            DeploymentConfiguration and HealthCheckGracePeriodSeconds of the
+            ECS service, from the deployment block of its configuration.
+        '''
+        deployment = config.get('deployment', {})
+        deployment_configuration = {
+            'MinimumHealthyPercent': int(deployment.get('minimum_healthy_percent', 100)),
+            'MaximumPercent': int(deployment.get('maximum_percent', 200)),
+        }
+        if 'circuit_breaker' in deployment:
+            deployment_configuration['DeploymentCircuitBreaker'] = DeploymentCircuitBreaker(
+                Enable=deployment['circuit_breaker']['enable'],
+                Rollback=deployment['circuit_breaker'].get('rollback', False)
+            )
+        arguments = {'DeploymentConfiguration': DeploymentConfiguration(**deployment_configuration)}
+        if 'health_check_grace_period_seconds' in deployment:
+            arguments['HealthCheckGracePeriodSeconds'] = int(
+                deployment['health_check_grace_period_seconds'])
+        return arguments
+
+    def _placement_arguments(self, config, deployment_type_constraint=True):
+        '''
+            PlacementStrategies and PlacementConstraints of an ECS service on
+            EC2: the strategies of its placement block, or a spread over
+            availability zones and instances, and its constraints next to
+            the one keeping it on spot or on demand instances, unless a
+            capacity provider does that.
+        '''
+        placement = config.get('placement', {})
+        if 'strategies' in placement:
+            strategies = [
+                PlacementStrategy(Type=strategy['type'], **(
+                    {'Field': strategy['field']} if 'field' in strategy else {}))
+                for strategy in placement['strategies']
+            ]
+        else:
+            strategies = self.PLACEMENT_STRATEGIES
+        arguments = {'PlacementStrategies': strategies}
+
+        constraints = []
+        deployment_type = self._deployment_type(config)
+        if deployment_type_constraint and deployment_type is not None:
+            constraints.append(PlacementConstraint(
+                Type='memberOf',
+                Expression='attribute:deployment_type == ' + deployment_type
+            ))
+        for constraint in placement.get('constraints', []):
+            constraints.append(PlacementConstraint(Type=constraint['type'], **(
+                {'Expression': constraint['expression']} if 'expression' in constraint else {})))
+        if constraints:
+            arguments['PlacementConstraints'] = constraints
+        return arguments
+
+    def _deployment_type(self, config):
+        '''
+            spot or ondemand, the instances an EC2 service runs on by its
+            spot_deployment or the default lifecycle of the cluster, or None.
+        '''
+        if 'spot_deployment' in config:
+            return 'spot' if config['spot_deployment'] else 'ondemand'
+        if 'ECSClusterDefaultInstanceLifecycle' in self.environment_stack_outputs:
+            return 'spot' if self.environment_stack_outputs['ECSClusterDefaultInstanceLifecycle'] == 'spot' \
+                else 'ondemand'
+        return None
+
+    def _capacity_provider_strategy(self, config):
+        '''
+            The capacity provider strategy of an EC2 service on a cluster
+            with capacity providers: the provider of its deployment type, or
+            an empty one for the cluster's default strategy. None when the
+            cluster has no provider for it, and the service keeps its launch
+            type and deployment_type placement constraint.
+        '''
+        capacity_providers = {
+            'ondemand': self.environment_stack_outputs.get('CapacityProviderOnDemand'),
+            'spot': self.environment_stack_outputs.get('CapacityProviderSpot'),
+        }
+        if not any(capacity_providers.values()):
+            return None
+        deployment_type = self._deployment_type(config)
+        if deployment_type is None:
+            return []
+        if not capacity_providers[deployment_type]:
+            return None
+        return [CapacityProviderStrategyItem(CapacityProvider=capacity_providers[deployment_type], Weight=1)]
+
     def _get_desired_task_count_for_service(self, service_name):
         if service_name in self.desired_counts:
             return self.desired_counts[service_name]
@@ -1082,6 +1276,16 @@ building this service",
                self.region + ".amazonaws.com/" + \
                self.repo_name
 
+    @property
+    def environment_stack_outputs(self):
+        # built once, as every service looks up the cluster stack outputs
+        if self._environment_stack_outputs is None:
+            self._environment_stack_outputs = {
+                output['OutputKey']: output['OutputValue']
+                for output in self.environment_stack['Outputs']
+            }
+        return self._environment_stack_outputs
+
     @property
     def account_id(self):
         return get_account_id()
@@ -2,7 +2,10 @@ import base64
 import multiprocessing
 import os
 import subprocess
+import sys
 import boto3
+from collections import OrderedDict
+from functools import partial
 from time import sleep
 
 from botocore.exceptions import ClientError
@@ -15,101 +18,246 @@ from cloudlift.config import get_account_id
 from cloudlift.config import (get_client_for,
                               get_region_for_environment)
 from cloudlift.config import get_cluster_name, get_service_stack_name
+from cloudlift.config.pre_flight import run_preflight_checks
+from cloudlift.config.service_configuration import ServiceConfiguration
 from cloudlift.deployment import deployer
 from cloudlift.config.logging import log_bold, log_err, log_intent, log_warning
+from cloudlift.deployment.cluster_capacity import (CAPACITY_CHECK_OFF, CAPACITY_CHECK_SCALE,
+                                                   CAPACITY_CHECK_WARN, CapacityPlanner,
+                                                   get_auto_scaling_groups)
 from cloudlift.deployment.ecs import DeployAction
+from cloudlift.deployment.rollout_monitor import DEFAULT_MAX_FAILED_STARTS, DEFAULT_ROLLOUT_DEADLINE
+from cloudlift.deployment.rollout_scheduler import CapacityGate, plan_waves
+from cloudlift.profiling import instrument_client, tracer
+from cloudlift.version import VERSION
 
 DEPLOYMENT_COLORS = ['blue', 'magenta', 'white', 'cyan']
+ECS_SERVICE_NAME_OUTPUT_SUFFIX = 'EcsServiceName'
 
 
 class ServiceUpdater(object):
     def __init__(self, name, environment, env_sample_file, version=None,
-                 build_args=None, working_dir='.'):
+                 build_args=None, working_dir='.', deadline=DEFAULT_ROLLOUT_DEADLINE,
+                 max_failed_starts=DEFAULT_MAX_FAILED_STARTS, rollback=False,
+                 max_rollouts=None, wait_for_capacity=False,
+                 capacity_check=CAPACITY_CHECK_WARN):
         self.name = name
         self.environment = environment
+        self._region = None
         if env_sample_file is not None:
             self.env_sample_file = env_sample_file
         else:
             self.env_sample_file = './env.sample'
         self.version = version
-        self.ecr_client = boto3.session.Session(region_name=self.region).client('ecr')
+        self.ecr_client = instrument_client(
+            boto3.session.Session(region_name=self.region).client('ecr'))
         self.cluster_name = get_cluster_name(environment)
         self.working_dir = working_dir
         self.build_args = build_args
+        self.deadline = deadline
+        self.max_failed_starts = max_failed_starts
+        self.rollback = rollback
+        self.max_rollouts = max_rollouts
+        self.wait_for_capacity = wait_for_capacity
+        self.capacity_check = capacity_check
 
     def run(self):
         log_warning("Deploying to {self.region}".format(**locals()))
-        self.init_stack_info()
         if not os.path.exists(self.env_sample_file):
             raise UnrecoverableException('env.sample not found. Exiting.')
         ecr_client = EcrClient(self.name, self.region, self.build_args)
-        ecr_client.set_version(self.version)
+        # the SSM config is fetched once here for all the ECS services
+        results = run_preflight_checks({
+            'service stack': self.init_stack_info,
+            'rollout configuration': self._get_rollout_settings,
+            'version resolution': partial(ecr_client.set_version, self.version),
+            'ECR repository': ecr_client.ensure_repository,
+            'SSM config fetch': partial(deployer.build_config, self.environment,
+                                        self.name, self.env_sample_file),
+        })
+        waves = self._plan_waves(results['rollout configuration'])
         log_intent("name: " + self.name + " | environment: " +
                    self.environment + " | version: " + str(ecr_client.version))
         log_bold("Checking image in ECR")
         ecr_client.build_and_upload_image()
         log_bold("Initiating deployment\n")
+        image_url = ecr_client.ecr_image_uri + ':' + ecr_client.version
+        self._deploy_ecs_services(waves, ecr_client.version, image_url,
+                                  results['SSM config fetch'])
 
-        jobs = []
-        for index, service_name in enumerate(self.ecs_service_names):
-            log_bold("Starting to deploy " + service_name)
-            color = DEPLOYMENT_COLORS[index % 3]
-            image_url = ecr_client.ecr_image_uri
-            image_url += (':' + ecr_client.version)
-            process = multiprocessing.Process(
-                target=deployer.deploy_new_version,
-                args=(
-                    self.region,
-                    self.cluster_name,
-                    service_name,
-                    ecr_client.version,
-                    self.name,
-                    self.env_sample_file,
-                    self.environment,
-                    color,
-                    image_url
-                )
-            )
-            jobs.append(process)
-            process.start()
+    def deploy_config(self):
+        '''
+            Roll out the current SSM config with the images which are
+            deployed, without resolving a version or touching ECR. Tasks
+            read their secrets when they start, so the services are rolled
+            out even if no parameter was added or removed.
+        '''
+        log_warning("Deploying config to {self.region}".format(**locals()))
+        if not os.path.exists(self.env_sample_file):
+            raise UnrecoverableException('env.sample not found. Exiting.')
+        results = run_preflight_checks({
+            'service stack': self.init_stack_info,
+            'rollout configuration': self._get_rollout_settings,
+            'SSM config fetch': partial(deployer.build_config, self.environment,
+                                        self.name, self.env_sample_file),
+        })
+        waves = self._plan_waves(results['rollout configuration'])
+        log_intent("name: " + self.name + " | environment: " +
+                   self.environment + " | version: unchanged")
+        log_bold("Initiating config deployment\n")
+        self._deploy_ecs_services(waves, None, None, results['SSM config fetch'])
+
+    def _get_rollout_settings(self):
+        services = ServiceConfiguration(self.name, self.environment).get_config(VERSION)['services']
+        return {component: config.get('rollout', {}) for component, config in services.items()}
+
+    def _plan_waves(self, rollout_settings):
+        '''
+            The ECS services in waves, by the rollout settings of their
+            components. Components without settings are deployed first,
+            all together.
+        '''
+        waves = plan_waves(
+            OrderedDict((component, rollout_settings.get(component, {}))
+                        for component in self.ecs_services),
+            self.max_rollouts
+        )
+        return [[self.ecs_services[component] for component in wave] for wave in waves]
+
+    def _deploy_ecs_services(self, waves, version, image_url, env_config):
+        capacity_planner = self._capacity_planner()
+        index = 0
+        for wave_number, wave in enumerate(waves, 1):
+            if len(waves) > 1:
+                log_bold("Rollout wave {} of {}: {}".format(wave_number, len(waves), ', '.join(wave)))
+            if capacity_planner is not None:
+                with tracer.span('capacity check'):
+                    self._check_capacity(capacity_planner, wave)
+            jobs = []
+            for service_name in wave:
+                jobs.append(self._start_deployment(service_name, DEPLOYMENT_COLORS[index % 3],
+                                                   version, image_url, env_config))
+                index += 1
+            if not self._wait_for_deployments(jobs):
+                skipped = [service_name for later_wave in waves[wave_number:]
+                           for service_name in later_wave]
+                if skipped:
+                    log_err("Not deploying " + ', '.join(skipped))
+                raise UnrecoverableException("Deployment failed")
+
+    def _capacity_planner(self):
+        if self.capacity_check == CAPACITY_CHECK_OFF and not self.wait_for_capacity:
+            return None
+        session = boto3.session.Session(region_name=self.region)
+        if self.capacity_check != CAPACITY_CHECK_SCALE:
+            return CapacityPlanner(instrument_client(session.client('ecs')), self.cluster_name)
+        return CapacityPlanner(
+            instrument_client(session.client('ecs')),
+            self.cluster_name,
+            instrument_client(session.client('autoscaling')),
+            get_auto_scaling_groups(instrument_client(session.client('cloudformation')), self.cluster_name)
+        )
+
+    def _check_capacity(self, capacity_planner, ecs_service_names):
+        '''
+            Warns when the new tasks of the ECS services cannot all be
+            placed next to the old ones, which leaves them PENDING and the
+            rollout stalled, and scales the cluster out or waits for room
+            when asked to.
+        '''
+        plan = capacity_planner.plan(ecs_service_names)
+        if not plan.fits:
+            log_warning("The rollout of {} may stall:\n{}".format(
+                ', '.join(ecs_service_names), plan.describe()))
+            if self.capacity_check == CAPACITY_CHECK_SCALE:
+                capacity_planner.scale_out(plan)
+        if self.wait_for_capacity:
+            CapacityGate(capacity_planner).wait_for(ecs_service_names, plan)
+
+    def _start_deployment(self, service_name, color, version, image_url, env_config):
+        log_bold("Starting to deploy " + service_name)
+        process = multiprocessing.Process(
+            target=tracer.traced('service deployment',
+                                 _deploy_new_version,
+                                 service=service_name),
+            args=(
+                self.region,
+                self.cluster_name,
+                service_name,
+                version,
+                self.name,
+                self.env_sample_file,
+                self.environment,
+                color,
+                image_url,
+                env_config
+            ),
+            kwargs={
+                'deadline': self.deadline,
+                'max_failed_starts': self.max_failed_starts,
+                'rollback': self.rollback
+            }
+        )
+        process.start()
+        return process
 
+    def _wait_for_deployments(self, jobs):
         exit_codes = []
         while True:
             sleep(1)
             exit_codes = [proc.exitcode for proc in jobs]
             if None not in exit_codes:
                 break
-
-        if any(exit_codes) != 0:
-            raise UnrecoverableException("Deployment failed")
+        return not any(exit_codes)
 
     def upload_image(self, additional_tags):
         EcrClient(self.name, self.region, self.build_args).upload_image(self.version, additional_tags)
 
     @property
     def region(self):
-        return get_region_for_environment(self.environment)
+        if self._region is None:
+            self._region = get_region_for_environment(self.environment)
+        return self._region
 
     def init_stack_info(self):
-        try:
-            self.stack_name = get_service_stack_name(self.environment, self.name)
-            stack = get_client_for(
-                'cloudformation',
-                self.environment
-            ).describe_stacks(
-                StackName=self.stack_name
-            )['Stacks'][0]
-            self.ecs_service_names = [
-                service_name['OutputValue'] for service_name in list(
-                    filter(
-                        lambda x: x['OutputKey'].endswith('EcsServiceName'),
-                        stack['Outputs']
-                    )
-                )
-            ]
-        except ClientError as client_error:
-            err = str(client_error)
-            if "Stack with id %s does not exist" % self.stack_name in err:
-                raise UnrecoverableException(f'Stack with id {self.stack_name} does not exist. Create the service using `create_service` command.')
-            else:
-                raise UnrecoverableException(str(client_error))
+        self.stack_name = get_service_stack_name(self.environment, self.name)
+        self.ecs_services = get_ecs_services(
+            get_client_for('cloudformation', self.environment),
+            self.stack_name
+        )
+        self.ecs_service_names = list(self.ecs_services.values())
+
+
+def _deploy_new_version(*args, **kwargs):
+    # the exit code of the deployment process tells whether it succeeded
+    if not deployer.deploy_new_version(*args, **kwargs):
+        sys.exit(1)
+
+
+def get_ecs_service_names(cloudformation_client, stack_name):
+    '''
+        Names of the ECS services in the service stack, from its outputs.
+    '''
+    return list(get_ecs_services(cloudformation_client, stack_name).values())
+
+
+def get_ecs_services(cloudformation_client, stack_name):
+    '''
+        Names of the ECS services in the service stack by the name of their
+        component in the service configuration.
+    '''
+    try:
+        stack = cloudformation_client.describe_stacks(
+            StackName=stack_name
+        )['Stacks'][0]
+        return OrderedDict(
+            (output['OutputKey'][:-len(ECS_SERVICE_NAME_OUTPUT_SUFFIX)], output['OutputValue'])
+            for output in stack['Outputs']
+            if output['OutputKey'].endswith(ECS_SERVICE_NAME_OUTPUT_SUFFIX)
+        )
+    except ClientError as client_error:
+        err = str(client_error)
+        if "Stack with id %s does not exist" % stack_name in err:
+            raise UnrecoverableException(f'Stack with id {stack_name} does not exist. Create the service using `create_service` command.')
+        else:
+            raise UnrecoverableException(str(client_error))
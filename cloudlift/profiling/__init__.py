@@ -0,0 +1,2 @@
+from .api_calls import *
+from .spans import *
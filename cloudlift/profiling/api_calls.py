@@ -0,0 +1,258 @@
+'''
+Records the botocore operations made by cloudlift clients, so a command can
+report how many AWS round trips it made and how long they took.
+'''
+
+import glob
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from terminaltables import SingleTable
+
+from cloudlift.config.logging import log_bold
+
+API_PROFILE_SPOOL_ENV = 'CLOUDLIFT_PROFILE_API_SPOOL'
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'TransactionInProgressException',
+    'RequestLimitExceeded',
+    'BandwidthLimitExceeded',
+    'LimitExceededException',
+    'RequestThrottled',
+    'SlowDown',
+    'PriorRequestNotComplete',
+    'EC2ThrottledException',
+}
+_CONTEXT_KEY = 'cloudlift_api_call'
+_COUNTERS = ('calls', 'errors', 'retries', 'throttles')
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class ApiCallRecorder(object):
+    '''
+        Collects per-operation call counts, latencies, retries and throttles
+        from botocore's event system.
+
+        Recording is switched on with enable(). The state lives in an
+        environment variable pointing at a spool directory, so deployment
+        processes started by multiprocessing record too and hand their
+        numbers back to the parent through spool().
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+        # fork hooks are Python 3.7+, on 3.6 children also report the parent's calls
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def enabled(self):
+        return API_PROFILE_SPOOL_ENV in os.environ
+
+    def enable(self):
+        if not self.enabled:
+            os.environ[API_PROFILE_SPOOL_ENV] = tempfile.mkdtemp(
+                prefix='cloudlift-api-profile-')
+
+    def instrument(self, client):
+        '''
+            Register the recording handlers on a botocore client. Clients are
+            returned untouched when profiling is not enabled.
+        '''
+        if not self.enabled:
+            return client
+        events = client.meta.events
+        events.register('before-call', self._before_call,
+                        unique_id='cloudlift-api-profile-before-call')
+        events.register('after-call', self._after_call,
+                        unique_id='cloudlift-api-profile-after-call')
+        events.register('after-call-error', self._after_call_error,
+                        unique_id='cloudlift-api-profile-after-call-error')
+        events.register('needs-retry', self._needs_retry,
+                        unique_id='cloudlift-api-profile-needs-retry')
+        return client
+
+    def spool(self):
+        '''
+            Write the calls recorded by this process to the spool directory,
+            to be merged by the process which enabled profiling.
+        '''
+        spool_dir = os.environ.get(API_PROFILE_SPOOL_ENV)
+        if not spool_dir or not os.path.isdir(spool_dir):
+            return
+        with self._lock:
+            operations = self._operations
+            self._operations = {}
+        if not operations:
+            return
+        spool_fd, _ = tempfile.mkstemp(suffix='.json', dir=spool_dir)
+        with os.fdopen(spool_fd, 'w') as spool_fp:
+            json.dump([
+                dict(stats, service=service, operation=operation)
+                for (service, operation), stats in operations.items()
+            ], spool_fp)
+
+    def summary(self):
+        '''
+            One row per operation, most expensive first. Latencies are in
+            milliseconds.
+        '''
+        self._collect_spooled()
+        rows = []
+        with self._lock:
+            for (service, operation), stats in self._operations.items():
+                latencies = sorted(stats['latencies'])
+                rows.append({
+                    'service': service,
+                    'operation': operation,
+                    'calls': stats['calls'],
+                    'errors': stats['errors'],
+                    'retries': stats['retries'],
+                    'throttles': stats['throttles'],
+                    'p50_ms': round(_percentile(latencies, 50), 1),
+                    'p90_ms': round(_percentile(latencies, 90), 1),
+                    'p99_ms': round(_percentile(latencies, 99), 1),
+                    'max_ms': round(latencies[-1], 1) if latencies else 0.0,
+                    'total_ms': round(sum(latencies), 1),
+                })
+        return sorted(rows, key=lambda row: (-row['total_ms'], -row['calls']))
+
+    def call_counts(self):
+        return {
+            '%s.%s' % (row['service'], row['operation']): row['calls']
+            for row in self.summary()
+        }
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+
+    def report(self, output_path=None):
+        '''
+            Print the summary table, or write it as JSON to output_path.
+        '''
+        rows = self.summary()
+        self._remove_spool()
+        if output_path:
+            with open(output_path, 'w') as output_fp:
+                json.dump({
+                    'total_calls': sum(row['calls'] for row in rows),
+                    'operations': rows
+                }, output_fp, indent=2)
+            log_bold("AWS API call profile written to " + output_path)
+            return
+        columns = ['service', 'operation', 'calls', 'errors', 'retries',
+                   'throttles', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'total_ms']
+        table_data = [['Service', 'Operation', 'Calls', 'Errors', 'Retries',
+                       'Throttles', 'p50 ms', 'p90 ms', 'p99 ms', 'Max ms', 'Total ms']]
+        table_data.extend([[str(row[column]) for column in columns] for row in rows])
+        log_bold("AWS API calls: %d" % sum(row['calls'] for row in rows))
+        print(SingleTable(table_data).table)
+
+    def _after_fork(self):
+        # a forked child starts with a copy of the parent's calls, which the
+        # parent reports itself
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def _stats_for(self, service, operation):
+        # callers must hold self._lock
+        if (service, operation) not in self._operations:
+            stats = {counter: 0 for counter in _COUNTERS}
+            stats['latencies'] = []
+            self._operations[(service, operation)] = stats
+        return self._operations[(service, operation)]
+
+    def _record(self, service, operation, latency, retries=0, error=False):
+        with self._lock:
+            stats = self._stats_for(service, operation)
+            stats['calls'] += 1
+            stats['retries'] += retries
+            if error:
+                stats['errors'] += 1
+            if latency is not None:
+                stats['latencies'].append(latency)
+
+    def _before_call(self, model, context=None, **kwargs):
+        if context is not None:
+            context[_CONTEXT_KEY] = (
+                model.service_model.service_name,
+                model.name,
+                time.perf_counter()
+            )
+
+    def _after_call(self, http_response, parsed, model, context=None, **kwargs):
+        # before-call is skipped when another handler (e.g. botocore's
+        # Stubber) answers the call, so the start time may be missing
+        _, _, started_at = (context or {}).get(_CONTEXT_KEY, (None, None, None))
+        latency = (time.perf_counter() - started_at) * 1000 if started_at else None
+        retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        self._record(
+            model.service_model.service_name,
+            model.name,
+            latency,
+            retries=retries,
+            error=http_response is not None and http_response.status_code >= 300
+        )
+
+    def _after_call_error(self, exception, context=None, **kwargs):
+        service, operation, started_at = (context or {}).get(
+            _CONTEXT_KEY, ('unknown', type(exception).__name__, None))
+        latency = (time.perf_counter() - started_at) * 1000 if started_at else None
+        self._record(service, operation, latency, error=True)
+
+    def _needs_retry(self, response=None, operation=None, **kwargs):
+        if response is None or operation is None:
+            return None
+        error_code = (response[1] or {}).get('Error', {}).get('Code')
+        if error_code in THROTTLING_ERROR_CODES:
+            with self._lock:
+                self._stats_for(
+                    operation.service_model.service_name,
+                    operation.name
+                )['throttles'] += 1
+        return None
+
+    def _collect_spooled(self):
+        spool_dir = os.environ.get(API_PROFILE_SPOOL_ENV)
+        if not spool_dir or not os.path.isdir(spool_dir):
+            return
+        for spool_file in glob.glob(os.path.join(spool_dir, '*.json')):
+            with open(spool_file) as spool_fp:
+                spooled_operations = json.load(spool_fp)
+            os.remove(spool_file)
+            with self._lock:
+                for spooled in spooled_operations:
+                    stats = self._stats_for(spooled['service'], spooled['operation'])
+                    for counter in _COUNTERS:
+                        stats[counter] += spooled[counter]
+                    stats['latencies'].extend(spooled['latencies'])
+
+    def _remove_spool(self):
+        spool_dir = os.environ.pop(API_PROFILE_SPOOL_ENV, None)
+        if spool_dir:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+
+api_call_recorder = ApiCallRecorder()
+
+
+def instrument_client(client):
+    return api_call_recorder.instrument(client)
+
@@ -0,0 +1,194 @@
+'''
+Lightweight span tracer for the phases of a deployment. Spans are written
+in Chrome's trace-event format, so a trace can be opened in chrome://tracing
+or Perfetto.
+'''
+
+import contextlib
+import glob
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from cloudlift.config.logging import log_bold
+
+TRACE_SPOOL_ENV = 'CLOUDLIFT_TRACE_SPOOL'
+
+
+class Tracer(object):
+    '''
+        Records timed, nested spans.
+
+        Like the API call recorder, tracing is switched on with enable(),
+        which points an environment variable at a spool directory. Work
+        handed to other threads or processes is wrapped with traced(), which
+        carries the parent span across and spools the child's spans when it
+        finishes.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+        self._events = []
+        # fork hooks are Python 3.7+, on 3.6 children also report the parent's spans
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def enabled(self):
+        return TRACE_SPOOL_ENV in os.environ
+
+    def enable(self):
+        if not self.enabled:
+            os.environ[TRACE_SPOOL_ENV] = tempfile.mkdtemp(
+                prefix='cloudlift-trace-')
+
+    def current_span_id(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def span(self, name, parent_id=None, **args):
+        '''
+            Time the enclosed block as a span called name. The span nests
+            under the current span of this thread unless parent_id is given.
+        '''
+        if not self.enabled:
+            yield
+            return
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        span_id = '%d.%d' % (os.getpid(), next(self._ids))
+        parent_id = parent_id or self.current_span_id()
+        self._local.stack.append(span_id)
+        started_at = time.time()
+        started_counter = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started_counter
+            self._local.stack.pop()
+            event_args = dict(args, span_id=span_id)
+            if parent_id:
+                event_args['parent_id'] = parent_id
+            with self._lock:
+                self._events.append({
+                    'name': name,
+                    'cat': 'cloudlift',
+                    'ph': 'X',
+                    'ts': int(started_at * 1e6),
+                    'dur': int(duration * 1e6),
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                    'args': event_args,
+                })
+
+    def traced(self, name, target, **args):
+        '''
+            Wrap target so that, when run in another thread or process, it
+            runs inside a span nested under the caller's current span.
+        '''
+        return _TracedCall(name, target, self.current_span_id(), args)
+
+    def spool(self):
+        spool_dir = os.environ.get(TRACE_SPOOL_ENV)
+        if not spool_dir or not os.path.isdir(spool_dir):
+            return
+        with self._lock:
+            events = self._events
+            self._events = []
+        if not events:
+            return
+        spool_fd, _ = tempfile.mkstemp(suffix='.json', dir=spool_dir)
+        with os.fdopen(spool_fd, 'w') as spool_fp:
+            json.dump(events, spool_fp)
+
+    def events(self):
+        self._collect_spooled()
+        with self._lock:
+            return sorted(self._events, key=lambda event: event['ts'])
+
+    def reset(self):
+        with self._lock:
+            self._events = []
+
+    def summary(self, root_name):
+        '''
+            One line with the wall time of the root span and the time spent
+            in each phase, longest first. Phases which ran more than once,
+            e.g. one rollout per ECS service, show the total and the count.
+        '''
+        events = self.events()
+        wall = sum(event['dur'] for event in events if event['name'] == root_name)
+        phases = {}
+        for event in events:
+            if event['name'] == root_name:
+                continue
+            total, count = phases.get(event['name'], (0, 0))
+            phases[event['name']] = (total + event['dur'], count + 1)
+        phase_texts = [
+            '%s %.1fs%s' % (name, total / 1e6, ' (x%d)' % count if count > 1 else '')
+            for name, (total, count) in sorted(
+                phases.items(), key=lambda phase: -phase[1][0])
+        ]
+        return '%s took %.1fs: %s' % (root_name, wall / 1e6, ', '.join(phase_texts))
+
+    def report(self, output_path, root_name):
+        '''
+            Write the Chrome trace to output_path and print the summary line.
+        '''
+        summary = self.summary(root_name)
+        with open(output_path, 'w') as output_fp:
+            json.dump({
+                'traceEvents': self.events(),
+                'displayTimeUnit': 'ms'
+            }, output_fp)
+        self._remove_spool()
+        log_bold(summary)
+        log_bold("Trace written to " + output_path)
+
+    def _after_fork(self):
+        # the open spans of the forking thread stay on the stack, so spans in
+        # the child still nest under them
+        self._lock = threading.Lock()
+        self._events = []
+
+    def _collect_spooled(self):
+        spool_dir = os.environ.get(TRACE_SPOOL_ENV)
+        if not spool_dir or not os.path.isdir(spool_dir):
+            return
+        for spool_file in glob.glob(os.path.join(spool_dir, '*.json')):
+            with open(spool_file) as spool_fp:
+                spooled_events = json.load(spool_fp)
+            os.remove(spool_file)
+            with self._lock:
+                self._events.extend(spooled_events)
+
+    def _remove_spool(self):
+        spool_dir = os.environ.pop(TRACE_SPOOL_ENV, None)
+        if spool_dir:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+
+class _TracedCall(object):
+    # a class rather than a closure so multiprocessing can pickle it
+    def __init__(self, name, target, parent_id, args):
+        self.name = name
+        self.target = target
+        self.parent_id = parent_id
+        self.args = args
+
+    def __call__(self, *args, **kwargs):
+        try:
+            with tracer.span(self.name, parent_id=self.parent_id, **self.args):
+                return self.target(*args, **kwargs)
+        finally:
+            tracer.spool()
+
+
+tracer = Tracer()
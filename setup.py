@@ -16,6 +16,9 @@ setup(
     version=VERSION,
     packages=find_packages(),
     install_requires=requirements,
+    extras_require={
+        'ssm-cache': ['cryptography'],
+    },
     description="Cloudlift makes it easier to launch dockerized services in AWS ECS",
     long_description=long_description,
     long_description_content_type="text/markdown",
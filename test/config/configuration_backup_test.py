@@ -0,0 +1,116 @@
+import json
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from mock import MagicMock, patch
+from moto import mock_dynamodb2
+
+from cloudlift.config.configuration_backup import (_batch_write_items, export_configurations,
+                                                   import_configurations)
+from cloudlift.config.dynamodb_configuration import is_conflicting_write, versioned_update
+
+
+def create_tables(client):
+    client.create_table(
+        TableName='environment_configurations',
+        KeySchema=[{'AttributeName': 'environment', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'environment', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    client.create_table(
+        TableName='service_configurations',
+        KeySchema=[
+            {'AttributeName': 'service_name', 'KeyType': 'HASH'},
+            {'AttributeName': 'environment', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'service_name', 'AttributeType': 'S'},
+            {'AttributeName': 'environment', 'AttributeType': 'S'}
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+def all_items(client, table_name):
+    return sorted(client.scan(TableName=table_name)['Items'], key=json.dumps)
+
+
+class TestConfigurationBackup(object):
+    @mock_dynamodb2
+    @patch('cloudlift.config.dynamodb_configuration.sleep')
+    def test_export_and_import(self, sleep, tmpdir):
+        client = boto3.client('dynamodb')
+        create_tables(client)
+        for environment in ['staging', 'production']:
+            client.put_item(TableName='environment_configurations', Item={
+                'environment': {'S': environment},
+                'configuration': {'M': {environment: {'M': {'region': {'S': 'ap-south-1'}}}}},
+                'config_version': {'N': '3'}
+            })
+            # more services than one batch_write_item call takes
+            for index in range(120):
+                client.put_item(TableName='service_configurations', Item={
+                    'service_name': {'S': 'service-%03d' % index},
+                    'environment': {'S': environment},
+                    'configuration': {'M': {'services': {'M': {
+                        'Web': {'M': {'memory_reservation': {'N': '512'}}}
+                    }}}}
+                })
+        environments = all_items(client, 'environment_configurations')
+        services = all_items(client, 'service_configurations')
+        backup_file = str(tmpdir.join('configs.jsonl'))
+
+        export_configurations(backup_file, segments=1)
+        client.delete_table(TableName='environment_configurations')
+        client.delete_table(TableName='service_configurations')
+        import_configurations(backup_file, assume_yes=True)
+
+        assert len(open(backup_file).readlines()) == 242
+        # imported items move on to a version no one has read yet
+        assert all_items(client, 'environment_configurations') == \
+            [dict(item, config_version={'N': '4'}) for item in environments]
+        assert all_items(client, 'service_configurations') == \
+            [dict(item, config_version={'N': '1'}) for item in services]
+
+    @mock_dynamodb2
+    @patch('cloudlift.config.dynamodb_configuration.sleep')
+    def test_import_moves_past_the_replaced_version(self, sleep, tmpdir):
+        client = boto3.client('dynamodb')
+        create_tables(client)
+        backup_file = tmpdir.join('configs.jsonl')
+        backup_file.write(json.dumps({'table': 'environment_configurations', 'item': {
+            'environment': {'S': 'staging'},
+            'configuration': {'M': {'staging': {'M': {'region': {'S': 'ap-south-1'}}}}},
+            'config_version': {'N': '3'}
+        }}) + '\n')
+        client.put_item(TableName='environment_configurations', Item={
+            'environment': {'S': 'staging'},
+            'configuration': {'M': {'staging': {'M': {'region': {'S': 'eu-west-1'}}}}},
+            'config_version': {'N': '7'}
+        })
+
+        import_configurations(str(backup_file), assume_yes=True)
+
+        table = boto3.resource('dynamodb').Table('environment_configurations')
+        for stale_version in (3, 7):
+            with pytest.raises(ClientError) as error:
+                versioned_update(table, {'environment': 'staging'}, {}, stale_version)
+            assert is_conflicting_write(error.value)
+        assert table.get_item(Key={'environment': 'staging'})['Item']['config_version'] == 8
+
+    @patch('cloudlift.config.configuration_backup.sleep')
+    def test_batch_write_retries_unprocessed_items(self, sleep):
+        items = [{'environment': {'S': 'staging'}}, {'environment': {'S': 'production'}}]
+        unprocessed = {'environment_configurations': [{'PutRequest': {'Item': items[1]}}]}
+        client = MagicMock()
+        client.batch_write_item.side_effect = [
+            {'UnprocessedItems': unprocessed},
+            {'UnprocessedItems': {}}
+        ]
+
+        _batch_write_items(client, 'environment_configurations', items)
+
+        assert client.batch_write_item.call_count == 2
+        assert client.batch_write_item.call_args[1] == {'RequestItems': unprocessed}
+        assert sleep.call_count == 1
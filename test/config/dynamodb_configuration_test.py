@@ -0,0 +1,61 @@
+import threading
+
+import boto3
+from moto import mock_dynamodb2
+
+from cloudlift.config.dynamodb_configuration import deserialize_item, scan_items
+
+
+class FakeSegmentedScanClient(object):
+    '''
+        moto ignores Segment, so parallel scans are checked against a client
+        which splits the items by segment and pages them two at a time.
+    '''
+
+    def __init__(self, items):
+        self.items = items
+        self.scanned_segments = []
+        self.threads = set()
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, TableName, Segment, TotalSegments, **kwargs):
+        self.scanned_segments.append(Segment)
+        self.threads.add(threading.current_thread().name)
+        segment_items = self.items[Segment::TotalSegments]
+        for start in range(0, len(segment_items), 2):
+            yield {'Items': segment_items[start:start + 2]}
+
+
+class TestScanItems(object):
+    @mock_dynamodb2
+    def test_follows_last_evaluated_key(self):
+        client = boto3.client('dynamodb')
+        client.create_table(
+            TableName='environment_configurations',
+            KeySchema=[{'AttributeName': 'environment', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'environment', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        for index in range(25):
+            client.put_item(
+                TableName='environment_configurations',
+                Item={'environment': {'S': 'environment-%02d' % index}}
+            )
+
+        items = scan_items(client, 'environment_configurations', Limit=10)
+
+        assert sorted(deserialize_item(item)['environment'] for item in items) == \
+            ['environment-%02d' % index for index in range(25)]
+
+    def test_scans_segments_in_parallel(self):
+        items = [{'environment': {'S': 'environment-%02d' % index}} for index in range(10)]
+        client = FakeSegmentedScanClient(items)
+
+        scanned_items = scan_items(client, 'environment_configurations', segments=4)
+
+        assert sorted(client.scanned_segments) == [0, 1, 2, 3]
+        assert 'MainThread' not in client.threads
+        assert sorted(item['environment']['S'] for item in scanned_items) == \
+            sorted(item['environment']['S'] for item in items)
@@ -1,7 +1,10 @@
 import boto3
+import pytest
+from mock import patch
 from moto import mock_dynamodb2
 
 from cloudlift.config import EnvironmentConfiguration
+from cloudlift.exceptions import UnrecoverableException
 
 
 class TestEnvironmentConfiguration(object):
@@ -240,3 +243,74 @@ class TestEnvironmentConfiguration(object):
                 }
             }
         }
+
+    @mock_dynamodb2
+    @patch('cloudlift.config.environment_configuration.check_sns_topic_exists')
+    def test_set_config_merges_concurrent_changes(self, check_sns_topic_exists):
+        self.setup_existing_params()
+        first_editor = EnvironmentConfiguration('dummy-staging')
+        second_editor = EnvironmentConfiguration('dummy-staging')
+        first_config = first_editor.get_config(for_update=True)
+        second_config = second_editor.get_config(for_update=True)
+
+        first_config["dummy-staging"]["cluster"]["min_instances"] = 1
+        first_editor._set_config(first_config)
+        second_config["dummy-staging"]["cluster"]["instance_type"] = "t2.large"
+        with patch('cloudlift.config.utils.confirm', return_value=True) as confirm:
+            second_editor._set_config(second_config)
+
+        confirm.assert_called_once_with('Do you want to save the merged config?')
+        cluster = EnvironmentConfiguration('dummy-staging').get_config()["dummy-staging"]["cluster"]
+        assert cluster["min_instances"] == 1
+        assert cluster["instance_type"] == "t2.large"
+        assert second_editor.config_version == 2
+
+    @mock_dynamodb2
+    @patch('cloudlift.config.environment_configuration.check_sns_topic_exists')
+    def test_set_config_keeps_conflicting_changes_unless_confirmed(self, check_sns_topic_exists):
+        self.setup_existing_params()
+        first_editor = EnvironmentConfiguration('dummy-staging')
+        second_editor = EnvironmentConfiguration('dummy-staging')
+        first_config = first_editor.get_config(for_update=True)
+        second_config = second_editor.get_config(for_update=True)
+
+        first_config["dummy-staging"]["cluster"]["instance_type"] = "t2.medium"
+        first_editor._set_config(first_config)
+        second_config["dummy-staging"]["cluster"]["instance_type"] = "t2.large"
+        with patch('cloudlift.config.utils.confirm', return_value=False) as confirm:
+            second_editor._set_config(second_config)
+
+        confirm.assert_called_once_with('Do you want to overwrite their changes with yours?')
+        cluster = EnvironmentConfiguration('dummy-staging').get_config()["dummy-staging"]["cluster"]
+        assert cluster["instance_type"] == "t2.medium"
+
+    @mock_dynamodb2
+    def test_get_all_environments_reads_every_page(self):
+        self.setup_existing_params()
+        table = boto3.resource('dynamodb').Table('environment_configurations')
+        for index in range(30):
+            table.put_item(Item={'environment': 'environment-%02d' % index})
+
+        environments = EnvironmentConfiguration('dummy-staging').get_all_environments()
+
+        assert len(environments) == 32
+        assert environments[:3] == ['dummy-staging', 'environment-00', 'environment-01']
+
+    @mock_dynamodb2
+    def test_validates_capacity_providers_after_the_schema(self):
+        self.setup_existing_params()
+        store_object = EnvironmentConfiguration('dummy-staging')
+        config = store_object.get_config()
+        cluster = config["dummy-staging"]["cluster"]
+        store_object._validate_changes(config)
+
+        cluster["capacity_providers"] = {"minimum_scaling_step_size": 5, "maximum_scaling_step_size": 2}
+        with pytest.raises(UnrecoverableException) as error:
+            store_object._validate_changes(config)
+        assert error.value.value.startswith('cluster.capacity_providers.minimum_scaling_step_size')
+
+        for capacity_providers in ["enabled", {"minimum_scaling_step_size": "5"}]:
+            cluster["capacity_providers"] = capacity_providers
+            with pytest.raises(UnrecoverableException) as error:
+                store_object._validate_changes(config)
+            assert not error.value.value.startswith('cluster.capacity_providers.minimum_scaling_step_size')
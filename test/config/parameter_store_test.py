@@ -1,8 +1,16 @@
+import os
+import threading
+
 import boto3
 import pytest
+from botocore.exceptions import ClientError
+from mock import MagicMock, patch
 from moto import mock_dynamodb2, mock_ssm
 
 from cloudlift.config import ParameterStore
+from cloudlift.config.parameter_cache import (SSM_CACHE_ENV, SSM_CACHE_KEY_FILE,
+                                              EncryptedParameterCache)
+from cloudlift.config.parameter_store import AdaptiveTokenBucket
 from cloudlift.exceptions import UnrecoverableException
 
 class TestParameterStore(object):
@@ -142,3 +150,182 @@ class TestParameterStore(object):
         assert pytest_wrapped_e.value.code == 1
         response = store_object.get_existing_config()
         assert response == {u'DUMMY_VAR12': u'dummy_values_12', u'DUMMY_VAR11': u'dummy_values_11', u'DUMMY_VAR8': u'dummy_values_8', u'DUMMY_VAR9': u'dummy_values_9', u'DUMMY_VAR0': u'dummy_values_0', u'DUMMY_VAR1': u'dummy_values_1', u'DUMMY_VAR2': u'dummy_values_2', u'DUMMY_VAR3': u'dummy_values_3', u'DUMMY_VAR4': u'dummy_values_4', u'DUMMY_VAR5': u'dummy_values_5', u'DUMMY_VAR6': u'dummy_values_6', u'DUMMY_VAR7': u'dummy_values_7', u'DUMMY_VAR13': u'dummy_values_13', u'DUMMY_VAR10': u'dummy_values_10'}
+
+
+def throttling_error():
+    return ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+                       'PutParameter')
+
+
+@pytest.fixture
+def ssm_client():
+    with patch('cloudlift.config.parameter_store.get_client_for') as get_client_for:
+        yield get_client_for.return_value
+
+
+class TestParameterStoreBulkWrites(object):
+    def test_puts_in_parallel_and_deletes_in_batches_of_ten(self, ssm_client):
+        threads = set()
+        ssm_client.put_parameter.side_effect = lambda **kwargs: threads.add(threading.current_thread().name)
+        ssm_client.delete_parameters.return_value = {'InvalidParameters': []}
+        differences = [
+            ['add', '', [('VAR%02d' % index, 'value') for index in range(30)]],
+            ['remove', '', [('OLD%02d' % index, 'value') for index in range(25)]]
+        ]
+
+        with patch.object(AdaptiveTokenBucket, 'acquire'):
+            report = ParameterStore('test-service', 'dummy-staging').set_config(differences)
+
+        assert ssm_client.put_parameter.call_count == 30
+        assert 'MainThread' not in threads
+        assert [len(call[1]['Names']) for call in ssm_client.delete_parameters.call_args_list] == [10, 10, 5]
+        assert report['VAR00'] == 'added' and report['OLD24'] == 'removed'
+
+    def test_retries_throttled_puts_and_reports_failures(self, ssm_client):
+        ssm_client.put_parameter.side_effect = [
+            throttling_error(),
+            ClientError({'Error': {'Code': 'ParameterAlreadyExists', 'Message': 'Exists'}}, 'PutParameter'),
+        ]
+        ssm_client.delete_parameters.return_value = {'InvalidParameters': ['/dummy-staging/test-service/OLD']}
+        differences = [
+            ['add', '', [('VAR', 'value')]],
+            ['remove', '', [('OLD', 'value')]]
+        ]
+
+        with patch.object(AdaptiveTokenBucket, 'acquire'), \
+                pytest.raises(UnrecoverableException) as error:
+            ParameterStore('test-service', 'dummy-staging').set_config(differences)
+
+        assert ssm_client.put_parameter.call_count == 2
+        assert error.value.value == '2 of 2 parameter changes failed.'
+
+    def test_dry_run_writes_nothing(self, ssm_client):
+        differences = [
+            ['change', 'VAR', ('old', 'new')],
+            ['remove', '', [('OLD', 'value')]]
+        ]
+
+        report = ParameterStore('test-service', 'dummy-staging').set_config(differences, dry_run=True)
+
+        assert report == {'VAR': 'changed', 'OLD': 'removed'}
+        ssm_client.put_parameter.assert_not_called()
+        ssm_client.delete_parameters.assert_not_called()
+
+
+class TestAdaptiveTokenBucket(object):
+    def test_paces_calls_and_slows_down_when_throttled(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        bucket = AdaptiveTokenBucket(2, 0.5, 4, clock=lambda: now[0], sleep=sleep)
+        for _ in range(3):
+            bucket.acquire()
+        bucket.throttled()
+        bucket.acquire()
+
+        assert sleeps == [pytest.approx(0.5), pytest.approx(1.0)]
+        assert bucket.rate == 1
+        bucket.succeeded()
+        assert bucket.rate == 1.5
+
+
+@pytest.fixture
+def parameter_cache_dir(tmpdir, monkeypatch):
+    monkeypatch.setenv(SSM_CACHE_ENV, '1')
+    monkeypatch.setattr('cloudlift.config.parameter_cache.SSM_CACHE_DIR', str(tmpdir))
+    return tmpdir
+
+
+class TestParameterStoreCache(object):
+    @mock_ssm
+    def test_downloads_only_changed_parameters(self, parameter_cache_dir):
+        client = boto3.client('ssm')
+        for index in range(12):
+            client.put_parameter(Name='/dummy-staging/test-service/VAR%02d' % index,
+                                 Value='secret_%02d' % index, Type='SecureString')
+        client.put_parameter(Name='/dummy-staging/other-service/VAR', Value='other', Type='SecureString')
+        get_parameters = MagicMock(wraps=client.get_parameters)
+        client.get_parameters = get_parameters
+
+        with patch('cloudlift.config.parameter_store.get_client_for', return_value=client):
+            store_object = ParameterStore('test-service', 'dummy-staging')
+            first_config, first_paths = store_object.get_existing_config()
+            first_fetches = get_parameters.call_count
+
+            client.put_parameter(Name='/dummy-staging/test-service/VAR03', Value='rotated',
+                                 Type='SecureString', Overwrite=True)
+            client.delete_parameter(Name='/dummy-staging/test-service/VAR11')
+            second_config, second_paths = store_object.get_existing_config()
+
+        assert first_fetches == 2
+        assert get_parameters.call_args[1]['Names'] == ['/dummy-staging/test-service/VAR03']
+        assert first_config == {'VAR%02d' % index: 'secret_%02d' % index for index in range(12)}
+        assert first_paths['VAR00'].endswith(':parameter/dummy-staging/test-service/VAR00')
+        assert second_config['VAR03'] == 'rotated'
+        assert 'VAR11' not in second_config and len(second_config) == 11
+        for cache_file in parameter_cache_dir.listdir():
+            assert b'secret_' not in cache_file.read_binary()
+
+    @mock_ssm
+    def test_drops_parameters_deleted_while_reading(self, parameter_cache_dir):
+        client = boto3.client('ssm')
+        for name in ('VAR', 'GONE'):
+            client.put_parameter(Name='/dummy-staging/test-service/' + name,
+                                 Value='old', Type='SecureString')
+        get_parameters = client.get_parameters
+
+        with patch('cloudlift.config.parameter_store.get_client_for', return_value=client):
+            store_object = ParameterStore('test-service', 'dummy-staging')
+            store_object.get_existing_config()
+            client.put_parameter(Name='/dummy-staging/test-service/GONE', Value='new',
+                                 Type='SecureString', Overwrite=True)
+
+            def delete_then_get(**kwargs):
+                client.delete_parameter(Name='/dummy-staging/test-service/GONE')
+                return get_parameters(**kwargs)
+            client.get_parameters = delete_then_get
+            config, paths = store_object.get_existing_config()
+
+        assert config == {'VAR': 'old'}
+        assert set(paths) == {'VAR'}
+
+    @mock_ssm
+    def test_needs_cryptography(self, parameter_cache_dir):
+        with patch('cloudlift.config.parameter_store.get_client_for', return_value=boto3.client('ssm')), \
+                patch.dict('sys.modules', {'cryptography.fernet': None}), \
+                pytest.raises(UnrecoverableException) as error:
+            ParameterStore('test-service', 'dummy-staging').get_existing_config()
+
+        assert 'pip install cloudlift[ssm-cache]' in error.value.value
+
+    def test_replaces_an_unusable_key(self, parameter_cache_dir):
+        parameter_cache_dir.join(SSM_CACHE_KEY_FILE).write_binary(b'')
+
+        cache = EncryptedParameterCache('dummy-staging/test-service')
+        cache.save({'VAR': 'value'})
+
+        assert len(parameter_cache_dir.join(SSM_CACHE_KEY_FILE).read_binary()) == 44
+        assert EncryptedParameterCache('dummy-staging/test-service').load() == {'VAR': 'value'}
+        assert len(parameter_cache_dir.listdir()) == 2
+
+    def test_uses_the_key_published_by_another_process(self, parameter_cache_dir):
+        from cryptography.fernet import Fernet
+        published_key = Fernet.generate_key()
+        real_link = os.link
+
+        def link_after_other_process(source, destination):
+            parameter_cache_dir.join(SSM_CACHE_KEY_FILE).write_binary(published_key)
+            real_link(source, destination)
+
+        with patch('cloudlift.config.parameter_cache.os.link', side_effect=link_after_other_process):
+            cache = EncryptedParameterCache('dummy-staging/test-service')
+        cache.save({'VAR': 'value'})
+
+        assert parameter_cache_dir.join(SSM_CACHE_KEY_FILE).read_binary() == published_key
+        assert Fernet(published_key).decrypt(
+            parameter_cache_dir.join(os.path.basename(cache.cache_file)).read_binary()) == b'{"VAR": "value"}'
+        assert len(parameter_cache_dir.listdir()) == 2
@@ -0,0 +1,132 @@
+import threading
+
+import boto3
+import pytest
+from mock import patch
+from moto import mock_ec2, mock_sns
+
+from cloudlift.config.pre_flight import (PREFLIGHT_CACHE_TTL_ENV, PreflightCache,
+                                         check_aws_instance_type, check_sns_topic_exists,
+                                         run_preflight_checks)
+from cloudlift.exceptions import UnrecoverableException
+
+
+@pytest.fixture
+def preflight_cache(tmpdir, monkeypatch):
+    cache = PreflightCache(cache_file=str(tmpdir.join('preflight_cache.json')))
+    monkeypatch.setattr('cloudlift.config.pre_flight.preflight_cache', cache)
+    monkeypatch.delenv(PREFLIGHT_CACHE_TTL_ENV, raising=False)
+    monkeypatch.setattr('cloudlift.config.pre_flight.get_account_id', lambda: '123456789012')
+    return cache
+
+
+class TestCheckSnsTopicExists(object):
+    @mock_sns
+    def test_looks_up_topic_in_its_own_region(self, preflight_cache):
+        topic_arn = boto3.client('sns', region_name='eu-west-1').create_topic(
+            Name='staging-alerts')['TopicArn']
+
+        # the default session is ap-south-1, where the topic does not exist
+        assert check_sns_topic_exists(topic_arn, 'staging')
+
+    @mock_sns
+    def test_caches_topics_found(self, preflight_cache):
+        topic_arn = boto3.client('sns', region_name='eu-west-1').create_topic(
+            Name='staging-alerts')['TopicArn']
+        check_sns_topic_exists(topic_arn, 'staging')
+
+        with patch('cloudlift.config.pre_flight.boto3') as boto3_mock:
+            assert check_sns_topic_exists(topic_arn, 'staging')
+
+        boto3_mock.session.Session.assert_not_called()
+
+    @mock_sns
+    def test_does_not_cache_missing_topics(self, preflight_cache):
+        topic_arn = 'arn:aws:sns:eu-west-1:123456789012:staging-alerts'
+        with pytest.raises(UnrecoverableException):
+            check_sns_topic_exists(topic_arn, 'staging')
+
+        boto3.client('sns', region_name='eu-west-1').create_topic(Name='staging-alerts')
+
+        assert check_sns_topic_exists(topic_arn, 'staging')
+
+
+class TestPreflightCache(object):
+    def test_persists_passed_checks_for_ttl(self, preflight_cache, monkeypatch):
+        monkeypatch.setenv(PREFLIGHT_CACHE_TTL_ENV, '60')
+        preflight_cache.remember('sns-topic', 'arn')
+        reloaded_cache = PreflightCache(cache_file=preflight_cache.cache_file)
+
+        assert reloaded_cache.passed('sns-topic', 'arn')
+        with patch('cloudlift.config.pre_flight.time.time', return_value=2 ** 40):
+            assert not PreflightCache(cache_file=preflight_cache.cache_file).passed('sns-topic', 'arn')
+
+    def test_keeps_checks_in_memory_without_ttl(self, preflight_cache):
+        preflight_cache.remember('sns-topic', 'arn')
+
+        assert preflight_cache.passed('sns-topic', 'arn')
+        assert not PreflightCache(cache_file=preflight_cache.cache_file).passed('sns-topic', 'arn')
+
+    def test_keeps_checks_per_account(self, preflight_cache, monkeypatch):
+        monkeypatch.setenv(PREFLIGHT_CACHE_TTL_ENV, '60')
+        preflight_cache.remember('sns-topic', 'arn')
+        monkeypatch.setattr('cloudlift.config.pre_flight.get_account_id', lambda: '210987654321')
+
+        assert not preflight_cache.passed('sns-topic', 'arn')
+        assert not PreflightCache(cache_file=preflight_cache.cache_file).passed('sns-topic', 'arn')
+
+
+class TestCheckAwsInstanceType(object):
+    def test_rejects_malformed_instance_types(self, preflight_cache):
+        assert check_aws_instance_type('t2.micro,m5.hugeish') == (False, 'm5.hugeish')
+
+    @mock_ec2
+    def test_checks_instance_types_are_offered_in_region(self, preflight_cache):
+        assert check_aws_instance_type('t2.micro,m5.xlarge', 'us-east-1') == (True, '')
+        with patch('cloudlift.config.pre_flight._instance_types_offered') as instance_types_offered:
+            assert check_aws_instance_type('t2.micro,m5.xlarge', 'us-east-1') == (True, '')
+
+        instance_types_offered.assert_not_called()
+
+
+class TestRunPreflightChecks(object):
+    def test_runs_checks_concurrently(self):
+        # each check waits for the other, so they only finish if run together
+        barrier = threading.Barrier(2, timeout=5)
+
+        def check(result):
+            barrier.wait()
+            return result
+
+        results = run_preflight_checks({
+            'stack': lambda: check('stack'),
+            'config': lambda: check('config'),
+        })
+
+        assert results == {'stack': 'stack', 'config': 'config'}
+
+    def test_reports_all_failures(self):
+        def fail(message):
+            raise UnrecoverableException(message)
+
+        with pytest.raises(UnrecoverableException) as error:
+            run_preflight_checks({
+                'stack': lambda: fail('stack missing'),
+                'config': lambda: 'config',
+                'topic': lambda: fail('topic missing'),
+            })
+
+        assert error.value.value.splitlines() == [
+            '2 pre-flight checks failed:',
+            '  - stack: stack missing',
+            '  - topic: topic missing',
+        ]
+
+    def test_keeps_message_of_single_failure(self):
+        def fail():
+            raise UnrecoverableException('stack missing')
+
+        with pytest.raises(UnrecoverableException) as error:
+            run_preflight_checks({'stack': fail, 'config': lambda: 'config'})
+
+        assert error.value.value == 'stack missing'
@@ -1,7 +1,10 @@
 import boto3
+import pytest
+from mock import patch
 from moto import mock_dynamodb2
 
 from cloudlift.config import ServiceConfiguration
+from cloudlift.exceptions import UnrecoverableException
 from cloudlift.version import VERSION
 
 
@@ -113,3 +116,208 @@ class TestServiceConfiguration(object):
                         }
                     }
                 }
+
+
+class TestServiceConfigurationVersionStamp(object):
+    def setup_service(self, cloudlift_version):
+        TestServiceConfiguration().setup_existing_params()
+        boto3.resource('dynamodb').Table('service_configurations').update_item(
+            Key={'service_name': 'test-service', 'environment': 'dummy-staging'},
+            UpdateExpression='SET configuration.cloudlift_version = :cloudlift_version',
+            ExpressionAttributeValues={':cloudlift_version': cloudlift_version}
+        )
+        with patch('cloudlift.config.service_configuration.EnvironmentConfiguration'), \
+                patch('cloudlift.config.service_configuration.get_resource_for'):
+            return ServiceConfiguration('test-service', 'dummy-staging')
+
+    def stored_configuration(self):
+        return boto3.resource('dynamodb').Table('service_configurations').get_item(
+            Key={'service_name': 'test-service', 'environment': 'dummy-staging'}
+        )['Item']['configuration']
+
+    @mock_dynamodb2
+    @patch('cloudlift.config.service_configuration.check_sns_topic_exists')
+    def test_update_cloudlift_version_writes_only_the_version(self, check_sns_topic_exists):
+        store_object = self.setup_service('0.0.1')
+        configuration = store_object.get_config(VERSION, for_update=True)
+
+        store_object.update_cloudlift_version()
+
+        stored_configuration = self.stored_configuration()
+        assert stored_configuration.pop('cloudlift_version') == VERSION
+        assert stored_configuration == configuration
+        check_sns_topic_exists.assert_not_called()
+
+    @mock_dynamodb2
+    def test_update_cloudlift_version_refuses_newer_concurrent_version(self):
+        store_object = self.setup_service('0.0.1')
+        store_object.get_config(VERSION, for_update=True)
+        boto3.resource('dynamodb').Table('service_configurations').update_item(
+            Key={'service_name': 'test-service', 'environment': 'dummy-staging'},
+            UpdateExpression='SET configuration.cloudlift_version = :cloudlift_version',
+            ExpressionAttributeValues={':cloudlift_version': '999.0.0'}
+        )
+
+        with pytest.raises(UnrecoverableException):
+            store_object.update_cloudlift_version()
+
+        assert self.stored_configuration()['cloudlift_version'] == '999.0.0'
+
+
+class TestServiceConfigurationDeploymentSettings(object):
+    @mock_dynamodb2
+    def test_grace_period_needs_an_http_interface(self):
+        store_object = TestServiceConfigurationVersionStamp().setup_service(VERSION)
+        configuration = {
+            'cloudlift_version': VERSION,
+            'notifications_arn': 'arn:aws:sns:ap-south-1:123456789012:notifications',
+            'services': {
+                'TestService': {
+                    'memory_reservation': 1000,
+                    'command': None,
+                    'deployment': {
+                        'maximum_percent': 150,
+                        'circuit_breaker': {'enable': True, 'rollback': True},
+                        'health_check_grace_period_seconds': 60,
+                    }
+                }
+            }
+        }
+
+        with pytest.raises(UnrecoverableException) as error:
+            store_object._validate_changes(configuration)
+        assert error.value.value.startswith(
+            'deployment.health_check_grace_period_seconds needs an http_interface')
+
+        configuration['services']['TestService']['http_interface'] = {
+            'internal': True, 'container_port': 80, 'restrict_access_to': ['0.0.0.0/0']}
+        store_object._validate_changes(configuration)
+
+        configuration['services']['TestService']['deployment']['maximum_percent'] = 50
+        with pytest.raises(UnrecoverableException):
+            store_object._validate_changes(configuration)
+
+        configuration['services']['TestService']['deployment'] = 5
+        with pytest.raises(UnrecoverableException):
+            store_object._validate_changes(configuration)
+
+
+class TestServiceConfigurationAutoscaling(object):
+    @mock_dynamodb2
+    def test_validates_autoscaling(self):
+        store_object = TestServiceConfigurationVersionStamp().setup_service(VERSION)
+        autoscaling = {
+            'min_capacity': 2,
+            'max_capacity': 10,
+            'target_tracking': [{'metric': 'cpu', 'target': 60}],
+            'sqs_step_scaling': {
+                'queue_name': 'test-jobs',
+                'scale_out_steps': [{'messages': 100, 'adjustment': 1},
+                                    {'messages': 1000, 'adjustment': 5}],
+            }
+        }
+        configuration = {
+            'cloudlift_version': VERSION,
+            'notifications_arn': 'arn:aws:sns:ap-south-1:123456789012:notifications',
+            'services': {
+                'TestService': {
+                    'memory_reservation': 1000,
+                    'command': None,
+                    'autoscaling': autoscaling,
+                }
+            }
+        }
+        store_object._validate_changes(configuration)
+
+        autoscaling['min_capacity'] = 11
+        with pytest.raises(UnrecoverableException) as error:
+            store_object._validate_changes(configuration)
+        assert error.value.value == 'autoscaling.min_capacity is more than autoscaling.max_capacity.'
+
+        autoscaling['min_capacity'] = 2
+        autoscaling['target_tracking'].append({'metric': 'alb_request_count', 'target': 500})
+        with pytest.raises(UnrecoverableException) as error:
+            store_object._validate_changes(configuration)
+        assert error.value.value == 'autoscaling on alb_request_count needs an http_interface.'
+
+        autoscaling['target_tracking'] = [{'metric': 'cpu', 'target': 60}, {'metric': 'cpu', 'target': 80}]
+        with pytest.raises(UnrecoverableException) as error:
+            store_object._validate_changes(configuration)
+        assert error.value.value == 'autoscaling.target_tracking repeats a metric other than custom.'
+
+        autoscaling['target_tracking'] = [{'metric': 'cpu', 'target': 0}]
+        with pytest.raises(UnrecoverableException):
+            store_object._validate_changes(configuration)
+
+    @mock_dynamodb2
+    @pytest.mark.parametrize('autoscaling', [
+        'x',
+        {'min_capacity': '2', 'max_capacity': '10'},
+        {'min_capacity': 2, 'max_capacity': 10, 'target_tracking': ['cpu']},
+        {'min_capacity': 2, 'max_capacity': 10, 'sqs_step_scaling': 'test-jobs'},
+    ])
+    def test_rejects_malformed_autoscaling(self, autoscaling):
+        store_object = TestServiceConfigurationVersionStamp().setup_service(VERSION)
+        configuration = {
+            'cloudlift_version': VERSION,
+            'notifications_arn': 'arn:aws:sns:ap-south-1:123456789012:notifications',
+            'services': {
+                'TestService': {'memory_reservation': 1000, 'command': None, 'autoscaling': autoscaling}
+            }
+        }
+
+        with pytest.raises(UnrecoverableException):
+            store_object._validate_changes(configuration)
+
+
+class TestServiceConfigurationPlacement(object):
+    @mock_dynamodb2
+    def test_validates_placement(self):
+        store_object = TestServiceConfigurationVersionStamp().setup_service(VERSION)
+        placement = {
+            'strategies': [{'type': 'binpack', 'field': 'memory'}],
+            'constraints': [{'type': 'distinctInstance'}],
+        }
+        service = {'memory_reservation': 1000, 'command': None, 'placement': placement}
+        configuration = {
+            'cloudlift_version': VERSION,
+            'notifications_arn': 'arn:aws:sns:ap-south-1:123456789012:notifications',
+            'services': {'TestService': service}
+        }
+        store_object._validate_changes(configuration)
+
+        placement['strategies'] = [{'type': 'binpack', 'field': 'instanceId'}]
+        with pytest.raises(UnrecoverableException) as error:
+            store_object._validate_changes(configuration)
+        assert error.value.value == 'placement.strategies: binpack needs a field of memory or cpu.'
+
+        placement['strategies'] = [{'type': 'random'}]
+        placement['constraints'] = [{'type': 'memberOf'}]
+        with pytest.raises(UnrecoverableException) as error:
+            store_object._validate_changes(configuration)
+        assert error.value.value == 'placement.constraints: memberOf needs an expression.'
+
+        placement['constraints'] = []
+        service['fargate'] = {'cpu': 256, 'memory': 512}
+        with pytest.raises(UnrecoverableException) as error:
+            store_object._validate_changes(configuration)
+        assert error.value.value.startswith('placement is not supported on fargate')
+
+    @mock_dynamodb2
+    @pytest.mark.parametrize('placement', [
+        'binpack',
+        {'strategies': ['binpack']},
+        {'constraints': [{'type': 'memberOf', 'expression': 7}]},
+    ])
+    def test_rejects_malformed_placement(self, placement):
+        store_object = TestServiceConfigurationVersionStamp().setup_service(VERSION)
+        configuration = {
+            'cloudlift_version': VERSION,
+            'notifications_arn': 'arn:aws:sns:ap-south-1:123456789012:notifications',
+            'services': {
+                'TestService': {'memory_reservation': 1000, 'command': None, 'placement': placement}
+            }
+        }
+
+        with pytest.raises(UnrecoverableException):
+            store_object._validate_changes(configuration)
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+from mock import patch
+
+from cloudlift.config.service_configuration import _service_configuration_validator
+from cloudlift.config.utils import ConfigUtils, validate_configuration
+from cloudlift.exceptions import UnrecoverableException
+from cloudlift.version import VERSION
+
+
+def invalid_service_configuration():
+    return {
+        "cloudlift_version": VERSION,
+        "notifications_arn": "arn:aws:sns:us-west-2:123456789012:team",
+        "services": {
+            "Dummy": {
+                "memory_reservation": 5,
+                "command": None,
+                "sidecars": [{"name": "statsd"}]
+            }
+        }
+    }
+
+
+def validate_service_configuration(configuration, collect_all_errors=False):
+    validate_configuration(
+        _service_configuration_validator(),
+        configuration,
+        collect_all_errors=collect_all_errors
+    )
+
+
+class TestValidateConfiguration(object):
+    def test_reports_first_error_by_default(self):
+        with pytest.raises(UnrecoverableException) as error:
+            validate_service_configuration(invalid_service_configuration())
+
+        assert error.value.value == \
+            "5 is less than the minimum of 10 in services.Dummy.memory_reservation"
+
+    def test_collects_all_errors(self):
+        with pytest.raises(UnrecoverableException) as error:
+            validate_service_configuration(invalid_service_configuration(), collect_all_errors=True)
+
+        assert error.value.value.splitlines() == [
+            "5 schema errors:",
+            "  - 5 is less than the minimum of 10 in services.Dummy.memory_reservation",
+            "  - 'image_uri' is a required property in services.Dummy.sidecars.0",
+            "  - 'memory_reservation' is a required property in services.Dummy.sidecars.0",
+            "  - 'essential' is a required property in services.Dummy.sidecars.0",
+            "  - 'statsd' does not match '.*-sidecar$' in services.Dummy.sidecars.0.name",
+        ]
+
+
+class TestConfigUtils(object):
+    def test_edit_reports_all_errors_and_keeps_configuration(self, capsys):
+        configuration = invalid_service_configuration()
+        del configuration['cloudlift_version']
+        edited = json.dumps(configuration)
+
+        with patch('cloudlift.config.utils.edit', return_value=edited), \
+                patch('cloudlift.config.utils.confirm', return_value=False):
+            updated_configuration = ConfigUtils(
+                changes_validation_function=validate_service_configuration
+            ).fault_tolerant_edit_config(configuration, inject_version=True)
+
+        assert updated_configuration is None
+        assert '5 schema errors' in capsys.readouterr().out
+        assert 'cloudlift_version' not in configuration
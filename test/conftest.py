@@ -5,6 +5,14 @@ def pytest_addoption(parser):
     parser.addoption(
         "--keep-resources", action="store_true", default=False, help="my option: type1 or type2"
     )
+    parser.addoption(
+        "--update-api-call-budget", action="store_true", default=False,
+        help="rewrite test/performance/api_call_budget.json with the calls made"
+    )
+    parser.addoption(
+        "--benchmark-runs", action="store", type=int, default=0,
+        help="number of timed runs per performance scenario"
+    )
 
 
 @pytest.fixture
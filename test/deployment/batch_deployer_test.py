@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+from collections import defaultdict
+
+import pytest
+from mock import MagicMock, patch
+
+from cloudlift.deployment.batch_deployer import BatchDeployer
+from cloudlift.exceptions import UnrecoverableException
+
+MODULE = 'cloudlift.deployment.batch_deployer'
+
+
+class RolloutRecorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = defaultdict(int)
+        self.most_running = defaultdict(int)
+        self.rollouts = []
+
+    def deploy_new_version(self, region, cluster_name, ecs_service_name, version,
+                           name, env_sample_file, environment, color, image_url, env_config):
+        with self.lock:
+            self.running[cluster_name] += 1
+            self.most_running[cluster_name] = max(self.most_running[cluster_name],
+                                                  self.running[cluster_name])
+            self.rollouts.append((ecs_service_name, image_url, env_config))
+        time.sleep(0.05)
+        with self.lock:
+            self.running[cluster_name] -= 1
+        return True
+
+
+@pytest.fixture
+def write_manifest(tmpdir):
+    tmpdir.join('env.sample').write('VAR1=\n')
+
+    def write_manifest(entries):
+        for entry in entries:
+            entry.setdefault('env_sample', str(tmpdir.join('env.sample')))
+        manifest = tmpdir.join('manifest.json')
+        manifest.write(json.dumps(entries))
+        return str(manifest)
+    return write_manifest
+
+
+@pytest.fixture
+def stubbed_aws():
+    recorder = RolloutRecorder()
+    ecr_client = MagicMock()
+    ecr_client.ecr_image_uri = '123456789012.dkr.ecr.ap-south-1.amazonaws.com/service-repo'
+    with patch(MODULE + '.get_region_for_environment', return_value='ap-south-1'), \
+            patch(MODULE + '.highlight_production'), \
+            patch(MODULE + '.highlight_user_account_details'), \
+            patch(MODULE + '.boto3'), \
+            patch(MODULE + '.get_ecs_service_names',
+                  side_effect=lambda client, stack_name: [stack_name + '-Web', stack_name + '-Worker']), \
+            patch(MODULE + '.deployer.build_config', return_value=[('VAR1', 'arn:VAR1')]), \
+            patch(MODULE + '.EcrClient', return_value=ecr_client) as ecr_client_class, \
+            patch(MODULE + '.deployer.deploy_new_version', side_effect=recorder.deploy_new_version):
+        yield recorder, ecr_client_class
+
+
+class TestBatchDeployer(object):
+    def test_caps_rollouts_per_cluster(self, write_manifest, stubbed_aws, tmpdir):
+        recorder, _ = stubbed_aws
+        manifest = write_manifest([
+            {'name': 'service-%d' % index, 'environment': 'staging', 'version': 'v1'}
+            for index in range(3)
+        ] + [{'name': 'service-0', 'environment': 'production', 'version': 'v1'}])
+        report_path = str(tmpdir.join('report.json'))
+
+        BatchDeployer(manifest, max_rollouts=6, max_rollouts_per_cluster=2,
+                      report_path=report_path).run()
+
+        assert len(recorder.rollouts) == 8
+        assert recorder.most_running['cluster-staging'] == 2
+        assert recorder.most_running['cluster-production'] <= 2
+        report = json.load(open(report_path))
+        assert [deployment['status'] for deployment in report] == ['deployed'] * 4
+        assert report[0]['ecs_services'] == {
+            'service-0-staging-Web': 'deployed',
+            'service-0-staging-Worker': 'deployed',
+        }
+
+    def test_reports_failures_and_continues(self, write_manifest, stubbed_aws, tmpdir):
+        recorder, ecr_client_class = stubbed_aws
+        ecr_client_class.return_value.verify_image.side_effect = [
+            None, UnrecoverableException('Image service-1-repo:v2 not found in ECR.')
+        ]
+        manifest = write_manifest([
+            {'name': 'service-0', 'environment': 'staging', 'version': 'v1'},
+            {'name': 'service-0', 'environment': 'production', 'version': 'v1'},
+            {'name': 'service-1', 'environment': 'staging', 'version': 'v2'},
+            {'name': 'service-2', 'environment': 'staging', 'version': 'v1',
+             'env_sample': str(tmpdir.join('missing.sample'))},
+        ])
+        report_path = str(tmpdir.join('report.json'))
+
+        with pytest.raises(UnrecoverableException) as error:
+            BatchDeployer(manifest, max_builds=1, report_path=report_path).run()
+
+        assert error.value.value == '2 of 4 deployments failed.'
+        # service-0 is in the same region for both environments, one image
+        assert ecr_client_class.call_count == 2
+        assert sorted(rollout[0] for rollout in recorder.rollouts) == [
+            'service-0-production-Web', 'service-0-production-Worker',
+            'service-0-staging-Web', 'service-0-staging-Worker',
+        ]
+        report = json.load(open(report_path))
+        assert [deployment['status'] for deployment in report] == \
+            ['deployed', 'deployed', 'failed', 'failed']
+        assert report[2]['error'] == 'Image service-1-repo:v2 not found in ECR.'
+        assert report[3]['error'].endswith('missing.sample not found.')
+
+    def test_rejects_invalid_manifest(self, write_manifest):
+        manifest = write_manifest([
+            {'name': 'service-0', 'environment': 'staging'},
+            {'name': 'service-0', 'environment': 'staging', 'version': 'v1', 'tag': 'v1'},
+        ])
+
+        with pytest.raises(UnrecoverableException) as error:
+            BatchDeployer(manifest)
+
+        assert error.value.value.splitlines() == [
+            "2 schema errors:",
+            "  - 'version' is a required property in 0",
+            "  - Additional properties are not allowed ('tag' was unexpected) in 1",
+        ]
@@ -0,0 +1,145 @@
+from mock import MagicMock
+
+from cloudlift.deployment.cluster_capacity import (CapacityPlanner, get_auto_scaling_groups,
+                                                   service_deployment_type, simulate_placement)
+
+
+def _container_instance(instance_id, deployment_type, free_memory, memory=2048):
+    return {
+        'ec2InstanceId': instance_id,
+        'attributes': [{'name': 'deployment_type', 'value': deployment_type}],
+        'remainingResources': [{'name': 'CPU', 'integerValue': 1024},
+                               {'name': 'MEMORY', 'integerValue': free_memory}],
+        'registeredResources': [{'name': 'CPU', 'integerValue': 1024},
+                                {'name': 'MEMORY', 'integerValue': memory}],
+    }
+
+
+def _service(name, deployment_type, desired_count, maximum_percent=200, launch_type='EC2'):
+    return {
+        'serviceName': name,
+        'launchType': launch_type,
+        'desiredCount': desired_count,
+        'taskDefinition': name + ':1',
+        'deploymentConfiguration': {'maximumPercent': maximum_percent},
+        'placementConstraints': [{'type': 'memberOf',
+                                  'expression': 'attribute:deployment_type == ' + deployment_type}],
+    }
+
+
+def _ecs_client(services, container_instances):
+    ecs_client = MagicMock()
+    ecs_client.describe_services.return_value = {'services': services}
+    ecs_client.describe_task_definition.return_value = {'taskDefinition': {
+        'containerDefinitions': [
+            {'name': 'WebContainer', 'memoryReservation': 512},
+            {'name': 'fluentbit-sidecar', 'memory': 64, 'cpu': 10},
+        ]
+    }}
+    ecs_client.get_paginator.return_value.paginate.return_value = [
+        {'containerInstanceArns': [instance['ec2InstanceId'] for instance in container_instances]}
+    ]
+    ecs_client.describe_container_instances.return_value = {
+        'containerInstances': container_instances}
+    return ecs_client
+
+
+class TestSimulatePlacement(object):
+    def test_spreads_tasks_over_instances(self):
+        task = {'CPU': 0, 'MEMORY': 500}
+
+        assert simulate_placement([{'CPU': 0, 'MEMORY': 900}, {'CPU': 0, 'MEMORY': 600}],
+                                  [task] * 3) == [task]
+        assert simulate_placement([{'CPU': 0, 'MEMORY': 1100}], [task] * 2) == []
+
+
+class TestServiceDeploymentType(object):
+    def test_reads_constraints_and_capacity_providers(self):
+        assert service_deployment_type(_service('Web', 'spot', 1)) == 'spot'
+        assert service_deployment_type({'capacityProviderStrategy': [
+            {'capacityProvider': 'cluster-staging-ondemand', 'weight': 1}]}) == 'ondemand'
+        assert service_deployment_type({'capacityProviderStrategy': [
+            {'capacityProvider': 'cluster-staging-ondemand', 'weight': 1},
+            {'capacityProvider': 'cluster-staging-spot', 'weight': 3}]}) == 'any'
+
+
+class TestCapacityPlanner(object):
+    def test_plans_surge_tasks_by_deployment_type(self):
+        ecs_client = _ecs_client(
+            [_service('Web', 'ondemand', 2), _service('Worker', 'spot', 3, maximum_percent=100),
+             _service('Api', 'spot', 2, maximum_percent=150),
+             _service('Batch', 'spot', 4, launch_type='FARGATE')],
+            [_container_instance('i-1', 'ondemand', 600), _container_instance('i-2', 'ondemand', 100),
+             _container_instance('i-3', 'spot', 700)]
+        )
+
+        plan = CapacityPlanner(ecs_client, 'cluster-staging').plan(['Web', 'Worker', 'Api', 'Batch'])
+
+        assert not plan.fits
+        assert {pool: len(tasks) for pool, tasks in plan.tasks.items()} == {'ondemand': 2, 'spot': 1}
+        assert {pool: len(tasks) for pool, tasks in plan.unplaced.items()} == {'ondemand': 1, 'spot': 0}
+        assert plan.extra_instances == {'ondemand': 1, 'spot': 0}
+        assert plan.describe() == '1 of 2 new tasks on ondemand instances cannot be placed, ' \
+                                  '1 more instances needed'
+        ecs_client.describe_task_definition.assert_any_call(taskDefinition='Web:1')
+        assert ecs_client.describe_task_definition.call_count == 2
+
+    def test_scales_out_the_auto_scaling_group(self):
+        ecs_client = _ecs_client([_service('Web', 'ondemand', 4)],
+                                 [_container_instance('i-1', 'ondemand', 600)])
+        autoscaling_client = MagicMock()
+        autoscaling_client.describe_auto_scaling_groups.return_value = {'AutoScalingGroups': [
+            {'DesiredCapacity': 1, 'MaxSize': 2}]}
+        planner = CapacityPlanner(ecs_client, 'cluster-staging', autoscaling_client,
+                                  {'ondemand': 'staging-AutoScalingGroupOnDemand'})
+
+        plan = planner.plan(['Web'])
+
+        assert plan.extra_instances == {'ondemand': 1}
+        assert planner.scale_out(plan) == {'staging-AutoScalingGroupOnDemand': 2}
+        autoscaling_client.set_desired_capacity.assert_called_once_with(
+            AutoScalingGroupName='staging-AutoScalingGroupOnDemand',
+            DesiredCapacity=2,
+            HonorCooldown=False
+        )
+
+    def test_starts_an_empty_auto_scaling_group(self):
+        ecs_client = _ecs_client([_service('Worker', 'spot', 2)],
+                                 [_container_instance('i-1', 'ondemand', 2048)])
+        autoscaling_client = MagicMock()
+        autoscaling_client.describe_auto_scaling_groups.return_value = {'AutoScalingGroups': [
+            {'DesiredCapacity': 0, 'MaxSize': 10}]}
+        planner = CapacityPlanner(ecs_client, 'cluster-staging', autoscaling_client,
+                                  {'ondemand': 'staging-AutoScalingGroupOnDemand',
+                                   'spot': 'staging-AutoScalingGroupSpot'})
+
+        plan = planner.plan(['Worker'])
+
+        assert plan.extra_instances == {'spot': None}
+        assert plan.describe() == '2 of 2 new tasks on spot instances cannot be placed, ' \
+                                  'there are none to tell how many more instances are needed'
+        assert planner.scale_out(plan) == {'staging-AutoScalingGroupSpot': 1}
+        autoscaling_client.describe_auto_scaling_groups.assert_called_once_with(
+            AutoScalingGroupNames=['staging-AutoScalingGroupSpot'])
+
+        autoscaling_client.describe_auto_scaling_groups.return_value = {'AutoScalingGroups': [
+            {'DesiredCapacity': 1, 'MaxSize': 10}]}
+        assert planner.scale_out(plan) == {}
+
+
+class TestGetAutoScalingGroups(object):
+    def test_reads_the_cluster_stack_outputs(self):
+        cloudformation_client = MagicMock()
+        cloudformation_client.describe_stacks.return_value = {'Stacks': [{'Outputs': [
+            {'OutputKey': 'AutoScalingGroupOnDemand', 'OutputValue': 'staging-AutoScalingGroupOnDemand'},
+            {'OutputKey': 'AutoScalingGroupSpot', 'OutputValue': 'staging-AutoScalingGroupSpot'},
+            {'OutputKey': 'ECSClusterDefaultInstanceLifecycle', 'OutputValue': 'spot'},
+            {'OutputKey': 'VPC', 'OutputValue': 'vpc-staging'},
+        ]}]}
+
+        assert get_auto_scaling_groups(cloudformation_client, 'cluster-staging') == {
+            'ondemand': 'staging-AutoScalingGroupOnDemand',
+            'spot': 'staging-AutoScalingGroupSpot',
+            'any': 'staging-AutoScalingGroupSpot',
+        }
+        cloudformation_client.describe_stacks.assert_called_once_with(StackName='cluster-staging')
@@ -0,0 +1,159 @@
+import json
+
+from cfn_flip import to_json
+from mock import MagicMock, patch
+
+from cloudlift.deployment.cluster_template_generator import ClusterTemplateGenerator
+
+NOTIFICATIONS_ARN = 'arn:aws:sns:ap-south-1:123456789012:non-prod-mumbai'
+
+
+def _environment_configuration(**cluster):
+    configuration = {
+        'region': 'ap-south-1',
+        'vpc': {
+            'cidr': '10.0.0.0/16',
+            'nat-gateway': {'elastic-ip-allocation-id': 'eipalloc-staging'},
+            'subnets': {
+                'public': {'public-subnet-1': {'cidr': '10.0.0.0/22'},
+                           'public-subnet-2': {'cidr': '10.0.4.0/22'}},
+                'private': {'private-subnet-1': {'cidr': '10.0.8.0/22'},
+                            'private-subnet-2': {'cidr': '10.0.12.0/22'}},
+            },
+        },
+        'cluster': {
+            'min_instances': 1,
+            'max_instances': 5,
+            'spot_min_instances': 1,
+            'spot_max_instances': 10,
+            'instance_type': 'm5.xlarge,m5a.xlarge',
+            'key_name': 'staging-cluster',
+            'ami_id': 'None',
+            'ecs_instance_default_lifecycle_type': 'spot',
+        },
+        'environment': {
+            'notifications_arn': NOTIFICATIONS_ARN,
+            'ssl_certificate_arn': 'arn:aws:acm:ap-south-1:123456789012:certificate/staging',
+        },
+    }
+    configuration['cluster'].update(cluster)
+    return configuration
+
+
+def _generate_cluster(environment_configuration):
+    client = MagicMock()
+    client.describe_availability_zones.return_value = {
+        'AvailabilityZones': [{'ZoneName': 'ap-south-1a'}, {'ZoneName': 'ap-south-1b'}]}
+    client.get_parameter.return_value = {'Parameter': {'Value': json.dumps({'image_id': 'ami-staging'})}}
+    with patch('cloudlift.deployment.cluster_template_generator.get_client_for', return_value=client), \
+            patch('cloudlift.deployment.cluster_template_generator.get_region_for_environment',
+                  return_value='ap-south-1'), \
+            patch('cloudlift.config.region.get_region_for_environment', return_value='ap-south-1'), \
+            patch('cloudlift.config.region.get_notifications_arn_for_environment',
+                  return_value=NOTIFICATIONS_ARN):
+        template = ClusterTemplateGenerator('staging', environment_configuration).generate_cluster()
+    return json.loads(to_json(template))
+
+
+class TestClusterCapacityProviders(object):
+    def test_scales_with_memory_reservation_alarms_by_default(self):
+        template = _generate_cluster(_environment_configuration())
+
+        resources = template['Resources']
+        assert 'AutoScalingPolicyOnDemand' in resources
+        assert 'ClusterHighMemoryReservationAlarmSpot' in resources
+        assert 'CapacityProviderOnDemand' not in resources
+        assert 'ClusterCapacityProviderAssociations' not in resources
+        assert 'NewInstancesProtectedFromScaleIn' not in resources['AutoScalingGroupSpot']['Properties']
+
+    def test_adds_a_capacity_provider_per_auto_scaling_group(self):
+        template = _generate_cluster(_environment_configuration(
+            capacity_providers={'target_capacity': 90, 'maximum_scaling_step_size': 20}))
+
+        resources = template['Resources']
+        assert 'AutoScalingPolicyOnDemand' not in resources
+        assert 'ClusterHighMemoryReservationAlarmSpot' not in resources
+        assert resources['AutoScalingGroupSpot']['Properties']['NewInstancesProtectedFromScaleIn'] is True
+        assert resources['CapacityProviderSpot']['Properties']['AutoScalingGroupProvider'] == {
+            'AutoScalingGroupArn': {'Ref': 'AutoScalingGroupSpot'},
+            'ManagedScaling': {
+                'Status': 'ENABLED',
+                'TargetCapacity': 90,
+                'MinimumScalingStepSize': 1,
+                'MaximumScalingStepSize': 20,
+                'InstanceWarmupPeriod': 300,
+            },
+            'ManagedTerminationProtection': 'ENABLED',
+        }
+        assert resources['CapacityProviderOnDemand']['Properties']['Name'] == {
+            'Fn::Sub': '${AWS::StackName}-ondemand'}
+        assert resources['ClusterCapacityProviderAssociations']['Properties'] == {
+            'Cluster': {'Ref': 'Cluster'},
+            'CapacityProviders': [{'Ref': 'CapacityProviderOnDemand'}, {'Ref': 'CapacityProviderSpot'}],
+            'DefaultCapacityProviderStrategy': [
+                {'CapacityProvider': {'Ref': 'CapacityProviderSpot'}, 'Weight': 1}],
+        }
+        assert template['Outputs']['CapacityProviderSpot']['Value'] == {'Ref': 'CapacityProviderSpot'}
+        assert template['Outputs']['CapacityProviderOnDemand']['Value'] == {'Ref': 'CapacityProviderOnDemand'}
+
+    def test_skips_the_providers_of_skipped_fleets(self):
+        template = _generate_cluster(_environment_configuration(
+            spot_min_instances=0, capacity_providers={'managed_termination_protection': False}))
+
+        resources = template['Resources']
+        assert 'CapacityProviderSpot' not in resources
+        assert 'CapacityProviderSpot' not in template['Outputs']
+        assert 'NewInstancesProtectedFromScaleIn' not in resources['AutoScalingGroupOnDemand']['Properties']
+        assert resources['CapacityProviderOnDemand']['Properties']['AutoScalingGroupProvider'][
+            'ManagedTerminationProtection'] == 'DISABLED'
+        assert resources['ClusterCapacityProviderAssociations']['Properties'][
+            'DefaultCapacityProviderStrategy'] == [
+            {'CapacityProvider': {'Ref': 'CapacityProviderOnDemand'}, 'Weight': 1}]
+
+
+class TestClusterWarmPool(object):
+    def test_launches_on_demand_instances_without_a_warm_pool_by_default(self):
+        template = _generate_cluster(_environment_configuration())
+
+        resources = template['Resources']
+        assert 'WarmPoolOnDemand' not in resources
+        assert 'MixedInstancesPolicy' in resources['AutoScalingGroupOnDemand']['Properties']
+        assert 'Policies' not in resources['ECSRole']['Properties']
+
+    def test_adds_a_warm_pool_to_the_on_demand_group(self):
+        template = _generate_cluster(_environment_configuration(
+            warm_pool={'min_size': 2, 'pool_state': 'Running', 'heartbeat_timeout': 900}))
+
+        resources = template['Resources']
+        assert resources['WarmPoolOnDemand']['Properties'] == {
+            'AutoScalingGroupName': {'Ref': 'AutoScalingGroupOnDemand'},
+            'MinSize': 2,
+            'PoolState': 'Running',
+            'InstanceReusePolicy': {'ReuseOnScaleIn': False},
+        }
+        on_demand_group = resources['AutoScalingGroupOnDemand']['Properties']
+        assert 'MixedInstancesPolicy' not in on_demand_group
+        assert on_demand_group['LaunchTemplate']['LaunchTemplateId'] == {'Ref': 'LaunchTemplateOnDemand'}
+        assert on_demand_group['LifecycleHookSpecificationList'] == [{
+            'LifecycleHookName': 'InstanceInitialization',
+            'LifecycleTransition': 'autoscaling:EC2_INSTANCE_LAUNCHING',
+            'HeartbeatTimeout': 900,
+            'DefaultResult': 'CONTINUE',
+        }]
+        assert resources['LaunchTemplateOnDemand']['Properties']['LaunchTemplateData']['InstanceType'] == 'm5.xlarge'
+
+        user_data = resources['LaunchTemplateOnDemand']['Properties']['LaunchTemplateData']['UserData'][
+            'Fn::Base64']['Fn::Sub']
+        assert 'INIT_STATUS=$?' in user_data
+        assert '/usr/local/bin/complete-lifecycle-action ABANDON' in user_data
+        init = resources['LaunchTemplateOnDemand']['Metadata']['AWS::CloudFormation::Init']['config']
+        assert 'ECS_WARM_POOLS_CHECK=true' in init['commands']['01_add_instance_to_cluster']['command']['Fn::Sub']
+        assert '/usr/local/bin/complete-lifecycle-action' in init['files']
+        assert '/var/lib/cloud/scripts/per-boot/complete-lifecycle-action' in init['files']
+        assert resources['ECSRole']['Properties']['Policies'][0]['PolicyName'] == 'WarmPoolLifecycleActions'
+
+        # spot groups cannot have a warm pool
+        spot_group = resources['AutoScalingGroupSpot']['Properties']
+        assert 'MixedInstancesPolicy' in spot_group
+        assert 'LifecycleHookSpecificationList' not in spot_group
+        assert 'ECS_WARM_POOLS_CHECK' not in json.dumps(resources['LaunchTemplateSpot'])
@@ -0,0 +1,59 @@
+from mock import MagicMock, call, patch
+
+from cloudlift.deployment import deployer
+from cloudlift.deployment.deployer import print_task_diff
+from cloudlift.deployment.ecs import EcsTaskDefinitionDiff
+
+
+class TestPrintTaskDiff(object):
+    def test_without_image_change(self, capsys):
+        diffs = [EcsTaskDefinitionDiff('WebContainer', 'secrets',
+                                       {'VAR1': 'arn:new'}, {'VAR1': 'arn:old'})]
+
+        print_task_diff('dummy-staging-Web', diffs, 'white')
+
+        output = capsys.readouterr().out
+        assert 'No change in image version' in output
+        assert 'VAR1' in output
+
+
+@patch('cloudlift.deployment.deployer.print_task_diff')
+@patch('cloudlift.deployment.deployer.EcsClient')
+@patch('cloudlift.deployment.deployer.DeployAction')
+class TestDeployNewVersionRollback(object):
+    def _deploy(self, mock_deploy_action, rollouts):
+        deployment = mock_deploy_action.return_value
+        deployment.service_name = 'dummy-staging-Web'
+        previous_task_definition = MagicMock(containers=[], family_revision='dummy:1')
+        new_task_definition = MagicMock(family_revision='dummy:2')
+        deployment.get_current_task_definition.return_value = previous_task_definition
+        deployment.update_task_definition.return_value = new_task_definition
+        with patch('cloudlift.deployment.deployer.deploy_and_wait',
+                   side_effect=rollouts) as mock_deploy_and_wait:
+            response = deployer.deploy_new_version(
+                'ap-south-1', 'cluster-staging', 'dummy-staging-Web', 'v2', 'dummy',
+                None, 'staging', env_config=[], deadline=60, max_failed_starts=2,
+                rollback=True)
+        return response, deployment, previous_task_definition, new_task_definition, \
+            mock_deploy_and_wait
+
+    def test_deregisters_previous_after_success(self, mock_deploy_action, *_):
+        response, deployment, previous_task_definition, _, mock_deploy_and_wait = \
+            self._deploy(mock_deploy_action, [True])
+
+        assert response is True
+        deployment.update_task_definition.assert_called_once_with(
+            previous_task_definition, deregister_previous=False)
+        deployment.deregister_task_definition.assert_called_once_with(previous_task_definition)
+        assert mock_deploy_and_wait.call_count == 1
+
+    def test_rolls_back_failed_rollout(self, mock_deploy_action, *_):
+        response, deployment, previous_task_definition, new_task_definition, \
+            mock_deploy_and_wait = self._deploy(mock_deploy_action, [False, True])
+
+        assert response is False
+        assert mock_deploy_and_wait.call_args_list == [
+            call(deployment, new_task_definition, 'white', 60, 2),
+            call(deployment, previous_task_definition, 'white', 60, 2),
+        ]
+        deployment.deregister_task_definition.assert_called_once_with(new_task_definition)
@@ -0,0 +1,48 @@
+from mock import MagicMock, patch
+
+from cloudlift.deployment.ecs import DeployAction, EcsClient, EcsService
+
+
+class TestDeployActionDesiredCount(object):
+    def _deploy_action(self, desired_count):
+        client = MagicMock()
+        client.describe_services.return_value = {u'services': [
+            {u'serviceName': 'dummy-Web', u'desiredCount': desired_count,
+             u'taskDefinition': 'dummy:1'}]}
+        client.update_service.return_value = {u'service': {u'serviceName': 'dummy-Web'}}
+        return DeployAction(client, 'cluster-staging', 'dummy-Web'), client
+
+    def test_keeps_the_desired_count_autoscaling_set(self):
+        deployment, client = self._deploy_action(desired_count=7)
+        deployment.service.set_desired_count(7)
+
+        deployment.deploy(MagicMock(arn='dummy:2'))
+
+        client.update_service.assert_called_once_with(
+            cluster='cluster-staging', service='dummy-Web',
+            desired_count=None, task_definition='dummy:2')
+
+    def test_sends_a_changed_desired_count(self):
+        deployment, client = self._deploy_action(desired_count=0)
+        deployment.service.set_desired_count(1)
+
+        deployment.deploy(MagicMock(arn='dummy:2'))
+
+        assert client.update_service.call_args[1]['desired_count'] == 1
+        assert isinstance(deployment.service, EcsService)
+
+
+class TestEcsClientListStoppedTasks(object):
+    def test_lists_every_page(self):
+        with patch('cloudlift.deployment.ecs.Session') as session:
+            client = EcsClient(region='ap-south-1')
+        paginator = session.return_value.client.return_value.get_paginator.return_value
+        paginator.paginate.return_value = [
+            {u'taskArns': ['task-%d' % index for index in range(100)]},
+            {u'taskArns': ['task-100']},
+        ]
+
+        assert client.list_stopped_tasks('cluster-staging', 'dummy-Web') == \
+            ['task-%d' % index for index in range(101)]
+        paginator.paginate.assert_called_once_with(
+            cluster='cluster-staging', serviceName='dummy-Web', desiredStatus=u'STOPPED')
@@ -0,0 +1,58 @@
+import boto3
+from mock import MagicMock, patch
+from moto import mock_ecs
+
+from cloudlift.deployment.environment_status import EnvironmentStatusFetcher
+
+
+def create_services(ecs, service_count):
+    ecs.create_cluster(clusterName='cluster-staging')
+    task_definition_arns = [
+        ecs.register_task_definition(
+            family='service-%d' % index,
+            containerDefinitions=[
+                {'name': 'statsd-sidecar', 'image': 'statsd/statsd:latest', 'memoryReservation': 64},
+                {'name': 'WebContainer', 'memoryReservation': 512,
+                 'image': '123456789012.dkr.ecr.ap-south-1.amazonaws.com/service-repo:v%d' % index},
+            ]
+        )['taskDefinition']['taskDefinitionArn']
+        for index in range(3)
+    ]
+    for index in range(service_count):
+        ecs.create_service(
+            cluster='cluster-staging',
+            serviceName='service-%03d-staging-Web' % index,
+            taskDefinition=task_definition_arns[index % 3],
+            desiredCount=2
+        )
+
+
+class TestEnvironmentStatusFetcher(object):
+    @mock_ecs
+    def test_describes_services_in_batches(self):
+        ecs = boto3.client('ecs')
+        create_services(ecs, 25)
+        ecs_client = MagicMock(wraps=ecs)
+
+        with patch('cloudlift.deployment.environment_status.get_client_for', return_value=ecs_client):
+            statuses = EnvironmentStatusFetcher('staging').get_status()
+
+        assert [len(call[1]['services']) for call in ecs_client.describe_services.call_args_list] == \
+            [10, 10, 5]
+        assert ecs_client.describe_task_definition.call_count == 3
+        assert len(statuses) == 25
+        assert statuses[4]['service'] == 'service-004-staging-Web'
+        assert statuses[4]['image_tag'] == 'v1'
+        assert statuses[4]['desired'] == 2
+
+    @mock_ecs
+    def test_prints_status_table(self, capsys):
+        create_services(boto3.client('ecs'), 2)
+
+        with patch('cloudlift.deployment.environment_status.get_client_for',
+                   return_value=boto3.client('ecs')):
+            EnvironmentStatusFetcher('staging').print_status()
+
+        output = capsys.readouterr().out
+        assert '2 services in cluster-staging' in output
+        assert 'service-001-staging-Web' in output
@@ -0,0 +1,148 @@
+import pytest
+from mock import MagicMock, patch
+
+from cloudlift.deployment import deployer
+from cloudlift.deployment.rollout_monitor import RolloutFailed, RolloutMonitor
+
+NEW_TASK_DEFINITION = 'arn:aws:ecs:ap-south-1:123456789012:task-definition/dummy:2'
+OLD_TASK_DEFINITION = 'arn:aws:ecs:ap-south-1:123456789012:task-definition/dummy:1'
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def _service(running_count):
+    return {u'deployments': [
+        {u'taskDefinition': NEW_TASK_DEFINITION, u'runningCount': running_count},
+        {u'taskDefinition': OLD_TASK_DEFINITION, u'runningCount': 2},
+    ]}
+
+
+def _stopped_task(task_id, task_definition_arn=NEW_TASK_DEFINITION,
+                  stop_code='EssentialContainerExited', exit_code=1):
+    return {
+        u'taskArn': 'arn:aws:ecs:ap-south-1:123456789012:task/cluster/' + task_id,
+        u'taskDefinitionArn': task_definition_arn,
+        u'stopCode': stop_code,
+        u'stoppedReason': 'Essential container in task exited',
+        u'stoppedAt': task_id,
+        u'containers': [{u'name': 'dummyContainer', u'exitCode': exit_code}],
+    }
+
+
+class StoppedTasks(object):
+    def __init__(self):
+        self.tasks = []
+        self.client = MagicMock()
+        self.client.list_stopped_tasks.side_effect = lambda cluster_name, service_name: [
+            task[u'taskArn'] for task in self.tasks
+        ]
+        self.client.describe_tasks.side_effect = lambda cluster_name, task_arns: {
+            u'tasks': [task for task in self.tasks if task[u'taskArn'] in task_arns]
+        }
+
+
+def _monitor(stopped_tasks, clock, **kwargs):
+    return RolloutMonitor(stopped_tasks.client, 'cluster', 'dummy-Web',
+                          NEW_TASK_DEFINITION, clock=clock, **kwargs)
+
+
+class TestRolloutMonitor(object):
+    def test_fails_after_consecutive_failed_starts(self):
+        clock = FakeClock()
+        stopped_tasks = StoppedTasks()
+        monitor = _monitor(stopped_tasks, clock, max_failed_starts=2)
+        stopped_tasks.tasks = [
+            _stopped_task('task-1'),
+            _stopped_task('task-0', task_definition_arn=OLD_TASK_DEFINITION),
+            _stopped_task('task-2', stop_code='ServiceSchedulerInitiated', exit_code=0),
+        ]
+        clock.now = 10
+        monitor.check(_service(0))
+        # stopped tasks are listed at most every 10 seconds
+        clock.now = 15
+        stopped_tasks.tasks.append(_stopped_task('task-3', exit_code=137))
+        monitor.check(_service(0))
+        assert stopped_tasks.client.list_stopped_tasks.call_count == 1
+
+        clock.now = 20
+        with pytest.raises(RolloutFailed) as failure:
+            monitor.check(_service(0))
+
+        assert str(failure.value).splitlines() == [
+            'dummy-Web: 2 tasks of dummy:2 failed to start:',
+            '  - task task-1: Essential container in task exited',
+            '      container dummyContainer exited with code 1',
+            '  - task task-3: Essential container in task exited',
+            '      container dummyContainer exited with code 137',
+        ]
+        # tasks already reported are not described again
+        assert stopped_tasks.client.describe_tasks.call_args[0][1] == [
+            stopped_tasks.tasks[-1][u'taskArn']]
+
+    def test_running_task_resets_failed_starts(self):
+        clock = FakeClock()
+        stopped_tasks = StoppedTasks()
+        monitor = _monitor(stopped_tasks, clock, max_failed_starts=2)
+        stopped_tasks.tasks = [_stopped_task('task-1')]
+        clock.now = 10
+        monitor.check(_service(0))
+        assert len(monitor.failed_starts) == 1
+
+        clock.now = 20
+        monitor.check(_service(1))
+        assert monitor.failed_starts == []
+
+        stopped_tasks.tasks.append(_stopped_task('task-2'))
+        clock.now = 30
+        monitor.check(_service(1))
+        assert len(monitor.failed_starts) == 1
+
+    def test_fails_after_deadline(self):
+        clock = FakeClock()
+        monitor = _monitor(StoppedTasks(), clock, deadline=60)
+        clock.now = 60
+        monitor.check(_service(1))
+
+        clock.now = 61
+        with pytest.raises(RolloutFailed) as failure:
+            monitor.check(_service(1))
+
+        assert str(failure.value) == 'dummy-Web: not stable after 60 seconds.'
+
+    def test_fails_when_the_circuit_breaker_trips(self):
+        monitor = _monitor(StoppedTasks(), FakeClock())
+        service = _service(0)
+        service[u'deployments'][0][u'rolloutState'] = u'FAILED'
+        service[u'deployments'][0][u'rolloutStateReason'] = u'ECS deployment circuit breaker: tasks failed to start.'
+
+        with pytest.raises(RolloutFailed) as failure:
+            monitor.check(service)
+        assert str(failure.value) == 'dummy-Web: ECS deployment circuit breaker: tasks failed to start.'
+
+        with pytest.raises(RolloutFailed) as failure:
+            monitor.check_finished({u'taskDefinition': OLD_TASK_DEFINITION})
+        assert str(failure.value) == 'dummy-Web: ECS rolled the deployment back to dummy:1.'
+
+
+class TestWaitForFinish(object):
+    @patch('cloudlift.deployment.deployer.sleep')
+    def test_stops_waiting_when_the_rollout_fails(self, mock_sleep):
+        service = MagicMock(errors=None)
+        service.get.return_value = []
+        action = MagicMock()
+        action.get_service.return_value = service
+        action.is_deployed.return_value = False
+        monitor = MagicMock()
+        monitor.check.side_effect = [None, RolloutFailed('dummy-Web: not stable after 60 seconds.')]
+
+        with patch('cloudlift.deployment.deployer.log_err') as mock_log_err:
+            assert deployer.wait_for_finish(action, [], 'white', monitor) is False
+
+        assert action.get_service.call_count == 2
+        mock_log_err.assert_called_once_with('dummy-Web: not stable after 60 seconds.')
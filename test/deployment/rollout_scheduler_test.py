@@ -0,0 +1,67 @@
+import pytest
+from mock import MagicMock
+
+from cloudlift.deployment.rollout_scheduler import CapacityGate, plan_waves
+from cloudlift.exceptions import UnrecoverableException
+
+
+class TestPlanWaves(object):
+    def test_orders_by_priority_and_dependencies(self):
+        waves = plan_waves({
+            'Worker': {'after': ['Migrations']},
+            'Web': {'priority': 1},
+            'Migrations': {},
+            'Scheduler': {},
+            'Admin': {'priority': 1, 'after': ['Web']},
+        })
+
+        assert waves == [['Migrations', 'Scheduler'], ['Worker'], ['Web'], ['Admin']]
+
+    def test_caps_wave_size(self):
+        waves = plan_waves({'A': {}, 'B': {}, 'C': {}, 'D': {'priority': 1}}, max_concurrent=2)
+
+        assert waves == [['A', 'B'], ['C'], ['D']]
+
+    def test_rejects_unresolvable_order(self):
+        with pytest.raises(UnrecoverableException) as error:
+            plan_waves({'Web': {'after': ['Worker']}, 'Worker': {'priority': 1}})
+        assert error.value.value.startswith('Cannot order the rollout of Web, Worker')
+
+        with pytest.raises(UnrecoverableException) as error:
+            plan_waves({'Web': {'after': ['Wrker']}})
+        assert error.value.value == 'Unknown components in rollout.after: Wrker'
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def _planner(fits):
+    planner = MagicMock(cluster_name='cluster-staging')
+    planner.plan.side_effect = [MagicMock(fits=fit) for fit in fits]
+    return planner
+
+
+class TestCapacityGate(object):
+    def test_waits_until_the_wave_fits(self):
+        clock = FakeClock()
+        planner = _planner([False, False, True])
+        gate = CapacityGate(planner, clock=clock, sleep=clock.sleep)
+
+        assert gate.wait_for(['Web', 'Worker']) is True
+        assert planner.plan.call_count == 3
+        assert clock.now == 30
+
+    def test_lets_the_wave_through_after_max_wait(self):
+        clock = FakeClock()
+        gate = CapacityGate(_planner([False] * 3), max_wait=30, clock=clock, sleep=clock.sleep)
+
+        assert gate.wait_for(['Web', 'Worker']) is False
+        assert clock.now == 30
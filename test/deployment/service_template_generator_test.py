@@ -1,7 +1,13 @@
 import datetime
+from decimal import Decimal
 
+import pytest
 from cfn_flip import to_json
-from mock import patch
+from mock import MagicMock, patch
+from troposphere import Parameter, Ref, Template
+from troposphere.ecs import LoadBalancer as EcsLoadBalancer
+from troposphere.ecs import Service
+from troposphere.elasticloadbalancingv2 import Listener, LoadBalancer, TargetGroup
 
 from cloudlift.config import ParameterStore
 from cloudlift.config import ServiceConfiguration
@@ -114,3 +120,256 @@ class TestServiceTemplateGenerator(object):
                     generated_template = template_generator.generate_service()
 
         assert to_json(''.join(open('./test/templates/expected_fargate_service_template.yml').readlines())) == to_json(generated_template)
+
+
+class TestDeploymentArguments(object):
+    def test_defaults(self):
+        arguments = ServiceTemplateGenerator._deployment_arguments(None, {})
+
+        assert list(arguments) == ['DeploymentConfiguration']
+        assert arguments['DeploymentConfiguration'].to_dict() == {
+            'MinimumHealthyPercent': 100, 'MaximumPercent': 200}
+
+    def test_from_service_configuration(self):
+        arguments = ServiceTemplateGenerator._deployment_arguments(None, {'deployment': {
+            'minimum_healthy_percent': 50,
+            'maximum_percent': 150,
+            'circuit_breaker': {'enable': True, 'rollback': True},
+            'health_check_grace_period_seconds': 60,
+        }})
+
+        assert arguments['DeploymentConfiguration'].to_dict() == {
+            'MinimumHealthyPercent': 50,
+            'MaximumPercent': 150,
+            'DeploymentCircuitBreaker': {'Enable': True, 'Rollback': True},
+        }
+        assert arguments['HealthCheckGracePeriodSeconds'] == 60
+
+
+class TestServiceAutoscaling(object):
+    def _resources(self, autoscaling, http_interface=True):
+        generator = object.__new__(ServiceTemplateGenerator)
+        generator.template = Template()
+        generator.cluster_name = 'cluster-staging'
+        svc = Service('Dummy')
+        alb_target_group = (LoadBalancer('ALBDummy'), TargetGroup('TargetGroupDummy')) \
+            if http_interface else None
+
+        generator._add_service_autoscaling('Dummy', svc, autoscaling, alb_target_group)
+
+        return generator.template.to_dict()['Resources']
+
+    def test_target_tracking(self):
+        resources = self._resources({
+            'min_capacity': 2,
+            'max_capacity': 10,
+            'target_tracking': [
+                {'metric': 'cpu', 'target': 60},
+                {'metric': 'alb_request_count', 'target': 500, 'scale_in_cooldown': 600},
+                {'metric': 'custom', 'target': 20, 'custom_metric': {
+                    'namespace': 'Dummy', 'metric_name': 'QueueLatency',
+                    'statistic': 'Average', 'dimensions': {'Service': 'dummy'}}},
+            ]
+        })
+
+        assert resources['DummyScalableTarget']['Properties'] == {
+            'MinCapacity': 2,
+            'MaxCapacity': 10,
+            'ResourceId': {'Fn::Join': ['/', ['service', 'cluster-staging',
+                                              {'Fn::GetAtt': ['Dummy', 'Name']}]]},
+            'ScalableDimension': 'ecs:service:DesiredCount',
+            'ServiceNamespace': 'ecs',
+        }
+        cpu = resources['DummyCpuTargetTracking']['Properties']
+        assert cpu['ScalingTargetId'] == {'Ref': 'DummyScalableTarget'}
+        assert cpu['TargetTrackingScalingPolicyConfiguration'] == {
+            'PredefinedMetricSpecification': {
+                'PredefinedMetricType': 'ECSServiceAverageCPUUtilization'},
+            'TargetValue': 60.0,
+            'ScaleInCooldown': 300,
+            'ScaleOutCooldown': 60,
+        }
+        requests = resources['DummyAlbRequestCountTargetTracking']['Properties'][
+            'TargetTrackingScalingPolicyConfiguration']
+        assert requests['PredefinedMetricSpecification']['ResourceLabel'] == {'Fn::Join': ['/', [
+            {'Fn::GetAtt': ['ALBDummy', 'LoadBalancerFullName']},
+            {'Fn::GetAtt': ['TargetGroupDummy', 'TargetGroupFullName']},
+        ]]}
+        assert requests['ScaleInCooldown'] == 600
+        custom = resources['DummyCustomTargetTracking']['Properties'][
+            'TargetTrackingScalingPolicyConfiguration']['CustomizedMetricSpecification']
+        assert custom['Dimensions'] == [{'Name': 'Service', 'Value': 'dummy'}]
+
+    def test_numbers_repeated_custom_metrics(self):
+        resources = self._resources({
+            'min_capacity': 2,
+            'max_capacity': 10,
+            'target_tracking': [
+                {'metric': 'custom', 'target': 20, 'custom_metric': {
+                    'namespace': 'Dummy', 'metric_name': 'QueueLatency', 'statistic': 'Average'}},
+                {'metric': 'cpu', 'target': 60},
+                {'metric': 'custom', 'target': 100, 'custom_metric': {
+                    'namespace': 'Dummy', 'metric_name': 'ActiveSessions', 'statistic': 'Average'}},
+            ]
+        })
+
+        assert sorted(name for name in resources if name.endswith('TargetTracking')) == [
+            'DummyCpuTargetTracking', 'DummyCustom2TargetTracking', 'DummyCustomTargetTracking']
+        assert resources['DummyCustom2TargetTracking']['Properties'][
+            'TargetTrackingScalingPolicyConfiguration']['CustomizedMetricSpecification'][
+            'MetricName'] == 'ActiveSessions'
+
+    def test_sqs_step_scaling(self):
+        resources = self._resources({
+            'min_capacity': 1,
+            'max_capacity': 20,
+            'sqs_step_scaling': {
+                'queue_name': 'dummy-jobs',
+                'scale_out_steps': [{'messages': 1000, 'adjustment': 5},
+                                    {'messages': 100, 'adjustment': 1}],
+            }
+        }, http_interface=False)
+
+        assert resources['DummySqsScaleOutPolicy']['Properties'][
+            'StepScalingPolicyConfiguration']['StepAdjustments'] == [
+            {'MetricIntervalLowerBound': 0.0, 'MetricIntervalUpperBound': 900.0,
+             'ScalingAdjustment': 1},
+            {'MetricIntervalLowerBound': 900.0, 'ScalingAdjustment': 5},
+        ]
+        scale_out_alarm = resources['DummySqsScaleOutAlarm']['Properties']
+        assert scale_out_alarm['Threshold'] == '100'
+        assert scale_out_alarm['AlarmActions'] == [{'Ref': 'DummySqsScaleOutPolicy'}]
+        assert scale_out_alarm['Dimensions'] == [{'Name': 'QueueName', 'Value': 'dummy-jobs'}]
+        scale_in_alarm = resources['DummySqsScaleInAlarm']['Properties']
+        assert scale_in_alarm['ComparisonOperator'] == 'LessThanThreshold'
+        assert scale_in_alarm['Threshold'] == '1'
+
+    @pytest.mark.parametrize('running_count, expected_count', [(0, 2), (5, 5), (30, 10)])
+    def test_keeps_the_desired_count_within_the_capacity(self, running_count, expected_count):
+        generator = _placement_template_generator({})
+        generator._get_desired_task_count_for_service.return_value = running_count
+        # as read from DynamoDB
+        config = {'memory_reservation': 1000, 'command': None, 'logging': None,
+                  'autoscaling': {'min_capacity': Decimal(2), 'max_capacity': Decimal(10),
+                                  'target_tracking': [{'metric': 'cpu', 'target': Decimal(60)}]}}
+
+        properties = _ecs_service_properties(generator, config)
+
+        assert properties['DesiredCount'] == expected_count
+        generator.template.to_json()
+
+
+def _placement_template_generator(environment_stack_outputs):
+    generator = object.__new__(ServiceTemplateGenerator)
+    generator.template = Template()
+    generator.env = 'staging'
+    generator.application_name = 'dummy'
+    generator.env_sample_file_path = './test/templates/test_env.sample'
+    generator.current_version = 'master'
+    generator.team_name = 'non-prod-mumbai'
+    generator.cluster_name = 'cluster-staging'
+    generator.environment_configuration = {}
+    generator._environment_stack_outputs = environment_stack_outputs
+    generator.vpc = Parameter('VPC', Type='String')
+    generator.private_subnet1 = Parameter('PrivateSubnet1', Type='String')
+    generator.private_subnet2 = Parameter('PrivateSubnet2', Type='String')
+    generator.ecs_service_role = Parameter('ECSServiceRole', Type='String')
+    target_group = TargetGroup('TargetGroupDummy')
+    generator._add_alb = MagicMock(return_value=(
+        LoadBalancer('ALBDummy'),
+        EcsLoadBalancer(ContainerName='DummyContainer', ContainerPort=80, TargetGroupArn=Ref(target_group)),
+        Listener('DummyListener'),
+        None,
+        target_group,
+    ))
+    generator._add_service_alarms = MagicMock()
+    generator._get_desired_task_count_for_service = MagicMock(return_value=1)
+    return generator
+
+
+def _ecs_service_properties(generator, config):
+    with patch('cloudlift.deployment.service_template_generator.build_config', return_value=[]), \
+            patch('cloudlift.deployment.service_template_generator.boto3') as mock_boto3, \
+            patch.object(ServiceTemplateGenerator, 'ecr_image_uri',
+                         new='12345.dkr.ecr.ap-south-1.amazonaws.com/dummy-repo'):
+        mock_boto3.resource.return_value.Role.return_value.arn = \
+            'arn:aws:iam::12345:role/ecsTaskExecutionRole'
+        generator._add_service('Dummy', config)
+    return generator.template.to_dict()['Resources']['Dummy']['Properties']
+
+
+DEFAULT_PLACEMENT_STRATEGIES = [
+    {'Type': 'spread', 'Field': 'attribute:ecs.availability-zone'},
+    {'Type': 'spread', 'Field': 'instanceId'},
+]
+
+
+class TestServicePlacement(object):
+    @pytest.mark.parametrize('http_interface', [True, False])
+    @pytest.mark.parametrize('custom_metrics', [True, False])
+    @pytest.mark.parametrize('placement, lifecycle, expected_strategies, expected_constraints', [
+        (None, None, DEFAULT_PLACEMENT_STRATEGIES, None),
+        (None, 'spot', DEFAULT_PLACEMENT_STRATEGIES,
+         [{'Type': 'memberOf', 'Expression': 'attribute:deployment_type == spot'}]),
+        ({'strategies': [{'type': 'binpack', 'field': 'memory'}],
+          'constraints': [{'type': 'distinctInstance'}]},
+         'ondemand',
+         [{'Type': 'binpack', 'Field': 'memory'}],
+         [{'Type': 'memberOf', 'Expression': 'attribute:deployment_type == ondemand'},
+          {'Type': 'distinctInstance'}]),
+        ({'strategies': [{'type': 'spread', 'field': 'attribute:ecs.availability-zone'},
+                         {'type': 'binpack', 'field': 'cpu'}],
+          'constraints': [{'type': 'memberOf', 'expression': 'attribute:ecs.instance-type =~ m5.*'}]},
+         None,
+         [{'Type': 'spread', 'Field': 'attribute:ecs.availability-zone'},
+          {'Type': 'binpack', 'Field': 'cpu'}],
+         [{'Type': 'memberOf', 'Expression': 'attribute:ecs.instance-type =~ m5.*'}]),
+        ({'strategies': [{'type': 'random'}]}, None, [{'Type': 'random'}], None),
+    ])
+    def test_renders_placement_in_every_ec2_branch(self, http_interface, custom_metrics, placement,
+                                                   lifecycle, expected_strategies, expected_constraints):
+        generator = _placement_template_generator(
+            {'ECSClusterDefaultInstanceLifecycle': lifecycle} if lifecycle else {})
+        config = {'memory_reservation': 1000, 'command': None, 'logging': None}
+        if http_interface:
+            config['http_interface'] = {'internal': False, 'container_port': 80,
+                                        'restrict_access_to': ['0.0.0.0/0']}
+        if custom_metrics:
+            config['custom_metrics'] = {'metrics_port': '8080', 'metrics_path': '/metrics'}
+        if placement:
+            config['placement'] = placement
+
+        properties = _ecs_service_properties(generator, config)
+        assert properties['PlacementStrategies'] == expected_strategies
+        assert properties.get('PlacementConstraints') == expected_constraints
+
+    @pytest.mark.parametrize('http_interface', [True, False])
+    @pytest.mark.parametrize('outputs, spot_deployment, expected', [
+        ({'CapacityProviderOnDemand': 'cluster-staging-ondemand', 'CapacityProviderSpot': 'cluster-staging-spot',
+          'ECSClusterDefaultInstanceLifecycle': 'ondemand'},
+         True,
+         {'CapacityProviderStrategy': [{'CapacityProvider': 'cluster-staging-spot', 'Weight': 1}]}),
+        ({'CapacityProviderOnDemand': 'cluster-staging-ondemand',
+          'ECSClusterDefaultInstanceLifecycle': 'ondemand'},
+         None,
+         {'CapacityProviderStrategy': [{'CapacityProvider': 'cluster-staging-ondemand', 'Weight': 1}]}),
+        ({'CapacityProviderOnDemand': 'cluster-staging-ondemand'}, None, {}),
+        ({'CapacityProviderOnDemand': 'cluster-staging-ondemand'}, True, {
+            'LaunchType': 'EC2',
+            'PlacementConstraints': [{'Type': 'memberOf', 'Expression': 'attribute:deployment_type == spot'}],
+        }),
+    ])
+    def test_uses_the_capacity_providers_of_the_cluster(self, http_interface, outputs, spot_deployment, expected):
+        generator = _placement_template_generator(outputs)
+        config = {'memory_reservation': 1000, 'command': None, 'logging': None}
+        if http_interface:
+            config['http_interface'] = {'internal': False, 'container_port': 80,
+                                        'restrict_access_to': ['0.0.0.0/0']}
+        if spot_deployment is not None:
+            config['spot_deployment'] = spot_deployment
+
+        properties = _ecs_service_properties(generator, config)
+        assert {key: properties[key] for key in ['CapacityProviderStrategy', 'LaunchType', 'PlacementConstraints']
+                if key in properties} == expected
+        assert properties['PlacementStrategies'] == DEFAULT_PLACEMENT_STRATEGIES
+
@@ -0,0 +1,125 @@
+import json
+import os
+import statistics
+import time
+
+import pytest
+from mock import patch
+
+from cloudlift.config import ServiceConfiguration
+from cloudlift.deployment import editor
+from cloudlift.deployment.ecs import EcsAction
+from cloudlift.deployment.service_creator import ServiceCreator
+from cloudlift.deployment.service_information_fetcher import ServiceInformationFetcher
+from cloudlift.deployment.service_template_generator import ServiceTemplateGenerator
+from cloudlift.deployment.service_updater import ServiceUpdater
+
+from aws_environment import (ENV_SAMPLE_FILE, ENVIRONMENT, SERVICE,
+                             seeded_environment, service_directory)
+
+BUDGET_FILE = os.path.join(os.path.dirname(__file__), 'api_call_budget.json')
+
+
+def deploy_service(aws_environment):
+    # ECS never finishes a rollout in moto, so the first poll reports it done
+    with patch('cloudlift.deployment.ecr_client.get_container_tool', return_value='docker'), \
+            patch.object(EcsAction, 'is_deployed', return_value=True), \
+            patch('cloudlift.deployment.deployer.sleep'), \
+            patch('cloudlift.deployment.service_updater.sleep', new=lambda _: time.sleep(0.01)):
+        ServiceUpdater(SERVICE, ENVIRONMENT, ENV_SAMPLE_FILE, 'v1').run()
+
+
+def deploy_config(aws_environment):
+    with patch.object(EcsAction, 'is_deployed', return_value=True), \
+            patch('cloudlift.deployment.deployer.sleep'), \
+            patch('cloudlift.deployment.service_updater.sleep', new=lambda _: time.sleep(0.01)):
+        ServiceUpdater(SERVICE, ENVIRONMENT, ENV_SAMPLE_FILE).deploy_config()
+
+
+def update_service(aws_environment):
+    with patch('cloudlift.config.utils.edit', return_value=None), \
+            patch('cloudlift.deployment.changesets.click.confirm', return_value=True), \
+            service_directory():
+        ServiceCreator(SERVICE, ENVIRONMENT).update()
+
+
+def edit_config(aws_environment):
+    with patch('cloudlift.deployment.editor.click.edit', return_value='VAR1=val2\nVAR2=val2'), \
+            patch('cloudlift.deployment.editor.click.confirm', return_value=True):
+        editor.edit_config(SERVICE, ENVIRONMENT)
+
+
+def get_version(aws_environment):
+    ServiceInformationFetcher(SERVICE, ENVIRONMENT).get_version(short=True)
+
+
+def generate_service_template(aws_environment):
+    environment_stack = aws_environment.stacks['cluster-' + ENVIRONMENT]
+    template_generator = ServiceTemplateGenerator(
+        ServiceConfiguration(SERVICE, ENVIRONMENT),
+        environment_stack
+    )
+    template_generator.env_sample_file_path = ENV_SAMPLE_FILE
+    template_generator.generate_service()
+
+
+SCENARIOS = [
+    deploy_service,
+    deploy_config,
+    update_service,
+    edit_config,
+    get_version,
+    generate_service_template,
+]
+
+
+def _load_budget():
+    with open(BUDGET_FILE) as budget_fp:
+        return json.load(budget_fp)
+
+
+class TestApiCallBudget(object):
+    '''
+        Counts the AWS API calls each command makes against moto and fails
+        when an operation is called more often than api_call_budget.json
+        allows. Run with --update-api-call-budget to rewrite the budget
+        after an intended change.
+    '''
+
+    @pytest.mark.parametrize('scenario', SCENARIOS, ids=lambda scenario: scenario.__name__)
+    def test_api_calls_within_budget(self, scenario, aws_environment, api_calls, request):
+        scenario(aws_environment)
+        call_counts = api_calls.call_counts()
+
+        if request.config.getoption('--update-api-call-budget'):
+            budget = _load_budget()
+            budget[scenario.__name__] = dict(sorted(call_counts.items()))
+            with open(BUDGET_FILE, 'w') as budget_fp:
+                json.dump(dict(sorted(budget.items())), budget_fp, indent=4)
+                budget_fp.write('\n')
+            return
+
+        budget = _load_budget()[scenario.__name__]
+        over_budget = {
+            operation: '%d calls, budget %d' % (calls, budget.get(operation, 0))
+            for operation, calls in call_counts.items()
+            if calls > budget.get(operation, 0)
+        }
+        assert not over_budget, \
+            '%s made more AWS API calls than budgeted: %s' % (scenario.__name__, over_budget)
+
+    @pytest.mark.parametrize('scenario', SCENARIOS, ids=lambda scenario: scenario.__name__)
+    def test_wall_time(self, scenario, fake_cloudformation, request, capsys):
+        runs = request.config.getoption('--benchmark-runs')
+        if not runs:
+            pytest.skip('pass --benchmark-runs N to time the scenarios')
+        timings = []
+        for _ in range(runs):
+            with seeded_environment(fake_cloudformation) as aws_environment:
+                started_at = time.perf_counter()
+                scenario(aws_environment)
+                timings.append(time.perf_counter() - started_at)
+        with capsys.disabled():
+            print('\n%s: %d runs, min %.3fs, median %.3fs, max %.3fs' % (
+                scenario.__name__, runs, min(timings),
+                statistics.median(timings), max(timings)))
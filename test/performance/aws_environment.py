@@ -0,0 +1,294 @@
+"""
+A cloudlift environment on moto, shared by the performance tests.
+"""
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from contextlib import ExitStack, contextmanager
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from moto import (mock_dynamodb2, mock_ecr, mock_ecs, mock_iam, mock_s3,
+                  mock_sns, mock_ssm, mock_sts)
+
+from cloudlift.config import account
+from cloudlift.config.pre_flight import preflight_cache
+from cloudlift.version import VERSION
+
+REGION = 'us-west-2'
+ACCOUNT_ID = '123456789012'
+ENVIRONMENT = 'staging'
+SERVICE = 'dummy'
+ECS_SERVICES = ['Dummy', 'DummyRunSidekiqsh']
+ENV_SAMPLE_FILE = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'templates', 'test_env.sample'))
+
+
+class FakeCloudFormation(object):
+    '''
+        moto's CloudFormation backend pulls in every other moto service and
+        dependencies which conflict with ours, so stacks are faked here.
+        Registered as botocore event handlers, like botocore's Stubber, it
+        answers the CloudFormation operations cloudlift uses from an
+        in-memory dict of stacks.
+    '''
+
+    def __init__(self):
+        self.stacks = {}
+        self.change_sets = {}
+
+    def add_stack(self, stack_name, outputs):
+        self.stacks[stack_name] = {
+            'StackName': stack_name,
+            'StackId': 'arn:aws:cloudformation:%s:%s:stack/%s/%s' % (
+                REGION, ACCOUNT_ID, stack_name, uuid.uuid4()),
+            'StackStatus': 'UPDATE_COMPLETE',
+            'CreationTime': '2020-01-01T00:00:00Z',
+            'Outputs': [
+                {'OutputKey': key, 'OutputValue': value}
+                for key, value in outputs.items()
+            ],
+        }
+        return self.stacks[stack_name]
+
+    def remember_params(self, params, context, **kwargs):
+        context['fake_cloudformation_params'] = params
+
+    def respond(self, model, context, **kwargs):
+        handler = getattr(self, '_' + model.name, None)
+        if handler is None:
+            raise NotImplementedError('CloudFormation ' + model.name)
+        status, parsed = handler(context['fake_cloudformation_params'])
+        return AWSResponse(None, status, {}, None), parsed
+
+    def _error(self, message):
+        return 400, {'Error': {'Code': 'ValidationError', 'Message': message}}
+
+    def _DescribeStacks(self, params):
+        if params['StackName'] not in self.stacks:
+            return self._error('Stack with id %s does not exist' % params['StackName'])
+        return 200, {'Stacks': [self.stacks[params['StackName']]]}
+
+    def _DescribeStackEvents(self, params):
+        return 200, {'StackEvents': []}
+
+    def _CreateChangeSet(self, params):
+        change_set_id = 'arn:aws:cloudformation:%s:%s:changeSet/%s/%s' % (
+            REGION, ACCOUNT_ID, params['ChangeSetName'], uuid.uuid4())
+        self.change_sets[change_set_id] = params['StackName']
+        return 200, {'Id': change_set_id}
+
+    def _DescribeChangeSet(self, params):
+        return 200, {
+            'ChangeSetId': params['ChangeSetName'],
+            'Status': 'CREATE_COMPLETE',
+            'Changes': [{
+                'ResourceChange': {
+                    'Action': 'Modify',
+                    'LogicalResourceId': 'Dummy',
+                    'ResourceType': 'AWS::ECS::Service',
+                    'Details': [],
+                }
+            }],
+        }
+
+    def _ExecuteChangeSet(self, params):
+        return 200, {}
+
+    def _DeleteChangeSet(self, params):
+        return 200, {}
+
+
+def _put_environment_configuration(notifications_arn):
+    table = boto3.resource('dynamodb').create_table(
+        TableName='environment_configurations',
+        AttributeDefinitions=[{'AttributeName': 'environment', 'AttributeType': 'S'}],
+        KeySchema=[{'AttributeName': 'environment', 'KeyType': 'HASH'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    table.put_item(Item={
+        'environment': ENVIRONMENT,
+        'configuration': {
+            ENVIRONMENT: {
+                'cluster': {
+                    'instance_type': 'm5.xlarge',
+                    'key_name': 'staging-cluster',
+                    'max_instances': 10,
+                    'min_instances': 1
+                },
+                'environment': {
+                    'notifications_arn': notifications_arn,
+                    'ssl_certificate_arn': 'arn:aws:acm:%s:%s:certificate/dummy' % (REGION, ACCOUNT_ID)
+                },
+                'region': REGION,
+                'vpc': {
+                    'cidr': '10.30.0.0/16',
+                    'nat-gateway': {'elastic-ip-allocation-id': 'eipalloc-dummy'},
+                    'subnets': {
+                        'private': {
+                            'subnet-1': {'cidr': '10.30.4.0/22'},
+                            'subnet-2': {'cidr': '10.30.12.0/22'}
+                        },
+                        'public': {
+                            'subnet-1': {'cidr': '10.30.0.0/22'},
+                            'subnet-2': {'cidr': '10.30.8.0/22'}
+                        }
+                    }
+                }
+            },
+            'cloudlift_version': VERSION
+        }
+    })
+
+
+def _put_service_configuration(notifications_arn):
+    table = boto3.resource('dynamodb').create_table(
+        TableName='service_configurations',
+        AttributeDefinitions=[
+            {'AttributeName': 'service_name', 'AttributeType': 'S'},
+            {'AttributeName': 'environment', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {'AttributeName': 'service_name', 'KeyType': 'HASH'},
+            {'AttributeName': 'environment', 'KeyType': 'RANGE'}
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    table.put_item(Item={
+        'service_name': SERVICE,
+        'environment': ENVIRONMENT,
+        'configuration': {
+            'cloudlift_version': VERSION,
+            'notifications_arn': notifications_arn,
+            'services': {
+                'Dummy': {
+                    'memory_reservation': 1000,
+                    'command': None,
+                    'http_interface': {
+                        'internal': False,
+                        'container_port': 7003,
+                        'restrict_access_to': ['0.0.0.0/0'],
+                        'health_check_path': '/elb-check'
+                    }
+                },
+                'DummyRunSidekiqsh': {
+                    'memory_reservation': 1000,
+                    'command': './run-sidekiq.sh'
+                }
+            }
+        }
+    })
+
+
+def _put_parameters():
+    ssm = boto3.client('ssm')
+    ssm.put_parameter(Name='/%s/%s/VAR1' % (ENVIRONMENT, SERVICE), Value='val1',
+                      Type='SecureString', KeyId='alias/aws/ssm')
+    return ssm.get_parameter(Name='/%s/%s/VAR1' % (ENVIRONMENT, SERVICE))['Parameter']['ARN']
+
+
+def _put_image():
+    ecr = boto3.client('ecr')
+    ecr.create_repository(repositoryName=SERVICE + '-repo')
+    ecr.put_image(
+        repositoryName=SERVICE + '-repo',
+        imageTag='v1',
+        imageManifest=json.dumps({'schemaVersion': 2, 'layers': []})
+    )
+    return '%s.dkr.ecr.%s.amazonaws.com/%s-repo' % (ACCOUNT_ID, REGION, SERVICE)
+
+
+def _put_ecs_services(image_uri, parameter_arn):
+    execution_role_arn = boto3.client('iam').create_role(
+        RoleName='ecsTaskExecutionRole',
+        AssumeRolePolicyDocument=json.dumps({
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Effect': 'Allow',
+                'Principal': {'Service': 'ecs-tasks.amazonaws.com'},
+                'Action': 'sts:AssumeRole'
+            }]
+        })
+    )['Role']['Arn']
+    ecs = boto3.client('ecs')
+    cluster_name = 'cluster-' + ENVIRONMENT
+    ecs.create_cluster(clusterName=cluster_name)
+    ecs_service_names = {}
+    for ecs_service in ECS_SERVICES:
+        task_definition = ecs.register_task_definition(
+            family=SERVICE + ecs_service + 'Family',
+            executionRoleArn=execution_role_arn,
+            containerDefinitions=[{
+                'name': ecs_service + 'Container',
+                'image': image_uri + ':v0',
+                'memoryReservation': 1000,
+                'secrets': [{'name': 'VAR1', 'valueFrom': parameter_arn}]
+            }]
+        )['taskDefinition']
+        ecs_service_name = '-'.join([SERVICE, ENVIRONMENT, ecs_service])
+        ecs.create_service(
+            cluster=cluster_name,
+            serviceName=ecs_service_name,
+            taskDefinition=task_definition['taskDefinitionArn'],
+            desiredCount=1
+        )
+        ecs_service_names[ecs_service + 'EcsServiceName'] = ecs_service_name
+    return ecs_service_names
+
+
+
+
+@contextmanager
+def seeded_environment(fake_cloudformation):
+    '''
+        A cloudlift environment with one service of two ECS services,
+        deployed at version v0 with image v1 waiting in ECR.
+    '''
+    fake_cloudformation.stacks.clear()
+    fake_cloudformation.change_sets.clear()
+    with ExitStack() as stack:
+        for mock_service in [mock_dynamodb2, mock_ecr, mock_ecs, mock_iam,
+                             mock_s3, mock_sns, mock_ssm, mock_sts]:
+            stack.enter_context(mock_service())
+        notifications_arn = boto3.client('sns').create_topic(Name='staging-alerts')['TopicArn']
+        _put_environment_configuration(notifications_arn)
+        _put_service_configuration(notifications_arn)
+        parameter_arn = _put_parameters()
+        image_uri = _put_image()
+        ecs_service_names = _put_ecs_services(image_uri, parameter_arn)
+        fake_cloudformation.add_stack('cluster-' + ENVIRONMENT, {
+            'VPC': 'vpc-00f07c5a6b6c9abdb',
+            'PublicSubnet1': 'subnet-0aeae8fe5e13a7ff7',
+            'PublicSubnet2': 'subnet-096377a44ccb73aca',
+            'PrivateSubnet1': 'subnet-09b6cd23af94861cc',
+            'PrivateSubnet2': 'subnet-0657bc2faa99ce5f7',
+            'SecurityGroupAlb': 'sg-095dbeb511019cfd8',
+            'ECSClusterDefaultInstanceLifecycle': 'OnDemand',
+        })
+        fake_cloudformation.add_stack('-'.join([SERVICE, ENVIRONMENT]), ecs_service_names)
+        account._get_default_caller_identity.cache_clear()
+        preflight_cache.clear()
+        try:
+            yield fake_cloudformation
+        finally:
+            account._get_default_caller_identity.cache_clear()
+            preflight_cache.clear()
+
+
+@contextmanager
+def service_directory():
+    '''
+        Run from a checkout of the service, for commands which read
+        ./env.sample.
+    '''
+    previous_directory = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='cloudlift-service-')
+    shutil.copy(ENV_SAMPLE_FILE, os.path.join(directory, 'env.sample'))
+    os.chdir(directory)
+    try:
+        yield directory
+    finally:
+        os.chdir(previous_directory)
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,48 @@
+import boto3
+import botocore.handlers
+import pytest
+
+from aws_environment import FakeCloudFormation, REGION, seeded_environment
+from cloudlift.profiling import API_PROFILE_SPOOL_ENV, api_call_recorder
+
+
+@pytest.fixture
+def aws_credentials(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', REGION)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+    monkeypatch.delenv('AWS_DEFAULT_PROFILE', raising=False)
+
+
+@pytest.fixture
+def fake_cloudformation(monkeypatch, aws_credentials):
+    fake = FakeCloudFormation()
+    fake_handlers = [
+        ('before-parameter-build.cloudformation', fake.remember_params),
+        ('before-call.cloudformation', fake.respond),
+    ]
+    # extended in place, as moto adds its own handler to the same list
+    botocore.handlers.BUILTIN_HANDLERS.extend(fake_handlers)
+    monkeypatch.setattr(boto3, 'DEFAULT_SESSION', None)
+    yield fake
+    for fake_handler in fake_handlers:
+        botocore.handlers.BUILTIN_HANDLERS.remove(fake_handler)
+
+
+@pytest.fixture
+def aws_environment(fake_cloudformation):
+    with seeded_environment(fake_cloudformation) as environment:
+        yield environment
+
+
+@pytest.fixture
+def api_calls(tmpdir, monkeypatch):
+    '''
+        Records the AWS API calls made by cloudlift clients created while
+        the fixture is active.
+    '''
+    monkeypatch.setenv(API_PROFILE_SPOOL_ENV, str(tmpdir.mkdir('api-profile')))
+    api_call_recorder.reset()
+    yield api_call_recorder
+    api_call_recorder.reset()
@@ -0,0 +1,126 @@
+import statistics
+import time
+
+import pytest
+from jsonschema import validate
+
+from cloudlift.config.environment_configuration import (
+    ENVIRONMENT_SCHEMA, _environment_configuration_validator)
+from cloudlift.config.service_configuration import (
+    SERVICE_CONFIGURATION_SCHEMA, _service_configuration_validator)
+from cloudlift.config.utils import validate_configuration
+from cloudlift.version import VERSION
+
+SERVICE_COUNT = 150
+ENVIRONMENT = 'staging'
+
+
+def service_configuration(service_count=SERVICE_COUNT):
+    return {
+        'cloudlift_version': VERSION,
+        'notifications_arn': 'arn:aws:sns:us-west-2:123456789012:team',
+        'services': {
+            'Service' + ''.join(chr(ord('A') + int(digit)) for digit in '%03d' % index): {
+                'memory_reservation': 512,
+                'command': None if index % 2 == 0 else './run-worker.sh',
+                'http_interface': {
+                    'internal': index % 4 == 0,
+                    'container_port': 8000 + index,
+                    'restrict_access_to': ['10.0.0.0/8'],
+                    'health_check_path': '/health',
+                },
+                'custom_metrics': {'metrics_port': '9100', 'metrics_path': '/metrics'},
+                'logging': 'awslogs',
+                'depends_on': [{'container_name': 'statsd-sidecar', 'condition': 'START'}],
+                'sidecars': [{
+                    'name': 'statsd-sidecar',
+                    'image_uri': 'statsd/statsd:latest',
+                    'memory_reservation': 64,
+                    'essential': True,
+                    'env': {'STATSD_PORT': '8125'},
+                    'health_check': {'command': ['CMD-SHELL', 'exit 0'], 'interval': 10},
+                }],
+            }
+            for index in range(service_count)
+        },
+    }
+
+
+def environment_configuration():
+    subnets = {
+        'subnet-1': {'cidr': '10.0.0.0/24'},
+        'subnet-2': {'cidr': '10.0.1.0/24'},
+    }
+    return {
+        ENVIRONMENT: {
+            'cluster': {
+                'min_instances': 1,
+                'max_instances': 5,
+                'instance_type': 'm5.xlarge',
+                'key_name': 'staging',
+            },
+            'environment': {
+                'notifications_arn': 'arn:aws:sns:us-west-2:123456789012:team',
+                'ssl_certificate_arn': 'arn:aws:acm:us-west-2:123456789012:certificate/1',
+            },
+            'region': 'us-west-2',
+            'vpc': {
+                'cidr': '10.0.0.0/16',
+                'nat-gateway': {'elastic-ip-allocation-id': 'eipalloc-1'},
+                'subnets': {'private': subnets, 'public': subnets},
+            },
+        },
+        'cloudlift_version': VERSION,
+    }
+
+
+def _time(validate_once, runs):
+    timings = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        validate_once()
+        timings.append(time.perf_counter() - started_at)
+    return timings
+
+
+class TestSchemaValidationBenchmark(object):
+    '''
+        Compares the precompiled configuration validators with
+        jsonschema.validate, which checks the schema on every call.
+    '''
+
+    def test_large_configurations_are_valid(self):
+        validate_configuration(_service_configuration_validator(), service_configuration(),
+                               collect_all_errors=True)
+        validate_configuration(_environment_configuration_validator(ENVIRONMENT),
+                               environment_configuration(), collect_all_errors=True)
+
+    @pytest.mark.parametrize('name', ['service', 'environment'])
+    def test_validation_time(self, name, request, capsys):
+        runs = request.config.getoption('--benchmark-runs')
+        if not runs:
+            pytest.skip('pass --benchmark-runs N to benchmark schema validation')
+        if name == 'service':
+            configuration = service_configuration()
+            schema = SERVICE_CONFIGURATION_SCHEMA
+            validator = _service_configuration_validator()
+        else:
+            configuration = environment_configuration()
+            schema = {
+                'type': 'object',
+                'properties': {ENVIRONMENT: ENVIRONMENT_SCHEMA},
+                'required': [ENVIRONMENT]
+            }
+            validator = _environment_configuration_validator(ENVIRONMENT)
+
+        uncompiled = _time(lambda: validate(configuration, schema), runs)
+        compiled = _time(lambda: validate_configuration(validator, configuration), runs)
+        all_errors = _time(
+            lambda: validate_configuration(validator, configuration, collect_all_errors=True), runs)
+
+        with capsys.disabled():
+            for mode, timings in [('jsonschema.validate', uncompiled),
+                                  ('precompiled', compiled),
+                                  ('precompiled, all errors', all_errors)]:
+                print('\n%s configuration (%d services), %s: %d runs, median %.2fms' % (
+                    name, SERVICE_COUNT, mode, runs, statistics.median(timings) * 1000))
@@ -0,0 +1,340 @@
+import contextlib
+import json
+import statistics
+import time
+import tracemalloc
+
+import pytest
+import troposphere
+from cfn_flip import to_json
+from mock import MagicMock, patch
+
+from cloudlift.constants import FLUENTBIT_FIRELENS_SIDECAR_CONTAINER_NAME
+from cloudlift.deployment.cluster_template_generator import ClusterTemplateGenerator
+from cloudlift.deployment.service_template_generator import ServiceTemplateGenerator
+from cloudlift.version import VERSION
+
+from aws_environment import ACCOUNT_ID, ENVIRONMENT, REGION
+
+SERVICE = 'monorepo'
+SERVICE_COUNTS = [1, 10, 50, 200]
+SUBNET_COUNTS = [2, 4, 8]
+INSTANCE_TYPE_COUNTS = [1, 4, 10]
+INSTANCE_TYPES = ['m5.large', 'm5.xlarge', 'm5a.large', 'm5a.xlarge', 'm6i.large',
+                  'm6i.xlarge', 'c5.large', 'c5.xlarge', 'r5.large', 'r5.xlarge']
+NOTIFICATIONS_ARN = 'arn:aws:sns:%s:%s:platform-team' % (REGION, ACCOUNT_ID)
+SSL_CERTIFICATE_ARN = 'arn:aws:acm:%s:%s:certificate/benchmark' % (REGION, ACCOUNT_ID)
+SECRET_COUNT = 30
+
+
+class SyntheticServiceConfiguration(object):
+    '''
+        Stands in for ServiceConfiguration, which reads from DynamoDB.
+    '''
+
+    def __init__(self, configuration):
+        self.service_name = SERVICE
+        self.environment = ENVIRONMENT
+        self.configuration = configuration
+
+    def get_config(self, cloudlift_version):
+        return self.configuration
+
+
+def _synthetic_service(index):
+    # every service has sidecars; the rest of the features are mixed so all
+    # of the generator's branches are exercised at every scale
+    config = {
+        'memory_reservation': 512,
+        'command': None if index % 2 == 0 else './run-worker-%d.sh' % index,
+        'sidecars': [
+            {
+                'name': 'statsd',
+                'image_uri': 'statsd/statsd:latest',
+                'memory_reservation': 64,
+                'env': {'STATSD_PORT': '8125', 'STATSD_FLUSH_INTERVAL': '10000'},
+                'health_check': {
+                    'command': ['CMD-SHELL', 'nc -z localhost 8125 || exit 1'],
+                    'interval': 10,
+                    'timeout': 2,
+                    'retries': 3,
+                },
+            },
+            {
+                'name': 'envoy',
+                'image_uri': 'envoyproxy/envoy:v1.28',
+                'memory_reservation': 128,
+                'essential': False,
+            },
+        ],
+    }
+    if index % 2 == 0:
+        config['http_interface'] = {
+            'internal': index % 4 == 0,
+            'container_port': 8000 + index,
+            'restrict_access_to': ['10.0.0.0/8', '0.0.0.0/0'],
+            'health_check_path': '/health',
+        }
+    if index % 3 == 0:
+        config['custom_metrics'] = {
+            'metrics_port': str(9000 + index),
+            'metrics_path': '/metrics',
+        }
+    if index % 4 == 1:
+        config['logging'] = 'awsfirelens'
+        config['sidecars'].append({
+            'name': FLUENTBIT_FIRELENS_SIDECAR_CONTAINER_NAME,
+            'memory_reservation': 100,
+            'essential': True,
+            'image_uri': 'amazon/aws-for-fluent-bit:stable',
+            'env': {'delivery_stream': '%s-%s' % (ENVIRONMENT, SERVICE)},
+            'logging': 'awslogs',
+            'health_check': {
+                'command': ['CMD-SHELL', 'curl -f -s http://localhost:2020/api/v1/health || exit 1'],
+                'interval': 5,
+                'timeout': 2,
+                'retries': 3,
+            },
+        })
+        config['depends_on'] = [{
+            'container_name': FLUENTBIT_FIRELENS_SIDECAR_CONTAINER_NAME,
+            'condition': 'START',
+        }]
+    if index % 5 == 4:
+        config['fargate'] = {'cpu': 512, 'memory': 1024}
+    return config
+
+
+def synthetic_service_configuration(service_count):
+    return {
+        'cloudlift_version': VERSION,
+        'services': {
+            'Service%03d' % index: _synthetic_service(index)
+            for index in range(service_count)
+        },
+    }
+
+
+def synthetic_environment_configuration(subnet_count=2, instance_type_count=1):
+    return {
+        'region': REGION,
+        'vpc': {
+            'cidr': '10.0.0.0/16',
+            'nat-gateway': {'elastic-ip-allocation-id': 'eipalloc-benchmark'},
+            'subnets': {
+                'public': {
+                    'public-subnet-%d' % index: {'cidr': '10.0.%d.0/24' % index}
+                    for index in range(1, subnet_count + 1)
+                },
+                'private': {
+                    'private-subnet-%d' % index: {'cidr': '10.0.%d.0/24' % (100 + index)}
+                    for index in range(1, subnet_count + 1)
+                },
+            },
+        },
+        'cluster': {
+            'min_instances': 2,
+            'max_instances': 10,
+            'spot_min_instances': 1,
+            'spot_max_instances': 10,
+            'instance_type': ','.join(INSTANCE_TYPES[:instance_type_count]),
+            'key_name': 'benchmark',
+            'ami_id': 'None',
+            'ecs_instance_default_lifecycle_type': 'ondemand',
+        },
+        'environment': {
+            'notifications_arn': NOTIFICATIONS_ARN,
+            'ssl_certificate_arn': SSL_CERTIFICATE_ARN,
+        },
+        'service_defaults': {
+            'logging': 'awslogs',
+            'fluentbit_config': {
+                'image_uri': 'amazon/aws-for-fluent-bit:stable',
+                'env': {'kinesis_role_arn': ''},
+            },
+        },
+    }
+
+
+def environment_stack():
+    outputs = {
+        'VPC': 'vpc-benchmark',
+        'PublicSubnet1': 'subnet-public-1',
+        'PublicSubnet2': 'subnet-public-2',
+        'PrivateSubnet1': 'subnet-private-1',
+        'PrivateSubnet2': 'subnet-private-2',
+        'SecurityGroupAlb': 'sg-alb',
+        'ECSClusterDefaultInstanceLifecycle': 'ondemand',
+    }
+    # a real cluster stack has many more outputs than the ones services use
+    outputs.update({'Unused%d' % index: 'value-%d' % index for index in range(40)})
+    return {
+        'StackName': 'cluster-' + ENVIRONMENT,
+        'Outputs': [
+            {'OutputKey': key, 'OutputValue': value}
+            for key, value in outputs.items()
+        ],
+    }
+
+
+@contextlib.contextmanager
+def stubbed_aws():
+    '''
+        Replaces every AWS lookup the template generators make, so the
+        benchmark measures template generation only. Yields the S3 client
+        stub, which receives templates too large to inline.
+
+        troposphere enforces CloudFormation's per-stack resource and output
+        limits, which the larger synthetic stacks pass, so those are lifted.
+    '''
+    s3_client = MagicMock()
+    cloudformation_client = MagicMock()
+    cloudformation_client.describe_stacks.side_effect = Exception('Stack does not exist')
+    ec2_and_ssm_client = MagicMock()
+    ec2_and_ssm_client.describe_availability_zones.return_value = {
+        'AvailabilityZones': [{'ZoneName': REGION + zone} for zone in 'abc']
+    }
+    ec2_and_ssm_client.get_parameter.return_value = {
+        'Parameter': {'Value': json.dumps({'image_id': 'ami-benchmark'})}
+    }
+    boto3_stub = MagicMock()
+    boto3_stub.resource.return_value.Role.return_value.arn = \
+        'arn:aws:iam::%s:role/ecsTaskExecutionRole' % ACCOUNT_ID
+    secrets = [
+        ('SECRET_%d' % index,
+         'arn:aws:ssm:%s:%s:parameter/%s/%s/SECRET_%d' % (
+             REGION, ACCOUNT_ID, ENVIRONMENT, SERVICE, index))
+        for index in range(SECRET_COUNT)
+    ]
+    environment_configuration = MagicMock()
+    environment_configuration.return_value.get_config.return_value = {
+        ENVIRONMENT: synthetic_environment_configuration()
+    }
+    service_information_fetcher = MagicMock()
+    service_information_fetcher.return_value.get_current_version.return_value = 'v1'
+
+    generator_module = 'cloudlift.deployment.service_template_generator'
+    with patch('cloudlift.config.region.get_region_for_environment', return_value=REGION), \
+            patch('cloudlift.config.region.get_notifications_arn_for_environment',
+                  return_value=NOTIFICATIONS_ARN), \
+            patch('cloudlift.config.region.get_ssl_certification_for_environment',
+                  return_value=SSL_CERTIFICATE_ARN), \
+            patch('cloudlift.config.region.get_client_for', return_value=cloudformation_client), \
+            patch(generator_module + '.get_client_for', return_value=s3_client), \
+            patch(generator_module + '.get_account_id', return_value=ACCOUNT_ID), \
+            patch(generator_module + '.build_config', return_value=secrets), \
+            patch(generator_module + '.boto3', new=boto3_stub), \
+            patch(generator_module + '.EnvironmentConfiguration', new=environment_configuration), \
+            patch(generator_module + '.ServiceInformationFetcher', new=service_information_fetcher), \
+            patch('cloudlift.deployment.cluster_template_generator.get_client_for',
+                  return_value=ec2_and_ssm_client), \
+            patch('cloudlift.deployment.cluster_template_generator.get_region_for_environment',
+                  return_value=REGION), \
+            patch(generator_module + '.log'), \
+            patch(generator_module + '.log_bold'), \
+            patch.object(troposphere, 'MAX_RESOURCES', 10 ** 6), \
+            patch.object(troposphere, 'MAX_OUTPUTS', 10 ** 6):
+        yield s3_client
+
+
+def generate_service_template(service_count, s3_client):
+    generator = ServiceTemplateGenerator(
+        SyntheticServiceConfiguration(synthetic_service_configuration(service_count)),
+        environment_stack()
+    )
+    template, template_source, _ = generator.generate_service()
+    if template_source == 'TemplateURL':
+        return s3_client.put_object.call_args[1]['Body']
+    return template
+
+
+def generate_cluster_template(subnet_count, instance_type_count):
+    return ClusterTemplateGenerator(
+        ENVIRONMENT,
+        synthetic_environment_configuration(subnet_count, instance_type_count)
+    ).generate_cluster()
+
+
+def _measure(generate, runs):
+    '''
+        Time runs generations, then run once more under tracemalloc, which
+        slows allocation down too much to time with it on.
+    '''
+    timings = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        generate()
+        timings.append(time.perf_counter() - started_at)
+    tracemalloc.start()
+    try:
+        template = generate()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return timings, peak_memory, len(template.encode('utf-8'))
+
+
+def _report(capsys, name, runs, timings, peak_memory, template_size):
+    with capsys.disabled():
+        print('\n%s: %d runs, min %.3fs, median %.3fs, max %.3fs, '
+              'peak memory %.1f MiB, template %.1f KiB' % (
+                  name, runs, min(timings), statistics.median(timings),
+                  max(timings), peak_memory / 2 ** 20, template_size / 2 ** 10))
+
+
+class TestTemplateGenerationBenchmark(object):
+    '''
+        Tracks the cost of generating CloudFormation templates as stacks grow.
+        The benchmarks only run with --benchmark-runs N; the smoke tests check
+        the synthetic configurations still produce complete templates.
+    '''
+
+    def test_service_template_contains_every_service(self):
+        with stubbed_aws() as s3_client:
+            template = json.loads(to_json(generate_service_template(10, s3_client)))
+
+        resources = template['Resources']
+        for index in range(10):
+            service_name = 'Service%03d' % index
+            assert service_name + 'TaskDefinition' in resources
+            container_names = [
+                container['Name'] for container in
+                resources[service_name + 'TaskDefinition']['Properties']['ContainerDefinitions']
+            ]
+            assert 'statsd-sidecar' in container_names
+            assert (FLUENTBIT_FIRELENS_SIDECAR_CONTAINER_NAME in container_names) == (index % 4 == 1)
+            assert (service_name + 'ServiceRegistry' in resources) == (index % 3 == 0)
+        assert template['Parameters']['PrivateSubnet2']['Default'] == 'subnet-private-2'
+
+    def test_cluster_template_contains_every_subnet(self):
+        with stubbed_aws():
+            template = json.loads(to_json(generate_cluster_template(4, 4)))
+
+        subnets = [
+            resource for resource in template['Resources'].values()
+            if resource['Type'] == 'AWS::EC2::Subnet'
+        ]
+        assert len(subnets) == 8
+        assert template['Parameters']['InstanceTypes']['Default'] == ','.join(INSTANCE_TYPES[:4])
+
+    @pytest.mark.parametrize('service_count', SERVICE_COUNTS)
+    def test_service_template_generation(self, service_count, request, capsys):
+        runs = request.config.getoption('--benchmark-runs')
+        if not runs:
+            pytest.skip('pass --benchmark-runs N to benchmark template generation')
+        with stubbed_aws() as s3_client:
+            measurements = _measure(
+                lambda: generate_service_template(service_count, s3_client), runs)
+        _report(capsys, 'service template, %d services' % service_count, runs, *measurements)
+
+    @pytest.mark.parametrize('instance_type_count', INSTANCE_TYPE_COUNTS)
+    @pytest.mark.parametrize('subnet_count', SUBNET_COUNTS)
+    def test_cluster_template_generation(self, subnet_count, instance_type_count, request, capsys):
+        runs = request.config.getoption('--benchmark-runs')
+        if not runs:
+            pytest.skip('pass --benchmark-runs N to benchmark template generation')
+        with stubbed_aws():
+            measurements = _measure(
+                lambda: generate_cluster_template(subnet_count, instance_type_count), runs)
+        _report(capsys, 'cluster template, %d subnets per tier, %d instance types' % (
+            subnet_count, instance_type_count), runs, *measurements)
@@ -0,0 +1,99 @@
+import json
+import os
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+from cloudlift.profiling import API_PROFILE_SPOOL_ENV, ApiCallRecorder
+
+
+class TestApiCallRecorder(object):
+    @pytest.fixture(autouse=True)
+    def spool_dir(self, tmpdir, monkeypatch):
+        spool_dir = tmpdir.mkdir('spool')
+        monkeypatch.setenv(API_PROFILE_SPOOL_ENV, str(spool_dir))
+        return spool_dir
+
+    def _stubbed_ecs_client(self, recorder):
+        client = recorder.instrument(
+            boto3.session.Session(region_name='us-west-2').client('ecs'))
+        return client, Stubber(client)
+
+    def test_records_calls_and_errors_per_operation(self):
+        recorder = ApiCallRecorder()
+        client, stubber = self._stubbed_ecs_client(recorder)
+        stubber.add_response('list_clusters', {'clusterArns': []})
+        stubber.add_response('list_clusters', {'clusterArns': []})
+        stubber.add_client_error('describe_clusters', 'ClusterNotFoundException')
+
+        with stubber:
+            client.list_clusters()
+            client.list_clusters()
+            with pytest.raises(ClientError):
+                client.describe_clusters(clusters=['missing'])
+
+        assert recorder.call_counts() == {
+            'ecs.ListClusters': 2,
+            'ecs.DescribeClusters': 1,
+        }
+        rows = {row['operation']: row for row in recorder.summary()}
+        assert rows['DescribeClusters']['errors'] == 1
+        assert rows['ListClusters']['errors'] == 0
+
+    def test_merges_calls_spooled_by_other_processes(self):
+        child = ApiCallRecorder()
+        client, stubber = self._stubbed_ecs_client(child)
+        stubber.add_response('list_clusters', {'clusterArns': []})
+        with stubber:
+            client.list_clusters()
+        child.spool()
+
+        parent = ApiCallRecorder()
+        assert parent.call_counts() == {'ecs.ListClusters': 1}
+
+    def test_forked_children_spool_only_their_own_calls(self):
+        recorder = ApiCallRecorder()
+        client, stubber = self._stubbed_ecs_client(recorder)
+        stubber.add_response('list_clusters', {'clusterArns': []})
+        with stubber:
+            client.list_clusters()
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                recorder.spool()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        assert recorder.call_counts() == {'ecs.ListClusters': 1}
+
+    def test_records_without_fork_hooks(self, monkeypatch):
+        # Python 3.6 has no os.register_at_fork
+        monkeypatch.delattr(os, 'register_at_fork')
+        recorder = ApiCallRecorder()
+        client, stubber = self._stubbed_ecs_client(recorder)
+        stubber.add_response('list_clusters', {'clusterArns': []})
+        with stubber:
+            client.list_clusters()
+
+        assert recorder.call_counts() == {'ecs.ListClusters': 1}
+
+    def test_report_writes_json_and_removes_spool(self, spool_dir, tmpdir):
+        recorder = ApiCallRecorder()
+        client, stubber = self._stubbed_ecs_client(recorder)
+        stubber.add_response('list_clusters', {'clusterArns': []})
+        with stubber:
+            client.list_clusters()
+        output_path = str(tmpdir.join('profile.json'))
+
+        recorder.report(output_path)
+
+        with open(output_path) as output_fp:
+            profile = json.load(output_fp)
+        assert profile['total_calls'] == 1
+        assert profile['operations'][0]['operation'] == 'ListClusters'
+        assert API_PROFILE_SPOOL_ENV not in os.environ
+        assert not spool_dir.check()
@@ -0,0 +1,102 @@
+import json
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+from cloudlift.profiling import TRACE_SPOOL_ENV, tracer
+from cloudlift.profiling.spans import Tracer
+
+
+def _child_phase():
+    with tracer.span('child phase'):
+        pass
+
+
+class TestTracer(object):
+    @pytest.fixture(autouse=True)
+    def spool_dir(self, tmpdir, monkeypatch):
+        spool_dir = tmpdir.mkdir('spool')
+        monkeypatch.setenv(TRACE_SPOOL_ENV, str(spool_dir))
+        tracer.reset()
+        return spool_dir
+
+    def test_spans_nest_within_a_thread(self):
+        with tracer.span('deploy'):
+            with tracer.span('image build', tag='v1'):
+                pass
+
+        events = {event['name']: event for event in tracer.events()}
+        assert events['image build']['ph'] == 'X'
+        assert events['image build']['args']['tag'] == 'v1'
+        assert events['image build']['args']['parent_id'] == \
+            events['deploy']['args']['span_id']
+        assert 'parent_id' not in events['deploy']['args']
+
+    def test_spans_nest_across_threads_and_processes(self):
+        with tracer.span('deploy'):
+            thread = threading.Thread(
+                target=tracer.traced('thread work', _child_phase))
+            process = multiprocessing.Process(
+                target=tracer.traced('process work', _child_phase))
+            thread.start()
+            process.start()
+            thread.join()
+            process.join()
+
+        events = tracer.events()
+        by_name = {}
+        for event in events:
+            by_name.setdefault(event['name'], []).append(event)
+        deploy_id = by_name['deploy'][0]['args']['span_id']
+        assert by_name['thread work'][0]['args']['parent_id'] == deploy_id
+        assert by_name['process work'][0]['args']['parent_id'] == deploy_id
+        assert by_name['process work'][0]['pid'] != by_name['deploy'][0]['pid']
+        parents = {event['args']['parent_id'] for event in by_name['child phase']}
+        assert parents == {
+            by_name['thread work'][0]['args']['span_id'],
+            by_name['process work'][0]['args']['span_id'],
+        }
+
+    def test_forked_children_spool_only_their_own_spans(self):
+        with tracer.span('deploy'):
+            with tracer.span('config fetch'):
+                pass
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    _child_phase()
+                    tracer.spool()
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+
+        assert sorted(event['name'] for event in tracer.events()) == \
+            ['child phase', 'config fetch', 'deploy']
+
+    def test_traces_without_fork_hooks(self, monkeypatch):
+        # Python 3.6 has no os.register_at_fork
+        monkeypatch.delattr(os, 'register_at_fork')
+        own_tracer = Tracer()
+        with own_tracer.span('deploy'):
+            pass
+
+        assert [event['name'] for event in own_tracer.events()] == ['deploy']
+
+    def test_report_writes_chrome_trace_and_summary(self, tmpdir):
+        with tracer.span('deploy_service'):
+            for _ in range(2):
+                with tracer.span('ECS rollout'):
+                    pass
+        output_path = str(tmpdir.join('trace.json'))
+
+        summary = tracer.summary('deploy_service')
+        tracer.report(output_path, 'deploy_service')
+
+        assert summary.startswith('deploy_service took ')
+        assert 'ECS rollout' in summary and '(x2)' in summary
+        with open(output_path) as output_fp:
+            trace = json.load(output_fp)
+        assert [event['name'] for event in trace['traceEvents']] == \
+            ['deploy_service', 'ECS rollout', 'ECS rollout']